@@ -0,0 +1,63 @@
+"""
+Потоковая сборка ZIP-архива из файлов на диске.
+
+Архив не собирается целиком ни в памяти, ни во временном файле:
+zipfile пишет в буфер без перемотки, а генератор отдаёт накопленные
+байты по мере чтения файлов. Файлы хранятся без сжатия (ZIP_STORED):
+PDF уже сжаты, повторное сжатие только тратит процессор.
+"""
+import logging
+import os
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Размер блока чтения файлов
+CHUNK_SIZE = 64 * 1024
+
+
+class _StreamBuffer:
+    """Файлоподобный объект без перемотки: копит записанные байты до выдачи"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(paths):
+    """
+    Генератор байтов ZIP-архива с файлами paths (в архиве - под своими именами).
+    Отсутствующие файлы пропускаются. В памяти находится не больше блока файла.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for path in paths:
+            try:
+                source = open(path, 'rb')
+            except OSError as e:
+                logger.error(f"Ошибка добавления в архив {path}: {str(e)}")
+                continue
+
+            with source:
+                stat = os.fstat(source.fileno())
+                info = zipfile.ZipInfo(os.path.basename(path), time.localtime(stat.st_mtime)[:6])
+                info.file_size = stat.st_size
+                with archive.open(info, 'w') as target:
+                    while chunk := source.read(CHUNK_SIZE):
+                        target.write(chunk)
+                        yield buffer.pop()
+            yield buffer.pop()
+    # Центральный каталог записывается при закрытии архива
+    yield buffer.pop()
@@ -0,0 +1,121 @@
+"""
+Нормализация и проверка штрих-кодов перед генерацией.
+
+Excel отдаёт числовые штрих-коды как числа с плавающей точкой
+(2000000000026.0, 2.00123e+12), поэтому значения приводятся к строке
+целого числа без пробелов по краям. Затем проверяются символы (Code128
+кодирует только печатные символы ASCII), длина и контрольная цифра
+кодов EAN-8, UPC-A, EAN-13 и GTIN-14. Все проверки выполняются средствами
+pandas и NumPy для всей колонки сразу.
+"""
+import numpy as np
+import pandas as pd
+
+# Длины цифровых штрих-кодов: EAN-8, UPC-A, EAN-13, GTIN-14
+GTIN_LENGTHS = (8, 12, 13, 14)
+
+# Более длинные значения не помещаются на этикетку и не разбираются посимвольно
+MAX_LENGTH = 48
+
+
+def char_matrix(codes):
+    """
+    Коды символов строк: матрица NumPy (строк x длина самой длинной строки),
+    короткие строки дополнены нулями справа.
+    """
+    array = np.asarray(codes, dtype=str)
+    if array.size == 0:
+        return np.zeros((0, 0), dtype=np.uint32)
+    return array.view(np.uint32).reshape(len(array), -1)
+
+
+def normalize_barcodes(values):
+    """
+    Приводит значения к строкам штрих-кодов.
+    Числа с плавающей точкой с целым значением записываются как целые,
+    пустые ячейки - пустой строкой.
+    """
+    series = pd.Series(values, dtype=object)
+    codes = series.where(series.notna(), '').astype(str).str.strip()
+
+    # Кандидаты - короткие строки с точкой или экспонентой ('2000000000026.0', '2.00123e+12')
+    short = (codes.str.len() <= MAX_LENGTH).to_numpy()
+    chars = char_matrix(codes[short])
+    floating = np.zeros(len(codes), dtype=bool)
+    floating[short] = np.isin(chars, [ord('.'), ord('e'), ord('E')]).any(axis=1)
+
+    numbers = pd.to_numeric(codes[floating], errors='coerce')
+    # Целые значения в пределах точности float64
+    integral = numbers[(numbers % 1 == 0) & (numbers.abs() < 2 ** 53)]
+    codes[integral.index] = integral.astype('int64').astype(str)
+    return codes
+
+
+def check_digits(chars, lengths):
+    """
+    Контрольные цифры цифровых штрих-кодов.
+    chars - матрица char_matrix, lengths - длины строк.
+    Возвращает массивы NumPy (вычисленные, указанные в коде).
+    """
+    digits = chars.astype(np.int64) - ord('0')
+    # Позиция цифры от конца строки: контрольная - 0, перед ней вес 3, затем 1, 3, ...
+    position = lengths[:, None] - 1 - np.arange(chars.shape[1])
+    weights = np.where(position > 0, np.where(position % 2 == 1, 3, 1), 0)
+    expected = (10 - (digits * weights).sum(axis=1) % 10) % 10
+    actual = digits[np.arange(len(chars)), lengths - 1]
+    return expected, actual
+
+
+def barcode_errors(codes):
+    """
+    Описание ошибки для каждого штрих-кода ('' - штрих-код верный).
+    codes - строки после normalize_barcodes.
+    """
+    codes = pd.Series(codes, dtype=object).reset_index(drop=True)
+    lengths = codes.str.len().to_numpy(dtype=np.int64)
+    too_long = lengths > MAX_LENGTH
+
+    # Короткие строки проверяются по матрице символов
+    chars = char_matrix(codes.where(~too_long, ''))
+    present = chars != 0
+    printable = (((chars >= 0x20) & (chars <= 0x7e)) | ~present).all(axis=1)
+    numeric = (((chars >= ord('0')) & (chars <= ord('9'))) | ~present).all(axis=1) & (lengths > 0)
+    gtin = numeric & np.isin(lengths, GTIN_LENGTHS)
+
+    expected = np.zeros(len(codes), dtype=np.int64)
+    bad_check = np.zeros(len(codes), dtype=bool)
+    if gtin.any():
+        expected[gtin], actual = check_digits(chars[gtin], lengths[gtin])
+        bad_check[gtin] = expected[gtin] != actual
+
+    # Тексты ошибок собираются только для неверных строк (первая подходящая причина)
+    errors = np.full(len(codes), '', dtype=object)
+    lengths_text = ', '.join(map(str, GTIN_LENGTHS))
+    for index in np.flatnonzero(bad_check):
+        errors[index] = f"Неверная контрольная цифра (ожидается {expected[index]})"
+    for index in np.flatnonzero(numeric & ~gtin):
+        errors[index] = f"Неверная длина (цифр: {lengths[index]}; ожидается {lengths_text})"
+    errors[~printable] = 'Недопустимые символы (Code128 кодирует только латиницу, цифры и знаки)'
+    errors[too_long] = f"Слишком длинный штрих-код (больше {MAX_LENGTH} символов)"
+    errors[lengths == 0] = 'Нет штрих-кода'
+    return pd.Series(errors, dtype=object)
+
+
+def check_products(products, column):
+    """
+    Нормализует штрих-коды товаров в колонке column и отмечает неверные:
+    product['barcode_error'] - описание ошибки. Возвращает число неверных.
+    """
+    codes = normalize_barcodes([product['data'].get(column, '') for product in products])
+    errors = barcode_errors(codes)
+
+    invalid = 0
+    for product, code, error in zip(products, codes.tolist(), errors.tolist()):
+        if column in product['data']:
+            product['data'][column] = code
+        if error:
+            product['barcode_error'] = error
+            invalid += 1
+        else:
+            product.pop('barcode_error', None)
+    return invalid
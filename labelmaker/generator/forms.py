@@ -1,25 +1,48 @@
 from django import forms
 from django.core.validators import FileExtensionValidator
 
+# Допустимые форматы загружаемых файлов
+UPLOAD_EXTENSIONS = ['xlsx', 'csv', 'tsv']
+UPLOAD_ACCEPT = ','.join(f'.{extension}' for extension in UPLOAD_EXTENSIONS)
+
+
+class MultipleFileInput(forms.FileInput):
+    """Поле выбора нескольких файлов"""
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """Несколько файлов в одном поле: cleaned_data - список файлов"""
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(item, initial) for item in data]
+        return [single_file_clean(data, initial)] if data else []
+
+
 class UploadForm(forms.Form):
     """Форма для выбора типа генерации этикеток"""
-    bulk_file = forms.FileField(
+    bulk_file = MultipleFileField(
         label='Для массовой печати этикеток',
-        validators=[FileExtensionValidator(allowed_extensions=['xlsx'])],  # Разрешаем только Excel-файлы
-        widget=forms.FileInput(attrs={
+        validators=[FileExtensionValidator(allowed_extensions=UPLOAD_EXTENSIONS)],  # Excel-файлы и выгрузки CSV/TSV
+        widget=MultipleFileInput(attrs={
             'class': 'form-control',
-            'accept': '.xlsx'  # Подсказка браузеру для фильтрации файлов
+            'accept': UPLOAD_ACCEPT  # Подсказка браузеру для фильтрации файлов
         }),
         required=False,  # Поле необязательное
-        help_text='Будет создан единый PDF-файл со всеми этикетками'
+        help_text='Будет создан единый PDF-файл со всеми этикетками (несколько файлов объединяются)'
     )
     
-    template_file = forms.FileField(
+    template_file = MultipleFileField(
         label='Для генерации шаблонов',
-        validators=[FileExtensionValidator(allowed_extensions=['xlsx'])],
-        widget=forms.FileInput(attrs={
+        validators=[FileExtensionValidator(allowed_extensions=UPLOAD_EXTENSIONS)],
+        widget=MultipleFileInput(attrs={
             'class': 'form-control',
-            'accept': '.xlsx'
+            'accept': UPLOAD_ACCEPT
         }),
         required=False,
         help_text='Создаст отдельные PDF-файлы для каждого товара'
@@ -0,0 +1,158 @@
+"""
+Таблица товаров на шаге редактирования.
+
+Сгруппированные товары сохраняются черновиком в хранилище заданий
+(см. jobs.py), в сессии остаётся только его идентификатор. Страница
+редактирования получает строки по частям через JSON (постранично, с
+поиском на сервере) и отправляет обратно только изменённые строки,
+поэтому размер страницы и запроса не зависит от числа товаров.
+"""
+import threading
+from collections import OrderedDict
+
+from .forms import EditDataForm
+from .jobs import create_job, load_job, update_job, job_stamp
+
+# Предельное число строк на одной странице
+MAX_PAGE_SIZE = 500
+
+# Число черновиков, разобранных в памяти процесса
+CACHE_SIZE = 8
+
+# Разобранные черновики: {grid_id: (время изменения файла, товары, строки поиска)}
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _search_text(product):
+    """Строка поиска товара: значения всех колонок в нижнем регистре"""
+    return ' '.join(str(value) for value in product['data'].values()).lower()
+
+
+def _remember(grid_id, stamp, products):
+    with _cache_lock:
+        _cache[grid_id] = (stamp, products, [_search_text(product) for product in products])
+        _cache.move_to_end(grid_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def create_grid(products, is_template_mode, sources):
+    """
+    Сохраняет черновик таблицы и возвращает его идентификатор.
+    products - товары с количеством, предложенным по умолчанию.
+    """
+    grid_id = create_job(products, is_template_mode)
+    update_job(grid_id, sources=sources)
+    _remember(grid_id, job_stamp(grid_id), products)
+    return grid_id
+
+
+def load_grid(grid_id):
+    """
+    Товары и строки поиска черновика (из памяти, если файл не менялся).
+    Возвращает None, если черновика нет. Результат нельзя изменять.
+    """
+    stamp = job_stamp(grid_id)
+    if stamp is None:
+        return None
+    with _cache_lock:
+        cached = _cache.get(grid_id)
+        if cached is not None and cached[0] == stamp:
+            _cache.move_to_end(grid_id)
+            return cached[1], cached[2]
+
+    job = load_job(grid_id)
+    if job is None:
+        return None
+    _remember(grid_id, stamp, job['processed_data'])
+    with _cache_lock:
+        return _cache[grid_id][1], _cache[grid_id][2]
+
+
+def page_rows(grid_id, page=1, page_size=100, query='', invalid_only=False):
+    """
+    Страница строк черновика для редактора.
+
+    query - слова, которые должны встречаться в значениях колонок товара
+    (без учёта регистра), invalid_only - только товары с неверным штрих-кодом.
+    Строка содержит номер товара в черновике (index), по которому редактор
+    отправляет изменения, и описание ошибки штрих-кода (barcode_error).
+    """
+    grid = load_grid(grid_id)
+    if grid is None:
+        return None
+    products, search = grid
+
+    words = query.lower().split()
+    if words or invalid_only:
+        indexes = [
+            i for i, text in enumerate(search)
+            if all(word in text for word in words) and (not invalid_only or 'barcode_error' in products[i])
+        ]
+    else:
+        indexes = range(len(products))
+
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    pages = max(1, -(-len(indexes) // page_size))
+    page = max(1, min(page, pages))
+    start = (page - 1) * page_size
+
+    rows = []
+    for index in indexes[start:start + page_size]:
+        product = products[index]
+        rows.append({
+            'index': index,
+            'data': product['data'],
+            'color': product['data'].get('Цвет', ''),
+            'size': product['data'].get('Размер', ''),
+            'quantity': product['quantity'],
+            'sources': product.get('sources'),
+            'barcode_error': product.get('barcode_error', ''),
+        })
+    return {
+        'rows': rows,
+        'page': page,
+        'pages': pages,
+        'matched': len(indexes),
+        'total': len(products),
+    }
+
+
+def apply_changes(products, changes, size_column):
+    """
+    Применяет изменения редактора к товарам черновика.
+
+    changes - {номер товара: {'color': ..., 'size': ..., 'quantity': ...}}.
+    Значения проверяются формой EditDataForm. Возвращает список ошибок
+    вида "Строка N: ..."; при ошибках товары не изменяются.
+    """
+    cleaned = {}
+    errors = []
+    for key, values in changes.items():
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            errors.append(f"Неверный номер строки: {key}")
+            continue
+        if not 0 <= index < len(products) or not isinstance(values, dict):
+            errors.append(f"Строка {key}: нет такого товара")
+            continue
+
+        form = EditDataForm(values)
+        if not form.is_valid():
+            messages = '; '.join(f"{form.fields[name].label}: {' '.join(errs)}" for name, errs in form.errors.items())
+            errors.append(f"Строка {index + 1}: {messages}")
+            continue
+        cleaned[index] = form.cleaned_data
+
+    if errors:
+        return errors
+
+    for index, values in cleaned.items():
+        product = products[index]
+        product['data']['Цвет'] = values.get('color', '')
+        if size_column:
+            product['data']['Размер'] = values.get('size', '')
+        product['quantity'] = values['quantity']
+    return []
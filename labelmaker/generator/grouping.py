@@ -0,0 +1,139 @@
+"""
+Группировка строк Excel-файла в уникальные товары.
+
+Товар определяется сочетанием артикула, штрих-кода, цвета и размера
+(без учёта регистра и пробелов по краям). Вся обработка выполняется
+средствами pandas, без обхода строк в Python.
+"""
+import numpy as np
+import pandas as pd
+
+from .barcodes import normalize_barcodes
+
+
+def normalize(series):
+    """Приводит колонку к ключу группировки: строка без пробелов по краям, в нижнем регистре"""
+    return series.where(series.notna(), '').astype(str).str.strip().str.lower()
+
+
+def normalized_codes(series, barcode=False):
+    """
+    Коды нормализованных значений колонки и сами нормализованные значения.
+
+    Нормализуются только уникальные значения колонки, поэтому стоимость
+    строковых операций зависит от числа разных значений, а не строк.
+    Пустые ячейки считаются пустой строкой. Для колонки штрих-кода
+    (barcode=True) значения сначала приводятся normalize_barcodes: штрих-код,
+    прочитанный из Excel числом (2000000000026.0), и тот же штрих-код
+    из CSV дают один товар.
+    """
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    if barcode:
+        uniques = normalize_barcodes(uniques)
+    normalized = normalize(uniques)
+    # Последний элемент - значение для пустых ячеек (код -1 у factorize)
+    normalized = pd.concat([normalized, pd.Series([''])], ignore_index=True)
+    codes = np.where(codes < 0, len(uniques), codes)
+
+    norm_codes, norm_uniques = pd.factorize(normalized)
+    return norm_codes[codes], np.asarray(norm_uniques, dtype=object)
+
+
+def group_rows(df, selected_columns, column_mapping):
+    """
+    Группирует строки таблицы (или её части) по товарам.
+
+    Возвращает (keys, products): keys - кортежи нормализованных значений
+    артикула, штрих-кода, цвета и размера, products - список словарей
+    {'data': ..., 'quantity': ...} в порядке первого появления товара.
+    """
+    data = df[selected_columns]
+    size_column = column_mapping.get('size')
+
+    def key_column(column, barcode=False):
+        if column and column in data.columns:
+            return normalized_codes(data[column], barcode)
+        return np.zeros(len(data), dtype=np.intp), np.array([''], dtype=object)
+
+    columns = [
+        key_column(column_mapping['article']),
+        key_column(column_mapping['barcode'], barcode=True),
+        key_column('Цвет'),
+        key_column(size_column),
+    ]
+    keys = pd.DataFrame({name: codes for name, (codes, _) in zip(['article', 'barcode', 'color', 'size'], columns)})
+
+    # Количество строк каждого товара (порядок групп - порядок первого появления)
+    quantities = keys.groupby(list(keys.columns), sort=False).size().tolist()
+
+    # Первая строка каждого товара
+    first_rows = ~keys.duplicated().to_numpy()
+    first_data = data[first_rows]
+    first_data = first_data.astype(object).where(first_data.notna(), '')
+    values = [first_data[column].tolist() for column in selected_columns]
+    records = [dict(zip(selected_columns, row)) for row in zip(*values)]
+
+    size_codes, size_values = columns[3]
+    if size_column:
+        for record, size in zip(records, size_values[size_codes[first_rows]]):
+            record['Размер'] = size
+
+    product_keys = list(zip(*(uniques[codes[first_rows]] for codes, uniques in columns)))
+    products = [
+        {'data': record, 'quantity': quantity}
+        for record, quantity in zip(records, quantities)
+    ]
+    return product_keys, products
+
+
+def group_products(df, selected_columns, column_mapping):
+    """
+    Группирует строки таблицы по товарам.
+
+    Возвращает список словарей {'data': ..., 'quantity': ...} в порядке первого
+    появления товара в файле. data - значения выбранных колонок из первой строки
+    товара (пустые ячейки заменяются на ''), quantity - число строк товара.
+    """
+    return group_rows(df, selected_columns, column_mapping)[1]
+
+
+def merge_groups(parts):
+    """
+    Объединяет сгруппированные части таблиц в один список товаров.
+
+    parts - итератор (source, keys, products), где keys и products - результат
+    group_rows. Количество одинаковых товаров складывается, порядок - порядок
+    первого появления. Если source задан, товар получает сводку
+    product['sources'] = {source: число строк}.
+    """
+    positions = {}
+    merged = []
+    for source, keys, products in parts:
+        for key, product in zip(keys, products):
+            position = positions.get(key)
+            if position is None:
+                positions[key] = len(merged)
+                if source is not None:
+                    product['sources'] = {source: product['quantity']}
+                merged.append(product)
+                continue
+
+            existing = merged[position]
+            existing['quantity'] += product['quantity']
+            if source is not None:
+                existing['sources'][source] = existing['sources'].get(source, 0) + product['quantity']
+    return merged
+
+
+def group_chunks(chunks, selected_columns, column_mapping, source=None):
+    """
+    То же, что group_products, для таблицы, прочитанной по частям.
+
+    Части группируются по отдельности и объединяются по ключу товара,
+    поэтому в памяти находится одна часть и список товаров, а не вся таблица.
+    """
+    return merge_groups(
+        (source, *group_rows(chunk, selected_columns, column_mapping))
+        for chunk in chunks
+    )
@@ -0,0 +1,116 @@
+"""
+Серверное хранилище заданий на генерацию этикеток.
+
+Сгруппированные данные товаров не кладутся в сессию: каждое задание
+хранится отдельным JSON-файлом в media/jobs, а в сессии остаётся только
+идентификатор задания. Старые задания удаляются по истечении JOB_TTL.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Папка с файлами заданий
+JOBS_DIR = os.path.join(settings.MEDIA_ROOT, 'jobs')
+
+
+def _job_path(job_id):
+    # Идентификатор приходит из сессии или URL - допускаем только hex-строки uuid
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _write_job(job_id, job):
+    path = _job_path(job_id)
+    # Своё имя временного файла у каждой записи: задание могут одновременно
+    # обновлять поток запроса и поток фонового пула
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, separators=(',', ':'), default=str)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def create_job(processed_data, is_template_mode, output_format='pdf', from_library=False, session_key=None):
+    """
+    Сохраняет новое задание и возвращает его идентификатор.
+    output_format - формат файла массовой печати (см. tasks.OUTPUT_FORMATS),
+    from_library - брать готовые этикетки из библиотеки шаблонов,
+    session_key - сессия, которой принадлежит задание (см. views.own_job).
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    cleanup_jobs()
+
+    job_id = uuid.uuid4().hex
+    _write_job(job_id, {
+        'processed_data': processed_data,
+        'is_template_mode': is_template_mode,
+        'output_format': output_format,
+        'from_library': from_library,
+        'session': session_key,
+        'created': time.time(),
+    })
+    return job_id
+
+
+def load_job(job_id):
+    """Загружает задание; возвращает None, если задание не найдено или устарело"""
+    path = _job_path(job_id)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка чтения задания {job_id}: {str(e)}")
+        return None
+
+
+def job_exists(job_id):
+    """Есть ли задание в хранилище"""
+    path = _job_path(job_id)
+    return path is not None and os.path.exists(path)
+
+
+def job_stamp(job_id):
+    """Время последнего изменения задания (в наносекундах) или None, если задания нет"""
+    path = _job_path(job_id)
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+def update_job(job_id, **fields):
+    """Обновляет поля существующего задания"""
+    job = load_job(job_id)
+    if job is None:
+        return None
+    job.update(fields)
+    _write_job(job_id, job)
+    return job
+
+
+def cleanup_jobs(ttl=None):
+    """Удаляет задания, которые не изменялись дольше ttl секунд (по умолчанию JOB_TTL)"""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    ttl = settings.JOB_TTL if ttl is None else ttl
+    expire_before = time.time() - ttl
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < expire_before:
+                os.remove(path)
+        except OSError:
+            pass
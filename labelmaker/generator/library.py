@@ -0,0 +1,192 @@
+"""
+Библиотека шаблонов этикеток (media/patterns) с индексом в базе данных.
+
+Для каждого штрих-кода индекс хранит имя файла и хэш данных, из которых
+он нарисован. Генерация одним запросом к индексу находит отсутствующие
+и устаревшие шаблоны и перерисовывает только их.
+
+Вместе с записью хранятся команды отрисовки этикетки: PDF для массовой
+печати собирается из них без повторной вёрстки товаров из библиотеки.
+"""
+import logging
+import os
+import zlib
+
+from .models import TemplateRecord
+from .pages import load_pages, save_pages
+from .rendering import label_hash, template_filename, render_template_files
+
+logger = logging.getLogger(__name__)
+
+# Сколько штрих-кодов запрашивать у SQLite за один раз
+LOOKUP_BATCH = 500
+
+
+def product_barcode(data):
+    """Штрих-код товара в том виде, в котором он печатается на этикетке"""
+    return str(data.get('Баркод', 'N/A')).strip()
+
+
+def lookup_records(barcodes):
+    """Записи индекса для списка штрих-кодов: {barcode: TemplateRecord} (без команд отрисовки)"""
+    barcodes = list(barcodes)
+    records = {}
+    for start in range(0, len(barcodes), LOOKUP_BATCH):
+        batch = barcodes[start:start + LOOKUP_BATCH]
+        for record in TemplateRecord.objects.filter(barcode__in=batch).defer('content'):
+            records[record.barcode] = record
+    return records
+
+
+def load_contents(barcodes):
+    """Команды отрисовки этикеток из индекса: {input_hash: str}"""
+    barcodes = list(barcodes)
+    contents = {}
+    for start in range(0, len(barcodes), LOOKUP_BATCH):
+        batch = barcodes[start:start + LOOKUP_BATCH]
+        rows = TemplateRecord.objects.filter(barcode__in=batch, content__isnull=False)
+        for input_hash, content in rows.values_list('input_hash', 'content'):
+            contents[input_hash] = zlib.decompress(content).decode('utf-8')
+    return contents
+
+
+def plan_templates(processed_data, company, templates_dir):
+    """
+    Сравнивает товары задания с индексом библиотеки.
+
+    Возвращает (entries, skipped): entries - список словарей с данными товара,
+    путём к файлу, хэшем и признаком, что файл нужно (пере)рисовать;
+    skipped - число повторов штрих-кода внутри задания.
+    """
+    records = lookup_records({product_barcode(product['data']) for product in processed_data})
+
+    entries = []
+    seen = set()
+    skipped = 0
+    for product in processed_data:
+        data = product['data']
+        barcode = product_barcode(data)
+        # Один шаблон на штрих-код: повторы внутри задания пропускаем
+        if barcode in seen:
+            skipped += 1
+            continue
+        seen.add(barcode)
+
+        input_hash = label_hash(data, company)
+        filename = template_filename(data)
+        record = records.get(barcode)
+        fresh = (
+            record is not None
+            and record.input_hash == input_hash
+            and os.path.exists(os.path.join(templates_dir, record.filename))
+        )
+        entries.append({
+            'product': product,
+            'barcode': barcode,
+            'hash': input_hash,
+            'filename': record.filename if fresh else filename,
+            'record': record,
+            'render': not fresh,
+        })
+    return entries, skipped
+
+
+def save_records(entries, templates_dir):
+    """Записывает в индекс перерисованные шаблоны и удаляет их устаревшие файлы"""
+    records = [
+        TemplateRecord(
+            barcode=entry['barcode'],
+            filename=entry['filename'],
+            input_hash=entry['hash'],
+            content=zlib.compress(entry['content'].encode('utf-8')) if entry['content'] else None,
+        )
+        for entry in entries
+    ]
+    TemplateRecord.objects.bulk_create(
+        records,
+        update_conflicts=True,
+        unique_fields=['barcode'],
+        update_fields=['filename', 'input_hash', 'content', 'updated'],
+    )
+
+    # Файл прежней версии шаблона с другим именем больше не нужен
+    for entry in entries:
+        old = entry['record']
+        if old is not None and old.filename != entry['filename']:
+            try:
+                os.remove(os.path.join(templates_dir, old.filename))
+            except OSError:
+                pass
+
+
+def sync_templates(processed_data, company, templates_dir, workers=None, threshold=0, progress=None):
+    """
+    Приводит библиотеку шаблонов в соответствие с товарами задания.
+
+    Отсутствующие шаблоны создаются, устаревшие (изменились данные товара,
+    юрлицо или вёрстка) перерисовываются, актуальные пропускаются.
+    Этикетки из кэша отрисованных этикеток (pages.py) не вёрстаются заново.
+    Возвращает отчёт created/updated/skipped/failed со списком ошибок
+    и список entries (см. plan_templates) с итоговыми путями к файлам.
+    """
+    os.makedirs(templates_dir, exist_ok=True)
+    entries, skipped = plan_templates(processed_data, company, templates_dir)
+
+    report = {'created': 0, 'updated': 0, 'skipped': skipped, 'failed': 0, 'errors': []}
+    pending = [entry for entry in entries if entry['render']]
+    report['skipped'] += len(entries) - len(pending)
+
+    if progress and report['skipped']:
+        progress(report['skipped'])
+
+    # Этикетки, уже отрисованные ранее (в том числе при массовой печати), не вёрстаются заново
+    cached = load_pages(entry['hash'] for entry in pending)
+    tasks = [
+        (entry['product']['data'], company, os.path.join(templates_dir, entry['filename']), cached.get(entry['hash']))
+        for entry in pending
+    ]
+    results = render_template_files(tasks, workers, threshold, progress)
+
+    rendered = []
+    new_pages = {}
+    for entry, (filepath, error, content) in zip(pending, results):
+        entry['content'] = content
+        if content is not None and entry['hash'] not in cached:
+            new_pages[entry['hash']] = content
+        if error is not None:
+            report['failed'] += 1
+            report['errors'].append((os.path.basename(filepath), error))
+            entry['filename'] = None
+            continue
+        rendered.append(entry)
+        # Шаблон уже был в индексе, но устарел - обновление
+        if entry['record'] is not None:
+            report['updated'] += 1
+        else:
+            report['created'] += 1
+
+    save_records(rendered, templates_dir)
+    save_pages(new_pages)
+    return report, entries
+
+
+def prepare_bulk(processed_data, company, templates_dir):
+    """
+    Команды отрисовки этикеток из библиотеки для сборки PDF массовой печати.
+
+    Библиотека только читается: берутся записи, хэш которых совпадает с
+    данными товара и файл которых существует. Возвращает (found, contents):
+    число найденных товаров и {label_hash: str} для render_bulk_pdf.
+    Остальные этикетки (нет в библиотеке, изменены на странице
+    редактирования, символы вне FONT_CHARSET) берутся из кэша отрисованных
+    этикеток или вёрстаются заново - шаблоны в библиотеке при этом
+    не создаются и не перезаписываются.
+    """
+    products = [product for product in processed_data if product['quantity'] > 0]
+    entries, _ = plan_templates(products, company, templates_dir)
+    fresh = [entry for entry in entries if not entry['render']]
+    contents = load_contents(entry['barcode'] for entry in fresh)
+    # Запись индекса по штрих-коду может относиться к другому варианту товара
+    hashes = {entry['hash'] for entry in fresh}
+    contents = {key: value for key, value in contents.items() if key in hashes}
+    return len(fresh), contents
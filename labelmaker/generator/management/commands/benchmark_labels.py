@@ -0,0 +1,330 @@
+"""
+Замеры производительности генерации этикеток на синтетических выгрузках WB.
+
+Для каждого сочетания числа строк и профиля товаров команда создаёт
+xlsx-файл в формате "Листа сборки" и по отдельности замеряет этапы:
+чтение таблицы (pd.read_excel), группировку товаров (как в edit_data),
+массовую печать и создание шаблонов. По каждому этапу записываются время,
+пиковая память (основной процесс вместе с рабочими процессами) и размер
+результата. Отчёт сохраняется в JSON для сравнения между коммитами:
+
+    python manage.py benchmark_labels --rows 1000 10000 --output before.json
+    python manage.py benchmark_labels --rows 1000 10000 --compare before.json
+
+Этапы выполняются во временной папке шаблонов и в транзакции, которая
+откатывается, поэтому библиотека шаблонов и её индекс не изменяются.
+"""
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from generator.grouping import group_products
+from generator.tasks import OUTPUT_FORMATS, build_bulk, build_templates
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Профили выгрузки: число разных товаров в зависимости от числа строк
+PROFILES = {
+    'few': lambda rows: min(rows, 50),         # Крупные поставки немногих товаров
+    'typical': lambda rows: max(rows // 10, 1),  # В среднем 10 строк на товар
+    'unique': lambda rows: rows,               # Каждая строка - отдельный товар
+}
+
+STAGES = ['read_excel', 'group_products', 'generate_bulk_labels', 'generate_templates']
+
+# Строка заголовков синтетического файла (над ней - шапка, как в выгрузке WB)
+HEADER_ROW = 4
+
+SELECTED_COLUMNS = ['Баркод', 'Наименование', 'Артикул', 'Цвет', 'Размер']
+COLUMN_MAPPING = {'barcode': 'Баркод', 'product_name': 'Наименование', 'article': 'Артикул', 'size': 'Размер'}
+
+COMPANY = 'ООО "Тестовое юрлицо"'
+
+# Интервал опроса памяти процессов (секунды)
+MEMORY_POLL_INTERVAL = 0.02
+
+
+def synthetic_workbook(path, rows, products, seed=0):
+    """
+    Создаёт xlsx-файл "Листа сборки" с rows строками и products разными товарами.
+
+    Цвета встречаются в разном регистре и с пробелами по краям, часть ячеек
+    пустая - как в реальных выгрузках.
+    """
+    rng = np.random.default_rng(seed)
+    # Каждый товар встречается хотя бы раз, строки перемешаны
+    index = rng.permutation(np.arange(rows) % products)
+    colors = np.array(['Белый', 'белый ', 'Чёрный', 'синий', None], dtype=object)
+    sizes = np.array(['XS', 'S', 'M', 'L', 'XL', '42-44', '46-48'], dtype=object)
+    names = np.array([
+        'Футболка хлопковая', 'Перчатки трикотажные', 'Носки спортивные', 'Платье летнее',
+        'Куртка демисезонная утеплённая с капюшоном и карманами на молнии',
+    ], dtype=object)
+
+    df = pd.DataFrame({
+        '№ задания': np.arange(1, rows + 1),
+        'Стикер': rng.integers(10 ** 9, 10 ** 10, rows),
+        'Наименование': names[index % len(names)] + ' арт. ' + index.astype(str),
+        'Артикул': 'WB-' + index.astype(str),
+        'Баркод': 2040000000000 + index,
+        'Цвет': colors[index % len(colors)],
+        'Размер': sizes[index % len(sizes)],
+        'Бренд': 'Бренд',
+    })
+
+    tmp_path = f"{path}.tmp.xlsx"
+    with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+        header = pd.DataFrame([['Лист сборки'], ['Поставка WB-0000000']])
+        header.to_excel(writer, index=False, header=False, startrow=0)
+        df.to_excel(writer, index=False, startrow=HEADER_ROW)
+    os.replace(tmp_path, path)
+
+
+class PeakMemory:
+    """Пиковая память (RSS) процесса и его дочерних процессов за время блока with"""
+
+    def __init__(self):
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        process = psutil.Process()
+        total = 0
+        for proc in [process] + process.children(recursive=True):
+            try:
+                total += proc.memory_info().rss
+            except psutil.Error:
+                pass  # Рабочий процесс завершился между опросами
+        self.peak = max(self.peak or 0, total)
+
+    def _poll(self):
+        while not self._stop.wait(MEMORY_POLL_INTERVAL):
+            self._sample()
+
+    def __enter__(self):
+        if psutil is not None:
+            self._sample()
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / 1024 / 1024, 1) if self.peak is not None else None
+
+
+def directory_size(path):
+    """Суммарный размер файлов в папке"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def git_commit():
+    """Текущий коммит репозитория (None, если git недоступен)"""
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=10,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = 'Замеры производительности генерации этикеток на синтетических Excel-файлах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Число строк в файлах (по умолчанию 1000 10000 100000)')
+        parser.add_argument('--profiles', nargs='+', choices=list(PROFILES), default=list(PROFILES),
+                            help='Профили числа разных товаров')
+        parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                            help='Замеряемые этапы')
+        parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='pdf',
+                            help='Формат файла массовой печати')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора данных')
+        parser.add_argument('--data-dir', default=os.path.join(settings.MEDIA_ROOT, 'benchmark'),
+                            help='Папка для синтетических файлов (создаются один раз и переиспользуются)')
+        parser.add_argument('--output', default='benchmark.json', help='Файл отчёта JSON')
+        parser.add_argument('--compare', help='Отчёт предыдущего запуска для сравнения')
+
+    def handle(self, *args, **options):
+        if psutil is None:
+            self.stderr.write('psutil не установлен: пиковая память не замеряется')
+
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Ошибка чтения отчёта {options['compare']}: {str(e)}")
+
+        os.makedirs(options['data_dir'], exist_ok=True)
+        report = {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'settings': {
+                'format': options['format'],
+                'LABEL_WORKERS': settings.LABEL_WORKERS,
+                'LABEL_PARALLEL_THRESHOLD': settings.LABEL_PARALLEL_THRESHOLD,
+                'LABEL_SHARD_THRESHOLD': settings.LABEL_SHARD_THRESHOLD,
+                'LABEL_BULK_FROM_LIBRARY': settings.LABEL_BULK_FROM_LIBRARY,
+                'LABEL_PRINTER_DPI': settings.LABEL_PRINTER_DPI,
+            },
+            'cases': [],
+        }
+
+        started = time.perf_counter()
+        for rows in options['rows']:
+            for profile in options['profiles']:
+                case = self.run_case(rows, profile, options)
+                report['cases'].append(case)
+                self.print_case(case, baseline)
+        report['wall_s'] = round(time.perf_counter() - started, 3)
+
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Отчёт сохранён: {options['output']} ({report['wall_s']} с)"))
+
+    # ===========================================================
+    # ЭТАПЫ
+    # ===========================================================
+
+    def measure(self, func):
+        """Выполняет func() и возвращает (результат, {'wall_s', 'peak_rss_mb'})"""
+        gc.collect()
+        with PeakMemory() as memory:
+            started = time.perf_counter()
+            result = func()
+            wall = time.perf_counter() - started
+        return result, {'wall_s': round(wall, 3), 'peak_rss_mb': memory.peak_mb}
+
+    def run_case(self, rows, profile, options):
+        products = PROFILES[profile](rows)
+        path = os.path.join(options['data_dir'], f"wb_{rows}_{profile}_{options['seed']}.xlsx")
+        if not os.path.exists(path):
+            self.stdout.write(f"Создание {os.path.basename(path)}...")
+            synthetic_workbook(path, rows, products, options['seed'])
+
+        case = {
+            'rows': rows,
+            'profile': profile,
+            'input_bytes': os.path.getsize(path),
+            'stages': {},
+        }
+        stages = options['stages']
+        started = time.perf_counter()
+
+        # Чтение и группировка нужны остальным этапам, даже если не замеряются
+        df, stats = self.measure(lambda: pd.read_excel(path, header=HEADER_ROW))
+        if 'read_excel' in stages:
+            case['stages']['read_excel'] = stats
+
+        grouped, stats = self.measure(lambda: group_products(df, SELECTED_COLUMNS, COLUMN_MAPPING))
+        if 'group_products' in stages:
+            case['stages']['group_products'] = stats
+        del df
+
+        # По 2 этикетки на товар - как в edit_data для массовой печати
+        bulk_data = [{'data': item['data'], 'quantity': item['quantity'] * 2} for item in grouped]
+        template_data = [{'data': item['data'], 'quantity': 1} for item in grouped]
+        case['products'] = len(grouped)
+        case['labels'] = sum(item['quantity'] for item in bulk_data)
+
+        work_dir = tempfile.mkdtemp(prefix='run_', dir=options['data_dir'])
+        try:
+            if 'generate_bulk_labels' in stages:
+                case['stages']['generate_bulk_labels'] = self.run_bulk(bulk_data, options['format'], work_dir)
+            if 'generate_templates' in stages:
+                case['stages']['generate_templates'] = self.run_templates(template_data, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        case['wall_s'] = round(time.perf_counter() - started, 3)
+        return case
+
+    def run_bulk(self, processed_data, output_format, work_dir):
+        output = os.path.join(work_dir, OUTPUT_FORMATS[output_format][0])
+        templates_dir = os.path.join(work_dir, 'bulk_patterns')
+
+        def generate():
+            with transaction.atomic():
+                with open(output, 'wb') as f:
+                    build_bulk(processed_data, COMPANY, f, output_format, templates_dir=templates_dir)
+                transaction.set_rollback(True)
+
+        _, stats = self.measure(generate)
+        stats['output_bytes'] = os.path.getsize(output)
+        return stats
+
+    def run_templates(self, processed_data, work_dir):
+        templates_dir = os.path.join(work_dir, 'patterns')
+
+        def generate():
+            with transaction.atomic():
+                report = build_templates(processed_data, COMPANY, templates_dir=templates_dir)
+                transaction.set_rollback(True)
+            return report
+
+        report, stats = self.measure(generate)
+        stats['output_bytes'] = directory_size(templates_dir)
+        stats['files'] = report['created'] + report['updated']
+        stats['failed'] = report['failed']
+        return stats
+
+    # ===========================================================
+    # ВЫВОД
+    # ===========================================================
+
+    def print_case(self, case, baseline):
+        self.stdout.write(
+            f"{case['rows']} строк, профиль {case['profile']}: "
+            f"товаров {case['products']}, этикеток {case['labels']}"
+        )
+        previous = {}
+        if baseline:
+            for old_case in baseline.get('cases', []):
+                if old_case['rows'] == case['rows'] and old_case['profile'] == case['profile']:
+                    previous = old_case['stages']
+
+        for stage, stats in case['stages'].items():
+            line = f"  {stage:<22} {stats['wall_s']:>9.3f} с"
+            if stats['peak_rss_mb'] is not None:
+                line += f"  {stats['peak_rss_mb']:>8.1f} МБ"
+            if 'output_bytes' in stats:
+                line += f"  {stats['output_bytes'] / 1024 / 1024:>8.1f} МБ на выходе"
+            old = previous.get(stage)
+            if old and old['wall_s']:
+                line += f"  (было {old['wall_s']:.3f} с, x{stats['wall_s'] / old['wall_s']:.2f})"
+            self.stdout.write(line)
@@ -0,0 +1,192 @@
+"""
+Генерация этикеток из Excel-файлов и выгрузок CSV/TSV без веб-интерфейса.
+
+Выполняет те же шаги, что и мастер (чтение таблицы, группировка товаров,
+массовая печать или библиотека шаблонов), за один проход и без сессии:
+
+    python manage.py generate_labels orders.xlsx --header-row 5
+    python manage.py generate_labels *.xlsx --format zpl --output-dir out/ --skip-invalid
+    python manage.py generate_labels catalog.xlsx --mode templates --entity 'ООО "Ромашка"'
+    python manage.py generate_labels orders.xlsx --from-library
+
+Колонки, указанные в --barcode/--name/--article/--size, на этикетке
+используются как "Баркод", "Наименование", "Артикул" и "Размер".
+Штрих-коды проверяются так же, как на странице редактирования: файл с
+неверными штрих-кодами не обрабатывается, если не указан --skip-invalid.
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generator.barcodes import check_products
+from generator.tasks import OUTPUT_FORMATS, TEMPLATES_DIR, build_bulk, build_templates, count_labels
+from generator.utils import get_legal_entities
+from generator.workbook import read_products, preview_rows, preview_workbook, guess_header_row
+
+# Колонки, выбранные в мастере по умолчанию
+DEFAULT_COLUMNS = ['Баркод', 'Наименование', 'Артикул', 'Цвет']
+
+# Сколько неверных штрих-кодов показывать в сообщении
+INVALID_EXAMPLES = 5
+
+
+class Command(BaseCommand):
+    help = 'Генерация этикеток (массовая печать или шаблоны) из Excel-файлов и CSV/TSV без веб-интерфейса'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Excel-файлы (xlsx) или выгрузки CSV/TSV')
+        parser.add_argument('--header-row', type=int,
+                            help='Номер строки с заголовками, начиная с 1 (по умолчанию определяется по файлу)')
+        parser.add_argument('--barcode', default='Баркод', help='Колонка со штрих-кодом')
+        parser.add_argument('--name', default='Наименование', help='Колонка с названием товара')
+        parser.add_argument('--article', default='Артикул', help='Колонка с артикулом')
+        parser.add_argument('--size', help='Колонка с размером (по умолчанию не используется)')
+        parser.add_argument('--columns', nargs='+',
+                            help='Дополнительные колонки для этикетки (по умолчанию "Цвет", если она есть)')
+        parser.add_argument('--mode', choices=['bulk', 'templates'], default='bulk',
+                            help='Массовая печать или библиотека шаблонов')
+        parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='pdf',
+                            help='Формат файла массовой печати')
+        parser.add_argument('--copies', type=int, default=2,
+                            help='Этикеток на каждую строку товара при массовой печати (по умолчанию 2)')
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help='Пропускать товары с неверным штрих-кодом (по умолчанию файл не обрабатывается)')
+        parser.add_argument('--entity', help='Юрлицо на этикетке (по умолчанию текущее из настроек)')
+        parser.add_argument('--output-dir',
+                            help='Папка для файлов массовой печати (по умолчанию рядом с исходным файлом)')
+        parser.add_argument('--templates-dir', default=TEMPLATES_DIR, help='Папка библиотеки шаблонов')
+        parser.add_argument('--from-library', action='store_true', default=None,
+                            help='Брать готовые этикетки PDF из библиотеки шаблонов '
+                                 '(по умолчанию по настройке LABEL_BULK_FROM_LIBRARY)')
+
+    def handle(self, *args, **options):
+        if options['copies'] < 1:
+            raise CommandError('--copies должно быть не меньше 1')
+        for path in options['files']:
+            if not os.path.isfile(path):
+                raise CommandError(f"Файл не найден: {path}")
+
+        company = options['entity'] or get_legal_entities()['current']
+        if options['output_dir']:
+            os.makedirs(options['output_dir'], exist_ok=True)
+
+        failed = 0
+        for path in options['files']:
+            started = time.perf_counter()
+            try:
+                summary = self.process(path, company, options)
+            except CommandError as e:
+                failed += 1
+                self.stderr.write(f"{path}: {e}")
+                continue
+            except Exception as e:
+                # Повреждённый или неподдерживаемый файл не прерывает обработку остальных
+                failed += 1
+                self.stderr.write(f"{path}: ошибка обработки: {str(e)}")
+                continue
+            self.stdout.write(self.style.SUCCESS(f"{path}: {summary} ({time.perf_counter() - started:.1f} с)"))
+
+        if failed:
+            raise CommandError(f"Не обработано файлов: {failed} из {len(options['files'])}")
+
+    def read_products(self, path, options):
+        """Читает файл и группирует строки в товары (как edit_data)"""
+        header_row = options['header_row']
+        if header_row is None:
+            header_row = guess_header_row(preview_rows(path))
+            if header_row is None:
+                raise CommandError('Не удалось определить строку заголовков, укажите --header-row')
+        else:
+            header_row -= 1
+
+        # Колонки из сопоставления получают имена, под которыми их печатает этикетка
+        mapping = {
+            options['barcode']: 'Баркод',
+            options['name']: 'Наименование',
+            options['article']: 'Артикул',
+        }
+        if options['size']:
+            mapping[options['size']] = 'Размер'
+        columns = preview_workbook(path, header_row, nrows=0)[0]
+        missing = [column for column in list(mapping) + (options['columns'] or []) if column not in columns]
+        if missing:
+            raise CommandError(f"Нет колонок: {', '.join(map(str, missing))} (строка заголовков {header_row + 1})")
+
+        # Одноимённые колонки, которые заменяет сопоставление, не используются
+        replaced = {target for source, target in mapping.items() if source != target}
+        extra = options['columns'] if options['columns'] is not None else [
+            column for column in DEFAULT_COLUMNS if column in columns
+        ]
+        selected_columns = list(dict.fromkeys(list(mapping) + [column for column in extra if column not in replaced]))
+        column_mapping = {
+            'barcode': options['barcode'],
+            'product_name': options['name'],
+            'article': options['article'],
+            'size': options['size'] or '',
+        }
+
+        # Чтение через кэш разобранных таблиц (xlsx) или частями (CSV/TSV)
+        products = read_products(path, header_row, selected_columns, column_mapping)
+        for product in products:
+            data = product['data']
+            for source, target in mapping.items():
+                if source == target:
+                    continue
+                value = data.pop(source)
+                # Размер уже записан group_rows в нормализованном виде
+                if target != 'Размер':
+                    data[target] = value
+        return products
+
+    def check_barcodes(self, path, products, options):
+        """Проверяет штрих-коды (как edit_data); возвращает товары без неверных"""
+        invalid = check_products(products, 'Баркод')
+        if not invalid:
+            return products
+
+        bad = [product for product in products if product.get('barcode_error')]
+        examples = '; '.join(
+            f"{product['data'].get('Баркод') or '(пусто)'}: {product['barcode_error']}"
+            for product in bad[:INVALID_EXAMPLES]
+        )
+        if not options['skip_invalid']:
+            raise CommandError(f"Неверных штрих-кодов: {invalid} ({examples}); используйте --skip-invalid, чтобы пропустить их")
+        self.stderr.write(f"{path}: пропущено товаров с неверным штрих-кодом: {invalid} ({examples})")
+        return [product for product in products if not product.get('barcode_error')]
+
+    def process(self, path, company, options):
+        """Обрабатывает один файл и возвращает строку с итогом"""
+        products = self.check_barcodes(path, self.read_products(path, options), options)
+
+        if options['mode'] == 'templates':
+            for product in products:
+                product['quantity'] = 1
+            report = build_templates(products, company, templates_dir=options['templates_dir'])
+            for filename, error in report['errors']:
+                self.stderr.write(f"Ошибка генерации шаблона {filename}: {error}")
+            return (
+                f"шаблонов создано {report['created']}, обновлено {report['updated']}, "
+                f"актуальных {report['skipped']}, ошибок {report['failed']}"
+            )
+
+        for product in products:
+            product['quantity'] *= options['copies']
+
+        output_format = options['format']
+        extension = os.path.splitext(OUTPUT_FORMATS[output_format][0])[1]
+        output_dir = options['output_dir'] or os.path.dirname(os.path.abspath(path))
+        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + extension)
+
+        tmp_path = f"{output_path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                build_bulk(products, company, f, output_format, templates_dir=options['templates_dir'],
+                           from_library=options['from_library'])
+            os.replace(tmp_path, output_path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise CommandError(f"Ошибка генерации: {str(e)}")
+
+        return f"товаров {len(products)}, этикеток {count_labels(products)} -> {output_path}"
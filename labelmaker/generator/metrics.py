@@ -0,0 +1,165 @@
+"""
+Метрики этапов обработки: длительность, число строк/товаров/этикеток и объём данных.
+
+Замеры копятся в памяти процесса и отдаются эндпоинтом /metrics/
+в текстовом формате Prometheus. Каждый этап дополнительно пишется
+в лог одной строкой. Модуль не зависит от Django.
+
+    with stage('grouping', rows=len(df)) as s:
+        grouped = group_products(...)
+        s.record(products=len(grouped))
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1 КБ ... 1 ГБ
+
+_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счётчик с метками"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами и метками"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # labels -> (число значений по корзинам, сумма)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [('le', _format_number(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    'labelmaker_stage_duration_seconds', 'Длительность этапа обработки', ('stage',), DURATION_BUCKETS
+)
+STAGE_BYTES = Histogram(
+    'labelmaker_stage_bytes', 'Объём данных этапа (загруженный или сформированный файл)', ('stage',), BYTES_BUCKETS
+)
+STAGE_ITEMS = Counter(
+    'labelmaker_stage_items_total', 'Обработано строк, товаров и этикеток', ('stage', 'kind')
+)
+STAGE_ERRORS = Counter(
+    'labelmaker_stage_errors_total', 'Этапы, завершившиеся ошибкой', ('stage',)
+)
+
+REGISTRY = [STAGE_DURATION, STAGE_BYTES, STAGE_ITEMS, STAGE_ERRORS]
+
+
+class StageRecord:
+    """Счётчики замеряемого этапа: строки, товары, этикетки, байты..."""
+
+    def __init__(self, **counts):
+        self.counts = {}
+        self.record(**counts)
+
+    def record(self, **counts):
+        self.counts.update((kind, value) for kind, value in counts.items() if value is not None)
+
+
+@contextmanager
+def stage(name, **counts):
+    """
+    Замер этапа name: длительность, счётчики и строка в логе.
+
+    Счётчики (rows, products, labels, templates...) передаются при вызове
+    или через record(); значение bytes попадает в гистограмму объёма данных.
+    """
+    current = StageRecord(**counts)
+    failed = False
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.observe(duration, stage=name)
+        if failed:
+            STAGE_ERRORS.inc(stage=name)
+
+        for kind, value in current.counts.items():
+            if kind == 'bytes':
+                STAGE_BYTES.observe(value, stage=name)
+            else:
+                STAGE_ITEMS.inc(value, stage=name, kind=kind)
+
+        details = ''.join(f", {kind}={value}" for kind, value in current.counts.items())
+        status = ' (ошибка)' if failed else ''
+        logger.info(f"Этап {name}{status}: {duration:.3f} с{details}")
+
+
+def exposition():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.exposition())
+    return '\n'.join(lines) + '\n'
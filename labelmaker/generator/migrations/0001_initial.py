@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(max_length=128, unique=True, verbose_name='Штрих-код')),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('input_hash', models.CharField(max_length=64, verbose_name='Хэш данных этикетки')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Обновлён')),
+            ],
+            options={
+                'verbose_name': 'Шаблон этикетки',
+                'verbose_name_plural': 'Шаблоны этикеток',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='templaterecord',
+            name='content',
+            field=models.BinaryField(null=True, verbose_name='Команды отрисовки'),
+        ),
+    ]
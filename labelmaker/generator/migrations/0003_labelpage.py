@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 04:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0002_templaterecord_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelPage',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Хэш данных этикетки')),
+                ('content', models.BinaryField(verbose_name='Команды отрисовки')),
+                ('size', models.PositiveIntegerField(verbose_name='Размер')),
+                ('used', models.DateTimeField(db_index=True, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Отрисованная этикетка',
+                'verbose_name_plural': 'Отрисованные этикетки',
+            },
+        ),
+    ]
@@ -1,3 +1,41 @@
 from django.db import models
 
-# Create your models here.
+
+class TemplateRecord(models.Model):
+    """
+    Запись индекса библиотеки шаблонов (media/patterns).
+    По хэшу данных этикетки определяется, устарел ли готовый файл.
+    """
+    barcode = models.CharField('Штрих-код', max_length=128, unique=True)
+    filename = models.CharField('Имя файла', max_length=255)
+    input_hash = models.CharField('Хэш данных этикетки', max_length=64)
+    # Сжатые команды отрисовки этикетки для сборки PDF массовой печати без вёрстки
+    content = models.BinaryField('Команды отрисовки', null=True, editable=False)
+    updated = models.DateTimeField('Обновлён', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Шаблон этикетки'
+        verbose_name_plural = 'Шаблоны этикеток'
+
+    def __str__(self):
+        return f"{self.barcode} ({self.filename})"
+
+
+class LabelPage(models.Model):
+    """
+    Кэш отрисованных этикеток: команды отрисовки страницы по хэшу данных
+    этикетки (label_hash). Давно не использованные записи вытесняются,
+    когда кэш превышает LABEL_PAGE_CACHE_MAX_BYTES.
+    """
+    key = models.CharField('Хэш данных этикетки', max_length=64, primary_key=True)
+    # Сжатые команды отрисовки (см. draw_portable_label)
+    content = models.BinaryField('Команды отрисовки', editable=False)
+    size = models.PositiveIntegerField('Размер')
+    used = models.DateTimeField('Последнее использование', db_index=True)
+
+    class Meta:
+        verbose_name = 'Отрисованная этикетка'
+        verbose_name_plural = 'Отрисованные этикетки'
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,72 @@
+"""
+Постоянный кэш отрисованных этикеток с адресацией по содержимому.
+
+Ключ записи - label_hash: хэш штрих-кода, названия, артикула, размера,
+цвета, юрлица и отпечатка вёрстки (включая версию reportlab и файл шрифта,
+см. layout_fingerprint). Значение - команды отрисовки страницы
+(draw_portable_label), которые вставляются в PDF без повторной вёрстки.
+При повторной генерации после правки количества или цвета заново
+рисуются только изменившиеся этикетки. Размер кэша ограничен
+LABEL_PAGE_CACHE_MAX_BYTES, вытесняются давно не использованные записи.
+"""
+import logging
+import zlib
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import LabelPage
+
+logger = logging.getLogger(__name__)
+
+# Сколько ключей запрашивать у SQLite за один раз
+LOOKUP_BATCH = 500
+
+
+def load_pages(keys):
+    """Команды отрисовки этикеток из кэша: {key: str}. Найденные записи отмечаются использованными"""
+    keys = list(dict.fromkeys(keys))
+    pages = {}
+    now = timezone.now()
+    for start in range(0, len(keys), LOOKUP_BATCH):
+        batch = keys[start:start + LOOKUP_BATCH]
+        found = []
+        for key, content in LabelPage.objects.filter(key__in=batch).values_list('key', 'content'):
+            pages[key] = zlib.decompress(content).decode('utf-8')
+            found.append(key)
+        if found:
+            LabelPage.objects.filter(key__in=found).update(used=now)
+    return pages
+
+
+def save_pages(contents):
+    """Добавляет в кэш команды отрисовки {key: str} и вытесняет старые записи"""
+    if not contents:
+        return
+    now = timezone.now()
+    records = []
+    for key, content in contents.items():
+        data = zlib.compress(content.encode('utf-8'))
+        records.append(LabelPage(key=key, content=data, size=len(data), used=now))
+    LabelPage.objects.bulk_create(records, batch_size=LOOKUP_BATCH, ignore_conflicts=True)
+    evict_pages()
+
+
+def evict_pages(max_bytes=None):
+    """Удаляет давно не использованные записи, пока кэш больше max_bytes"""
+    if max_bytes is None:
+        max_bytes = settings.LABEL_PAGE_CACHE_MAX_BYTES
+    total = LabelPage.objects.aggregate(total=Sum('size'))['total'] or 0
+    if total <= max_bytes:
+        return
+
+    stale = []
+    for key, size in LabelPage.objects.order_by('used').values_list('key', 'size').iterator():
+        if total <= max_bytes:
+            break
+        stale.append(key)
+        total -= size
+    for start in range(0, len(stale), LOOKUP_BATCH):
+        LabelPage.objects.filter(key__in=stale[start:start + LOOKUP_BATCH]).delete()
+    logger.info(f"Кэш этикеток: вытеснено записей {len(stale)}")
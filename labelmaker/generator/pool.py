@@ -0,0 +1,51 @@
+"""
+Общий пул процессов для генерации этикеток и разбора Excel-файлов.
+
+Пул создаётся при первом обращении и живёт до завершения процесса сервера:
+запросы не запускают процессы заново и не импортируют в каждом из них
+reportlab и pandas. Процессы запускаются методом spawn - fork сервера,
+в котором работают потоки фоновых заданий, небезопасен. Точка входа
+(manage.py) вызывает multiprocessing.freeze_support().
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Верхняя граница числа процессов пула (при None в настройках - по числу ядер)
+MAX_WORKERS = 8
+
+_pool = None
+_pool_size = 0
+_lock = threading.Lock()
+
+
+def pool_size(workers=None):
+    """Число процессов пула: workers (None - по числу ядер), не больше MAX_WORKERS"""
+    return max(1, min(workers or os.cpu_count() or 1, MAX_WORKERS))
+
+
+def get_pool(workers=None):
+    """
+    Общий пул из pool_size(workers) процессов.
+    Пул другого размера (изменились настройки) заменяется новым;
+    уже поставленные в старый пул задачи при этом доделываются.
+    """
+    global _pool, _pool_size
+    size = pool_size(workers)
+    with _lock:
+        if _pool is None or _pool_size != size:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('spawn'))
+            _pool_size = size
+        return _pool
+
+
+def reset_pool(pool):
+    """Сбрасывает сломанный пул (BrokenProcessPool): следующий вызов get_pool создаст новый"""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,294 @@
+"""
+Растровый вывод этикеток (многостраничный TIFF или набор PNG) для станций,
+которые принимают только изображения с разрешением принтера.
+
+Этикетка рисуется в массив NumPy в пикселях устройства: штрихи штрих-кода
+имеют ширину в целое число точек, символы текста растеризуются Pillow один
+раз на размер шрифта и затем только копируются. Изображение строится один
+раз на товар и повторяется для копий. Вёрстка и переносы строк совпадают
+с PDF-этикеткой (rendering.py). Модуль не зависит от Django.
+"""
+import io
+import struct
+import zipfile
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from reportlab.pdfbase import pdfmetrics
+from reportlab.platypus import Paragraph
+
+from .rendering import (
+    PAGE_WIDTH, PAGE_HEIGHT, MARGIN,
+    BARCODE_HEIGHT, BARCODE_BAR_WIDTH, BARCODE_TEXT_SIZE, BARCODE_TOP_MARGIN,
+    BARCODE_TEXT_OFFSET, AFTER_BARCODE_SPACE,
+    register_fonts, build_styles, encode_barcode, label_elements, to_dots, paragraph_lines,
+)
+
+# Разрешение по умолчанию (точек на дюйм)
+DEFAULT_DPI = 203
+
+
+# ===========================================================
+# ШТРИХ-КОД И ТЕКСТ
+# ===========================================================
+
+def barcode_row(value, module):
+    """
+    Строка пикселей штрих-кода (0 - штрих, 255 - фон) без зон тишины.
+    Каждый модуль занимает ровно module точек.
+    """
+    bars = encode_barcode(value, BARCODE_HEIGHT, BARCODE_BAR_WIDTH).bars
+    if not bars:
+        return np.full(0, 255, dtype=np.uint8)
+    offsets = np.array(bars, dtype=float)
+    # Положение и ширина штрихов в модулях (в reportlab они кратны ширине модуля)
+    left = np.rint((offsets[:, 0] - offsets[0, 0]) / BARCODE_BAR_WIDTH).astype(int)
+    width = np.rint(offsets[:, 1] / BARCODE_BAR_WIDTH).astype(int)
+
+    pattern = np.full(left[-1] + width[-1], 255, dtype=np.uint8)
+    for start, size in zip(left, width):
+        pattern[start:start + size] = 0
+    # Каждый модуль - ровно module одинаковых пикселей
+    return np.repeat(pattern, module)
+
+
+class GlyphCache:
+    """
+    Растеризованные символы шрифта Arial по размеру в пикселях.
+
+    Pillow растеризует строку заново при каждом вызове, поэтому символы
+    рисуются один раз, а строки собираются из готовых масок.
+    """
+
+    def __init__(self):
+        self.path = pdfmetrics.getFont('Arial').face.filename  # Тот же файл, что у reportlab
+        self.fonts = {}
+        self.glyphs = {}
+
+    def glyph(self, char, size):
+        """(маска символа или None, смещение x, смещение y от базовой линии, ширина шага)"""
+        key = (char, size)
+        if key not in self.glyphs:
+            if size not in self.fonts:
+                self.fonts[size] = ImageFont.truetype(self.path, size)
+            font = self.fonts[size]
+            left, top, right, bottom = font.getbbox(char, anchor='ls')
+            mask = None
+            if right > left and bottom > top:
+                image = Image.new('L', (right - left, bottom - top), 0)
+                ImageDraw.Draw(image).text((-left, -top), char, font=font, fill=255, anchor='ls')
+                mask = 255 - np.asarray(image)  # 0 - чёрный, как в изображении этикетки
+            self.glyphs[key] = (mask, left, top, font.getlength(char))
+        return self.glyphs[key]
+
+    def width(self, text, size):
+        """Ширина строки в пикселях"""
+        return sum(self.glyph(char, size)[3] for char in text)
+
+    def draw(self, pixels, text, size, x, baseline):
+        """Рисует строку в массив pixels, (x, baseline) - начало базовой линии"""
+        height, width = pixels.shape
+        for char in text:
+            mask, left, top, advance = self.glyph(char, size)
+            if mask is not None:
+                x0, y0 = int(round(x)) + left, baseline + top
+                x1, y1 = x0 + mask.shape[1], y0 + mask.shape[0]
+                # Обрезаем символ по краям этикетки
+                cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+                if cx0 < cx1 and cy0 < cy1:
+                    region = pixels[cy0:cy1, cx0:cx1]
+                    np.minimum(region, mask[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0], out=region)
+            x += advance
+
+
+def render_label_image(data, company, styles, glyphs, dpi=DEFAULT_DPI):
+    """Чёрно-белое изображение одной этикетки (режим '1') с разрешением dpi"""
+    width, height = to_dots(PAGE_WIDTH, dpi), to_dots(PAGE_HEIGHT, dpi)
+    pixels = np.full((height, width), 255, dtype=np.uint8)
+    top = MARGIN  # Позиция от верхнего края в пунктах
+
+    barcode_value = str(data.get('Баркод', 'N/A')).strip()
+    if barcode_value != 'N/A':
+        row = barcode_row(barcode_value, max(to_dots(BARCODE_BAR_WIDTH, dpi), 1))
+        x = max((width - len(row)) // 2, 0)
+        row = row[:width - x]
+        y = to_dots(top + BARCODE_TOP_MARGIN - BARCODE_HEIGHT, dpi)
+        pixels[max(y, 0):y + to_dots(BARCODE_HEIGHT, dpi), x:x + len(row)] = row
+
+        # Текст под штрих-кодом
+        size = to_dots(BARCODE_TEXT_SIZE, dpi)
+        baseline = to_dots(top + BARCODE_TOP_MARGIN + BARCODE_TEXT_OFFSET, dpi)
+        glyphs.draw(pixels, barcode_value, size, (width - glyphs.width(barcode_value, size)) / 2, baseline)
+        top += AFTER_BARCODE_SPACE
+
+    for text, style in label_elements(data, company, styles):
+        para = Paragraph(text, style)
+        _, h = para.wrap(PAGE_WIDTH, PAGE_HEIGHT)
+        size = to_dots(style.fontSize, dpi)
+        left = to_dots(style.leftIndent, dpi)
+        area = to_dots(PAGE_WIDTH - style.leftIndent - style.rightIndent, dpi)
+        # Базовая линия первой строки на fontSize ниже верха абзаца, далее шаг leading
+        baseline = top + style.fontSize
+        for line in paragraph_lines(para):
+            x = left + (area - glyphs.width(line, size)) / 2
+            glyphs.draw(pixels, line, size, x, to_dots(baseline, dpi))
+            baseline += style.leading
+        top += h + style.spaceAfter
+
+    # Пороговое преобразование без растрирования: принтер печатает только чёрные точки
+    return Image.fromarray(pixels >= 128)
+
+
+def label_images(processed_data, company, dpi=DEFAULT_DPI):
+    """Генератор (изображение, количество) по товарам задания"""
+    register_fonts()
+    styles = build_styles()
+    glyphs = GlyphCache()
+    for product in processed_data:
+        if product['quantity'] > 0:
+            yield render_label_image(product['data'], company, styles, glyphs, dpi), product['quantity']
+
+
+# ===========================================================
+# МНОГОСТРАНИЧНЫЙ TIFF
+# ===========================================================
+
+# Типы полей TIFF
+_SHORT, _LONG, _RATIONAL = 3, 4, 5
+
+
+def encode_group4(image, dpi):
+    """
+    Сжимает изображение в CCITT Group 4 средствами Pillow.
+    Возвращает (теги изображения, список полос сжатых данных).
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='TIFF', compression='group4', dpi=(dpi, dpi))
+    data = buffer.getvalue()
+    tags = Image.open(io.BytesIO(data)).tag_v2
+    strips = [data[offset:offset + count] for offset, count in zip(tags[273], tags[279])]
+    return {tag: tags[tag] for tag in (256, 257, 262, 278)}, strips
+
+
+def _ifd_entries(tags, strip_offsets, strip_counts, dpi):
+    # Поля каталога страницы (тег, тип, значения) по возрастанию тега
+    return [
+        (254, _LONG, [2]),                  # NewSubfileType: страница документа
+        (256, _LONG, [tags[256]]),          # ImageWidth
+        (257, _LONG, [tags[257]]),          # ImageLength
+        (258, _SHORT, [1]),                 # BitsPerSample
+        (259, _SHORT, [4]),                 # Compression: CCITT Group 4
+        (262, _SHORT, [tags[262]]),         # PhotometricInterpretation
+        (273, _LONG, strip_offsets),        # StripOffsets
+        (277, _SHORT, [1]),                 # SamplesPerPixel
+        (278, _LONG, [tags[278]]),          # RowsPerStrip
+        (279, _LONG, strip_counts),         # StripByteCounts
+        (282, _RATIONAL, [(dpi, 1)]),       # XResolution
+        (283, _RATIONAL, [(dpi, 1)]),       # YResolution
+        (296, _SHORT, [2]),                 # ResolutionUnit: дюймы
+    ]
+
+
+def _pack_values(field_type, values):
+    if field_type == _SHORT:
+        return struct.pack(f"<{len(values)}H", *values)
+    if field_type == _LONG:
+        return struct.pack(f"<{len(values)}I", *values)
+    return b''.join(struct.pack('<II', *value) for value in values)
+
+
+def write_tiff(pages, output, dpi):
+    """
+    Записывает многостраничный TIFF из последовательности результатов encode_group4.
+
+    Файл пишется последовательно: каталог страницы, значения вне каталога,
+    сжатые данные. Сохранение save_all в Pillow перечитывает все предыдущие
+    страницы при добавлении каждой новой, что на тысячах страниц очень медленно.
+    """
+    output.write(b'II*\x00' + struct.pack('<I', 8))
+    position = 8
+    pages = iter(pages)
+    current = next(pages, None)
+    while current is not None:
+        following = next(pages, None)
+        tags, strips = current
+        counts = [len(strip) for strip in strips]
+
+        # Размер каталога и значений вне его не зависит от смещений данных
+        entries = _ifd_entries(tags, [0] * len(strips), counts, dpi)
+        ifd_size = 2 + 12 * len(entries) + 4
+        extra_size = sum(
+            len(packed) for packed in (_pack_values(field_type, values) for _, field_type, values in entries)
+            if len(packed) > 4
+        )
+
+        # Данные страницы - сразу за каталогом (с выравниванием по слову)
+        strip_offsets = []
+        offset = position + ifd_size + extra_size
+        for count in counts:
+            strip_offsets.append(offset)
+            offset += count + count % 2
+
+        directory = [struct.pack('<H', len(entries))]
+        extra = []
+        extra_offset = position + ifd_size
+        for tag, field_type, values in _ifd_entries(tags, strip_offsets, counts, dpi):
+            packed = _pack_values(field_type, values)
+            if len(packed) <= 4:
+                directory.append(struct.pack('<HHI', tag, field_type, len(values)) + packed.ljust(4, b'\x00'))
+            else:
+                directory.append(struct.pack('<HHII', tag, field_type, len(values), extra_offset))
+                extra.append(packed)
+                extra_offset += len(packed)
+        directory.append(struct.pack('<I', offset if following is not None else 0))
+
+        output.write(b''.join(directory) + b''.join(extra))
+        for strip in strips:
+            output.write(strip + b'\x00' * (len(strip) % 2))
+        position = offset
+        current = following
+
+
+def render_bulk_tiff(processed_data, company, output, dpi=DEFAULT_DPI, progress=None):
+    """
+    Записывает многостраничный TIFF (сжатие CCITT Group 4) в файлоподобный объект output.
+    Каждое изображение сжимается один раз на товар, копии повторяют готовые данные.
+    progress(n) вызывается после каждого товара с числом его страниц.
+    """
+    def pages():
+        empty = True
+        for image, quantity in label_images(processed_data, company, dpi):
+            encoded = encode_group4(image, dpi)
+            for _ in range(quantity):
+                yield encoded
+            empty = False
+            if progress:
+                progress(quantity)
+        if empty:
+            # В TIFF должна быть хотя бы одна страница
+            yield encode_group4(Image.new('1', (to_dots(PAGE_WIDTH, dpi), to_dots(PAGE_HEIGHT, dpi)), 1), dpi)
+
+    write_tiff(pages(), output, dpi)
+
+
+# ===========================================================
+# НАБОР PNG
+# ===========================================================
+
+def render_bulk_png(processed_data, company, output, dpi=DEFAULT_DPI, progress=None):
+    """
+    Записывает ZIP-архив с последовательностью PNG (по файлу на страницу) в output.
+    Каждое изображение кодируется один раз на товар; архив без сжатия,
+    так как PNG уже сжат.
+    """
+    page = 0
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for image, quantity in label_images(processed_data, company, dpi):
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG', dpi=(dpi, dpi))
+            png = buffer.getvalue()
+            for _ in range(quantity):
+                page += 1
+                archive.writestr(f"{page:05d}.png", png)
+            if progress:
+                progress(quantity)
@@ -0,0 +1,572 @@
+"""
+Отрисовка этикеток средствами reportlab.
+
+Модуль не зависит от Django: его функции используются как из view-функций,
+так и из фоновых процессов генерации.
+"""
+import io
+import os
+import json
+import math
+import hashlib
+import functools
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures.process import BrokenProcessPool
+
+import reportlab
+from reportlab.pdfgen import canvas
+from reportlab.graphics.barcode import code128
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph
+
+from .pool import get_pool, pool_size, reset_pool
+
+try:
+    from pypdf import PdfWriter
+except ImportError:  # Без pypdf склейка частей PDF недоступна
+    PdfWriter = None
+
+
+# ===========================================================
+# ГЛОБАЛЬНЫЕ КОНСТАНТЫ ДЛЯ ДИЗАЙНА ЭТИКЕТОК
+# ===========================================================
+
+# Размеры страницы и отступы
+PAGE_WIDTH = 58 * mm       # Ширина этикетки (58 мм)
+PAGE_HEIGHT = 40 * mm      # Высота этикетки (40 мм)
+MARGIN = 0.2 * mm            # Отступ от края страницы
+PADDING_RIGHT = 5 * mm     # Правый отступ для текста
+PADDING_LEFT = 5 * mm      # Левый отступ для текста
+
+# Размеры шрифтов
+COMPANY_FONT_SIZE = 8.2    # Размер шрифта для названия компании
+PRODUCT_FONT_SIZE = 7.4    # Размер шрифта для названия товара
+ARTICLE_FONT_SIZE = 7.5    # Размер шрифта для артикула
+EXTRA_FONT_SIZE = 8        # Размер шрифта для дополнительной информации
+
+# Параметры штрих-кода (одинаковые для всех режимов генерации)
+BARCODE_HEIGHT = 8.3 * mm        # Высота штрих-кода
+BARCODE_BAR_WIDTH = 0.75       # Толщина штрихов (меньше = тоньше)
+BARCODE_TEXT_SIZE = 9          # Размер шрифта для цифр под штрих-кодом
+BARCODE_TOP_MARGIN = 12 * mm   # Отступ штрих-кода от верхнего края
+BARCODE_TEXT_OFFSET = 4 * mm   # Отступ текста от штрих-кода
+AFTER_BARCODE_SPACE = 17 * mm  # Отступ после блока штрих-кода
+
+# Дополнительные параметры вёрстки
+LINE_SPACING = 1 * mm          # Универсальный межстрочный интервал
+PRODUCT_SIDE_PADDING = 5 * mm  # Боковые отступы для названия товара
+
+# Дополнительные отступы для элементов (необязательные, могут использоваться в будущем)
+ELEMENT_OFFSETS = {
+    'after_barcode': 3 * mm,
+    'after_company': 1.5 * mm,
+    'after_product': 1 * mm,
+    'after_article': 1 * mm
+}
+
+# Набор стилей текста этикетки
+LabelStyles = namedtuple('LabelStyles', ['company', 'product', 'article', 'color'])
+
+# Закодированный штрих-код: полная ширина, высота и полосы (смещение, ширина)
+EncodedBarcode = namedtuple('EncodedBarcode', ['width', 'height', 'bars'])
+
+# Сколько закодированных штрих-кодов хранить в памяти процесса
+BARCODE_CACHE_SIZE = 8192
+
+# Поля товара, которые попадают на этикетку
+LABEL_FIELDS = ('Баркод', 'Наименование', 'Артикул', 'Размер', 'Цвет')
+
+# Символы, коды которых закрепляются в шрифте каждого документа (см. prime_fonts)
+FONT_CHARSET = (
+    ''.join(chr(code) for code in range(32, 127))
+    + 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ'
+    + 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    + '№«»–—'
+)
+
+# Параметры вёрстки, от которых зависят команды отрисовки этикетки
+LAYOUT_PARAMS = (
+    PAGE_WIDTH, PAGE_HEIGHT, MARGIN, PADDING_RIGHT, PADDING_LEFT,
+    COMPANY_FONT_SIZE, PRODUCT_FONT_SIZE, ARTICLE_FONT_SIZE, EXTRA_FONT_SIZE,
+    BARCODE_HEIGHT, BARCODE_BAR_WIDTH, BARCODE_TEXT_SIZE, BARCODE_TOP_MARGIN,
+    BARCODE_TEXT_OFFSET, AFTER_BARCODE_SPACE, LINE_SPACING, PRODUCT_SIDE_PADDING,
+    FONT_CHARSET,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def layout_fingerprint():
+    """
+    Отпечаток вёрстки: параметры LAYOUT_PARAMS, версия reportlab и хэш файла шрифта.
+
+    Готовые команды отрисовки (библиотека шаблонов, кэш этикеток) получены
+    через внутренние структуры reportlab и ссылаются на коды символов шрифта,
+    поэтому при обновлении reportlab или замене arial.ttf все готовые
+    этикетки устаревают так же, как при изменении вёрстки.
+    """
+    register_fonts()
+    font_digest = hashlib.sha256()
+    with open(pdfmetrics.getFont('Arial').face.filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            font_digest.update(chunk)
+    payload = repr((LAYOUT_PARAMS, reportlab.Version, font_digest.hexdigest()))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def label_hash(data, company):
+    """Хэш всех данных, от которых зависит внешний вид этикетки товара"""
+    payload = [layout_fingerprint(), company] + [data.get(field) for field in LABEL_FIELDS]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def register_fonts():
+    """Регистрирует шрифт Arial (повторная регистрация не выполняется)"""
+    if 'Arial' not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
+
+
+def prime_fonts(p):
+    """
+    Закрепляет в документе холста коды символов FONT_CHARSET и имя шрифта Arial.
+
+    Reportlab нумерует символы встроенного шрифта в порядке их появления
+    в документе, поэтому без этого одни и те же команды отрисовки текста
+    в разных документах различаются. Вызывается сразу после создания холста.
+    """
+    font = pdfmetrics.getFont('Arial')
+    font.splitString(FONT_CHARSET, p._doc)
+    font.getSubsetInternalName(0, p._doc)
+
+
+def _font_state(p):
+    # Число закодированных символов Arial и шрифтов документа
+    return pdfmetrics.getFont('Arial').state[p._doc].nextCode, len(p._doc.fontMapping)
+
+
+def draw_portable_label(p, data, company, styles):
+    """
+    Рисует этикетку как draw_label и возвращает её команды отрисовки (str).
+
+    Команды можно вставить в любой документ, подготовленный prime_fonts,
+    без повторной вёрстки. Если на этикетке есть символы вне FONT_CHARSET,
+    команды зависят от документа и функция возвращает None.
+    """
+    state = _font_state(p)
+    start = len(p._code)
+    draw_label(p, data, company, styles)
+    if _font_state(p) != state:
+        return None
+    return '\n'.join(p._code[start:])
+
+
+def build_styles():
+    """
+    Создаёт стили текста этикетки (одинаковые для всех режимов).
+    """
+    styles = getSampleStyleSheet()
+
+    # Стиль для названия компании
+    company_style = styles["Normal"].clone('CompanyStyle')
+    company_style.fontName = "Arial"
+    company_style.fontSize = COMPANY_FONT_SIZE
+    company_style.alignment = 1  # Выравнивание по центру
+    company_style.leading = COMPANY_FONT_SIZE * 1.2  # Межстрочный интервал
+    company_style.spaceBefore = 1  # Отступ сверху
+    company_style.spaceAfter = 1   # Отступ снизу
+
+    # Стиль для названия товара
+    product_style = styles["Normal"].clone('ProductStyle')
+    product_style.fontName = "Arial"
+    product_style.fontSize = PRODUCT_FONT_SIZE
+    product_style.alignment = 1
+    product_style.leading = PRODUCT_FONT_SIZE * 1.3
+    product_style.splitLongWords = True  # Разрешаем перенос длинных слов
+    product_style.wordWrap = 'CJK'       # Алгоритм переноса для кириллицы
+    product_style.leftIndent = PRODUCT_SIDE_PADDING  # Левый отступ
+    product_style.rightIndent = PRODUCT_SIDE_PADDING  # Правый отступ
+
+    # Стиль для артикула
+    article_style = styles["Normal"].clone('ArticleStyle')
+    article_style.fontName = "Arial"
+    article_style.fontSize = ARTICLE_FONT_SIZE
+    article_style.alignment = 1
+    article_style.leading = ARTICLE_FONT_SIZE * 1.1
+    article_style.spaceBefore = 0.5 * mm  # Отступ сверху
+    article_style.spaceAfter = 0.5 * mm   # Отступ снизу
+
+    # Стиль для дополнительной информации (цвет/размер)
+    color_style = styles["Normal"].clone('ColorStyle')
+    color_style.fontName = "Arial"
+    color_style.fontSize = EXTRA_FONT_SIZE
+    color_style.alignment = 1
+    color_style.leading = EXTRA_FONT_SIZE * 1.1
+    color_style.spaceBefore = 1 * mm
+
+    return LabelStyles(company_style, product_style, article_style, color_style)
+
+
+def barcode_bars(barcode):
+    """
+    Полосы штрих-кода reportlab: кортеж (x, ширина) в пунктах.
+
+    Разбирает открытый атрибут decomposed: заглавная буква - полоса,
+    строчная - пробел, номер буквы в алфавите - ширина в модулях barWidth.
+    Полосы отсчитываются от левой тихой зоны, как в отрисовке reportlab.
+    """
+    bars = []
+    left = barcode.lquiet if barcode.quiet else 0
+    for c in barcode.decomposed:
+        width = (ord(c.lower()) - ord('a') + 1) * barcode.barWidth
+        if c.isupper():
+            bars.append((left, width))
+        left += width
+    return tuple(bars)
+
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
+def encode_barcode(value, bar_height=BARCODE_HEIGHT, bar_width=BARCODE_BAR_WIDTH):
+    """
+    Кодирует значение в Code128 и возвращает EncodedBarcode.
+
+    Результат кэшируется на уровне процесса (ключ - значение и геометрия
+    штрих-кода), повторная отрисовка того же штрих-кода не кодирует его заново.
+    """
+    barcode = code128.Code128(value, barHeight=bar_height, barWidth=bar_width)
+    # Обращение к width кодирует значение и заполняет decomposed
+    width = barcode.width
+    return EncodedBarcode(width, barcode.barHeight, barcode_bars(barcode))
+
+
+def barcode_cache_info():
+    """Статистика кэша штрих-кодов: hits, misses, maxsize, currsize"""
+    return encode_barcode.cache_info()
+
+
+def draw_barcode(p, encoded, x, y):
+    """Рисует закодированный штрих-код на холсте, левый нижний угол - (x, y)"""
+    for bar_x, bar_width in encoded.bars:
+        p.rect(x + bar_x, y, bar_width, encoded.height, stroke=0, fill=1)
+
+
+def label_elements(data, company, styles):
+    """Текстовые элементы этикетки под штрих-кодом: список (текст, стиль)"""
+    elements = [
+        (company, styles.company),  # Динамическое название
+        (data.get('Наименование', 'Без названия'), styles.product),
+        (f"Артикул: {data.get('Артикул', 'N/A')}", styles.article)
+    ]
+
+    # Добавляем размер, если он указан
+    if 'Размер' in data and data['Размер']:
+        elements.append((f"Размер: {data['Размер']}", styles.color))
+
+    # Добавляем цвет, если он указан
+    if data.get('Цвет'):
+        elements.append((f"Цвет: {data['Цвет']}", styles.color))
+
+    return elements
+
+
+def paragraph_lines(para):
+    """Строки текста абзаца после переноса reportlab (para.wrap уже вызван)"""
+    bl_para = para.blPara
+    if bl_para.kind == 0:
+        return [' '.join(words) for _, words in bl_para.lines]
+    # Абзац с разметкой: строки состоят из фрагментов
+    return [''.join(getattr(frag, 'text', '') for frag in line.words) for line in bl_para.lines]
+
+
+def to_dots(value, dpi):
+    """Переводит пункты reportlab (1/72 дюйма) в точки устройства печати"""
+    return int(round(value * dpi / 72))
+
+
+def draw_label(p, data, company, styles):
+    """
+    Рисует содержимое одной этикетки на текущей странице (или форме) холста.
+    """
+    current_y = PAGE_HEIGHT - MARGIN  # Стартовая позиция по Y
+
+    # Отрисовка штрих-кода (если он есть)
+    barcode_value = str(data.get('Баркод', 'N/A')).strip()
+    if barcode_value != 'N/A':
+        # Генерация штрих-кода (из кэша, если уже кодировался)
+        barcode = encode_barcode(barcode_value, BARCODE_HEIGHT, BARCODE_BAR_WIDTH)
+        # Центрирование штрих-кода
+        barcode_x = (PAGE_WIDTH - barcode.width) / 2
+        draw_barcode(p, barcode, barcode_x, current_y - BARCODE_TOP_MARGIN)
+
+        # Текст под штрих-кодом
+        p.setFont("Arial", BARCODE_TEXT_SIZE)
+        text_width = p.stringWidth(barcode_value, "Arial", BARCODE_TEXT_SIZE)
+        text_x = (PAGE_WIDTH - text_width) / 2
+        p.drawString(text_x, current_y - BARCODE_TOP_MARGIN - BARCODE_TEXT_OFFSET, barcode_value)
+
+        # Смещаем позицию Y вниз после штрих-кода
+        current_y -= AFTER_BARCODE_SPACE
+
+    # Отрисовка всех текстовых элементов
+    for text, style in label_elements(data, company, styles):
+        para = Paragraph(text, style)
+        w, h = para.wrap(PAGE_WIDTH, PAGE_HEIGHT)  # Определение размера элемента
+        x = (PAGE_WIDTH - w) / 2  # Центрирование по горизонтали
+        para.drawOn(p, x, current_y - h)  # Отрисовка параграфа
+
+        # Смещаем позицию Y с учетом отступа стиля
+        current_y -= h + style.spaceAfter
+
+
+def render_template_pdf(data, company, styles, content=None):
+    """
+    Рисует одностраничный PDF с этикеткой одного товара.
+    content - готовые команды отрисовки этикетки (из кэша): вёрстка не выполняется.
+    Возвращает (PDF в bytes, команды отрисовки из draw_portable_label).
+    """
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+    prime_fonts(p)
+    if content is not None:
+        p._code.append(content)
+    else:
+        content = draw_portable_label(p, data, company, styles)
+    p.showPage()
+    p.save()
+    return buffer.getvalue(), content
+
+
+def render_bulk_pdf(processed_data, company, output, progress=None, contents=None, rendered=None):
+    """
+    Рисует многостраничный PDF для массовой печати в файлоподобный объект output.
+
+    Каждый уникальный товар отрисовывается один раз в PDF-форму (XObject),
+    а копии этикеток лишь ссылаются на неё. Время генерации и размер файла
+    зависят от числа уникальных товаров, а не от общего числа этикеток.
+
+    contents - готовые команды отрисовки этикеток {label_hash: str}
+    (из библиотеки шаблонов или кэша): такие товары не вёрстаются заново.
+    В словарь rendered (если передан) добавляются команды отрисовки
+    товаров, свёрстанных при этом вызове.
+    progress(n) вызывается после каждого товара с числом готовых этикеток.
+    """
+    register_fonts()
+    styles = build_styles()
+    p = canvas.Canvas(output, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+    prime_fonts(p)
+
+    for index, product in enumerate(processed_data):
+        quantity = product['quantity']  # Количество этикеток для этого товара
+        if quantity <= 0:
+            continue
+
+        # Отрисовываем товар один раз в форму
+        form_name = f"label{index}"
+        key = label_hash(product['data'], company) if contents or rendered is not None else None
+        content = contents.get(key) if contents else None
+        p.beginForm(form_name, 0, 0, PAGE_WIDTH, PAGE_HEIGHT)
+        if content is not None:
+            p._code.append(content)  # Готовая этикетка из библиотеки шаблонов или кэша
+        elif rendered is not None:
+            content = draw_portable_label(p, product['data'], company, styles)
+            if content is not None:
+                rendered[key] = content
+        else:
+            draw_label(p, product['data'], company, styles)
+        p.endForm()
+
+        # Размещаем форму на каждой копии этикетки
+        for _ in range(quantity):
+            p.doForm(form_name)
+            p.showPage()
+
+        if progress:
+            progress(quantity)
+
+    # Сохраняем PDF-документ
+    p.save()
+
+
+# ===========================================================
+# ПАРАЛЛЕЛЬНАЯ ГЕНЕРАЦИЯ ШАБЛОНОВ
+# ===========================================================
+
+# Стили текста процесса-исполнителя (создаются при первом шаблоне в процессе)
+_worker_styles = None
+
+
+def worker_styles():
+    """Стили процесса-исполнителя: шрифт и стили создаются один раз на процесс"""
+    global _worker_styles
+    if _worker_styles is None:
+        register_fonts()
+        _worker_styles = build_styles()
+    return _worker_styles
+
+
+def template_filename(data):
+    """Имя файла шаблона на основе штрих-кода и названия товара"""
+    barcode = str(data.get('Баркод', 'N/A')).strip()
+    product_name = str(data.get('Наименование', 'без_названия'))[:60]  # Обрезаем длинные названия
+    clean_name = product_name.replace(' ', ' ').replace('/', '-')  # Заменяем спецсимволы
+    return f"{barcode} {clean_name}.pdf"
+
+
+def render_template_file(task):
+    """
+    Рисует шаблон одного товара и сохраняет его на диск.
+    task = (data, company, filepath, content), content - готовые команды отрисовки или None.
+    Возвращает (имя файла, текст ошибки или None, команды отрисовки или None).
+    """
+    data, company, filepath, content = task
+    try:
+        pdf, content = render_template_pdf(data, company, worker_styles(), content)
+        with open(filepath, 'wb') as f:
+            f.write(pdf)
+        return filepath, None, content
+    except Exception as e:
+        return filepath, str(e), None
+
+
+def render_template_files(tasks, workers=None, threshold=0, progress=None):
+    """
+    Рисует шаблоны по списку задач (data, company, filepath, content).
+
+    Задачи распределяются по общему пулу процессов (см. pool.py). Если задач
+    меньше threshold или доступен один процесс, генерация идёт в текущем процессе.
+    Возвращает список результатов render_template_file в порядке задач.
+    """
+    size = pool_size(workers)
+
+    results = []
+    if min(size, len(tasks)) > 1 and len(tasks) >= threshold:
+        pool = None
+        try:
+            pool = get_pool(size)
+            chunksize = max(1, len(tasks) // (size * 4))
+            for result in pool.map(render_template_file, tasks, chunksize=chunksize):
+                results.append(result)
+                if progress:
+                    progress(1)
+        except (BrokenProcessPool, OSError):
+            # Пул процессов недоступен (например, в ограниченном окружении) —
+            # оставшиеся шаблоны генерируем в текущем процессе
+            if pool is not None:
+                reset_pool(pool)
+
+    if len(results) < len(tasks):
+        for task in tasks[len(results):]:
+            results.append(render_template_file(task))
+            if progress:
+                progress(1)
+
+    return results
+
+
+# ===========================================================
+# МНОГОПРОЦЕССНАЯ ГЕНЕРАЦИЯ ЕДИНОГО PDF ДЛЯ МАССОВОЙ ПЕЧАТИ
+# ===========================================================
+
+def split_shards(processed_data, shards):
+    """
+    Делит список товаров на shards непрерывных диапазонов страниц.
+
+    Порядок этикеток сохраняется: товар, попавший на границу диапазонов,
+    делится на две части с соответствующим количеством копий.
+    """
+    total = sum(max(product['quantity'], 0) for product in processed_data)
+    size = math.ceil(total / shards) if total else 0
+
+    result = []
+    current = []
+    free = size
+    for product in processed_data:
+        quantity = product['quantity']
+        while quantity > 0:
+            take = min(quantity, free)
+            current.append({'data': product['data'], 'quantity': take})
+            quantity -= take
+            free -= take
+            if free == 0:
+                result.append(current)
+                current = []
+                free = size
+    if current:
+        result.append(current)
+    return result
+
+
+def render_bulk_shard(task):
+    """
+    Рисует одну часть документа в файл (выполняется в процессе пула).
+    Возвращает (путь к файлу, команды отрисовки свёрстанных товаров или None).
+    """
+    shard, company, filepath, contents, collect = task
+    rendered = {} if collect else None
+    with open(filepath, 'wb') as f:
+        render_bulk_pdf(shard, company, f, contents=contents, rendered=rendered)
+    return filepath, rendered
+
+
+def render_bulk_pdf_sharded(processed_data, company, output, workers=None, threshold=0, progress=None,
+                            contents=None, rendered=None):
+    """
+    Рисует PDF для массовой печати, распределяя страницы по пулу процессов.
+
+    Документ делится на непрерывные диапазоны страниц по числу процессов
+    общего пула (см. pool.py), каждый диапазон рисуется отдельным процессом,
+    затем части склеиваются в исходном порядке.
+    Если этикеток меньше threshold, доступен один процесс или не установлен
+    pypdf, используется обычная генерация в текущем процессе.
+    contents, rendered - см. render_bulk_pdf.
+    progress(n) вызывается по мере готовности частей документа.
+    """
+    total = sum(max(product['quantity'], 0) for product in processed_data)
+    workers = pool_size(workers)
+
+    if PdfWriter is None or workers <= 1 or total < threshold:
+        render_bulk_pdf(processed_data, company, output, progress, contents, rendered)
+        return
+
+    shards = split_shards(processed_data, workers)
+    shard_dir = tempfile.mkdtemp(prefix='labels_')
+    try:
+        tasks = [
+            (shard, company, os.path.join(shard_dir, f"part{index:04d}.pdf"), contents, rendered is not None)
+            for index, shard in enumerate(shards)
+        ]
+        results = []
+        pool = None
+        try:
+            pool = get_pool(workers)
+            for task, result in zip(tasks, pool.map(render_bulk_shard, tasks)):
+                results.append(result)
+                if progress:
+                    progress(sum(product['quantity'] for product in task[0]))
+        except (BrokenProcessPool, OSError):
+            # Оставшиеся части рисуем в текущем процессе
+            if pool is not None:
+                reset_pool(pool)
+            for task in tasks[len(results):]:
+                results.append(render_bulk_shard(task))
+                if progress:
+                    progress(sum(product['quantity'] for product in task[0]))
+
+        parts = [part for part, _ in results]
+        if rendered is not None:
+            for _, shard_rendered in results:
+                rendered.update(shard_rendered)
+
+        # Склеиваем части в исходном порядке. Каждая часть несёт свою копию
+        # шрифта и общих XObject'ов - одинаковые объекты объединяются
+        writer = PdfWriter()
+        for part in parts:
+            writer.append(part)
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+        writer.write(output)
+        writer.close()
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
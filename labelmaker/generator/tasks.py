@@ -0,0 +1,268 @@
+"""
+Генерация этикеток по заданиям из хранилища (generator/jobs.py).
+
+Задание можно выполнить прямо в запросе или передать в фоновый пул потоков:
+тогда запрос сразу возвращает идентификатор задания, а ход генерации
+отдаётся через JSON-эндпоинт job_status.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .jobs import JOBS_DIR, load_job, update_job, job_exists
+from .library import sync_templates, prepare_bulk
+from .metrics import stage
+from .pages import load_pages, save_pages
+from .rendering import label_hash, render_bulk_pdf_sharded, barcode_cache_info
+from .raster import render_bulk_tiff, render_bulk_png
+from .zpl import render_bulk_zpl
+
+logger = logging.getLogger(__name__)
+
+# Путь для сохранения шаблонов этикеток
+TEMPLATES_DIR = os.path.join(settings.MEDIA_ROOT, 'patterns')
+
+# Форматы файла массовой печати: имя файла для скачивания и тип содержимого
+OUTPUT_FORMATS = {
+    'pdf': ('labels.pdf', 'application/pdf'),
+    'zpl': ('labels.zpl', 'application/octet-stream'),
+    'tiff': ('labels.tiff', 'image/tiff'),
+    'png': ('labels.zip', 'application/zip'),
+}
+
+# Архив шаблонов (режим template_zip): имя файла для скачивания и тип содержимого
+TEMPLATE_ARCHIVE = ('templates.zip', 'application/zip')
+
+# Растровые форматы: функция вывода по формату
+RASTER_RENDERERS = {
+    'tiff': render_bulk_tiff,
+    'png': render_bulk_png,
+}
+
+# Пул фоновой генерации (создаётся при первом задании)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Ход выполнения фоновых заданий: job_id -> {'state', 'done', 'total'}
+_progress = {}
+_progress_lock = threading.Lock()
+
+
+def count_labels(processed_data):
+    """Общее число этикеток в задании"""
+    return sum(max(product['quantity'], 0) for product in processed_data)
+
+
+def build_bulk_pdf(processed_data, company, output, progress=None, templates_dir=TEMPLATES_DIR, from_library=None):
+    """
+    Рисует единый PDF для массовой печати в файлоподобный объект output.
+
+    При from_library готовые этикетки товаров берутся из библиотеки шаблонов
+    в templates_dir (библиотека только читается, см. prepare_bulk);
+    None - по настройке LABEL_BULK_FROM_LIBRARY.
+    Остальные этикетки берутся из кэша отрисованных этикеток, в него же
+    попадают этикетки, свёрстанные заново.
+    """
+    if from_library is None:
+        from_library = settings.LABEL_BULK_FROM_LIBRARY
+    contents = {}
+    if from_library:
+        found, contents = prepare_bulk(processed_data, company, templates_dir)
+        logger.info(f"Библиотека шаблонов: готовых этикеток {len(contents)} (товаров {found})")
+
+    missing = {
+        label_hash(product['data'], company) for product in processed_data if product['quantity'] > 0
+    } - contents.keys()
+    cached = load_pages(missing)
+    contents.update(cached)
+
+    rendered = {}
+    render_bulk_pdf_sharded(
+        processed_data,
+        company,
+        output,
+        workers=settings.LABEL_WORKERS,
+        threshold=settings.LABEL_SHARD_THRESHOLD,
+        progress=progress,
+        contents=contents,
+        rendered=rendered,
+    )
+    save_pages(rendered)
+    logger.info(f"Кэш этикеток: готовых {len(cached)}, отрисовано {len(rendered)}")
+    logger.info(f"Кэш штрих-кодов: {barcode_cache_info()}")
+
+
+def build_templates(processed_data, company, progress=None, templates_dir=TEMPLATES_DIR):
+    """
+    Обновляет библиотеку шаблонов в templates_dir: создаёт отсутствующие
+    и перерисовывает устаревшие. Возвращает отчёт created/updated/skipped/failed,
+    files - имена файлов шаблонов задания в templates_dir (новых и готовых).
+    """
+    with stage('render_templates', products=len(processed_data)) as current:
+        report, entries = sync_templates(
+            processed_data,
+            company,
+            templates_dir,
+            workers=settings.LABEL_WORKERS,
+            threshold=settings.LABEL_PARALLEL_THRESHOLD,
+            progress=progress,
+        )
+        current.record(templates=report['created'] + report['updated'])
+    report['files'] = [entry['filename'] for entry in entries if entry['filename'] is not None]
+
+    for filename, error in report['errors']:
+        logger.error(f"Ошибка генерации шаблона {filename}: {error}")
+
+    return report
+
+
+def build_bulk_zpl(processed_data, company, output, progress=None):
+    """Записывает задание для термопринтера (ZPL) в файлоподобный объект output"""
+    render_bulk_zpl(
+        processed_data, company, output, dpi=settings.LABEL_PRINTER_DPI, progress=progress, font=settings.LABEL_ZPL_FONT
+    )
+
+
+def build_bulk(processed_data, company, output, output_format='pdf', progress=None, templates_dir=TEMPLATES_DIR,
+               from_library=None):
+    """
+    Формирует файл массовой печати в формате output_format (см. OUTPUT_FORMATS).
+    from_library - брать готовые этикетки PDF из библиотеки шаблонов (см. build_bulk_pdf).
+    """
+    start = output.tell()
+    with stage(f"render_{output_format}", products=len(processed_data), labels=count_labels(processed_data)) as current:
+        if output_format == 'zpl':
+            build_bulk_zpl(processed_data, company, output, progress)
+        elif output_format in RASTER_RENDERERS:
+            RASTER_RENDERERS[output_format](
+                processed_data, company, output, dpi=settings.LABEL_PRINTER_DPI, progress=progress
+            )
+        else:
+            build_bulk_pdf(processed_data, company, output, progress, templates_dir, from_library)
+        current.record(bytes=output.tell() - start)
+
+
+def output_path(job_id, output_format='pdf'):
+    """Путь к готовому файлу фонового задания"""
+    return os.path.join(JOBS_DIR, f"{job_id}.{output_format}")
+
+
+def find_output(job_id):
+    """Готовый файл фонового задания: (путь, формат) или None"""
+    for output_format in OUTPUT_FORMATS:
+        path = output_path(job_id, output_format)
+        if os.path.exists(path):
+            return path, output_format
+    return None
+
+
+# ===========================================================
+# ФОНОВЫЕ ЗАДАНИЯ
+# ===========================================================
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_WORKERS,
+                thread_name_prefix='labels'
+            )
+        return _executor
+
+
+def _set_progress(job_id, **fields):
+    with _progress_lock:
+        _progress.setdefault(job_id, {}).update(fields)
+
+
+def _run_job(job_id, company):
+    """Выполняет задание в фоновом потоке и сохраняет результат в хранилище"""
+    job = load_job(job_id)
+    processed_data = job['processed_data']
+
+    def progress(count):
+        with _progress_lock:
+            _progress[job_id]['done'] += count
+
+    _set_progress(job_id, state='running')
+    try:
+        if job['is_template_mode']:
+            report = build_templates(processed_data, company, progress)
+            result = {
+                'created': report['created'],
+                'updated': report['updated'],
+                'skipped': report['skipped'],
+                'failed': report['failed'],
+            }
+            # Для архива запоминаем файлы: их отдаёт job_templates
+            if job.get('output_format') == 'zip':
+                result['files'] = report['files']
+        else:
+            path = output_path(job_id, job.get('output_format', 'pdf'))
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                build_bulk(processed_data, company, f, job.get('output_format', 'pdf'), progress,
+                           from_library=job.get('from_library', False))
+            os.replace(tmp_path, path)
+            result = {}
+
+        update_job(job_id, state='done', result=result)
+        _set_progress(job_id, state='done', result=result)
+    except Exception as e:
+        logger.error(f"Ошибка фоновой генерации {job_id}: {str(e)}")
+        update_job(job_id, state='error', error=str(e))
+        _set_progress(job_id, state='error', error=str(e))
+    finally:
+        # Поток пула живёт дольше задания - закрываем его соединение с БД
+        close_old_connections()
+
+
+def _prune_progress():
+    """Забывает завершённые задания, удалённые из хранилища по сроку хранения"""
+    with _progress_lock:
+        for job_id in list(_progress):
+            if _progress[job_id].get('state') in ('done', 'error') and not job_exists(job_id):
+                del _progress[job_id]
+
+
+def submit_job(job_id, company):
+    """Ставит задание в очередь фоновой генерации"""
+    _prune_progress()
+    job = load_job(job_id)
+    total = len(job['processed_data']) if job['is_template_mode'] else count_labels(job['processed_data'])
+
+    update_job(job_id, state='pending', total=total)
+    _set_progress(job_id, state='pending', done=0, total=total, session=job.get('session'))
+    _get_executor().submit(_run_job, job_id, company)
+
+
+def job_progress(job_id):
+    """
+    Состояние задания: state (pending/running/done/error), done, total,
+    session - сессия владельца и результат для завершённых заданий.
+    None, если задание не найдено.
+    """
+    with _progress_lock:
+        if job_id in _progress:
+            return dict(_progress[job_id])
+
+    # Задание не из текущего процесса (например, после перезапуска сервера)
+    job = load_job(job_id)
+    if job is None or 'state' not in job:
+        return None
+    if job['state'] in ('pending', 'running'):
+        # Процесс, выполнявший задание, завершился
+        return {
+            'state': 'error', 'error': 'Генерация была прервана', 'done': 0, 'total': job.get('total', 0),
+            'session': job.get('session'),
+        }
+    total = job.get('total', 0)
+    return {
+        'state': job['state'], 'done': total, 'total': total, 'result': job.get('result'), 'error': job.get('error'),
+        'session': job.get('session'),
+    }
@@ -1,3 +1,1414 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from filelock import Timeout
+from PIL import Image
+from pypdf import PdfReader
+from reportlab.graphics.barcode import createBarcodeDrawing
+from reportlab.graphics.shapes import Rect
+from reportlab.pdfbase import pdfmetrics
+
+from . import jobs, pool, rendering, tasks, utils, workbook, workspaces
+from .archive import stream_zip
+from .barcodes import normalize_barcodes, barcode_errors, check_products
+from .grid import apply_changes
+from .grouping import group_products, group_rows, group_chunks, merge_groups
+from .library import plan_templates, save_records, sync_templates, prepare_bulk
+from .metrics import stage
+from .models import TemplateRecord, LabelPage
+from .pages import load_pages, save_pages, evict_pages
+from .raster import encode_group4, write_tiff, render_bulk_tiff, render_bulk_png
+from .rendering import (
+    render_bulk_pdf, render_bulk_pdf_sharded, encode_barcode, label_hash, layout_fingerprint,
+    BARCODE_HEIGHT, BARCODE_BAR_WIDTH,
+)
+from .workbook import detect_encoding, detect_delimiter, csv_dialect, read_csv_chunks
+from .zpl import render_bulk_zpl
+
+COMPANY = 'ООО "Тест"'
+COLUMN_MAPPING = {'article': 'Артикул', 'barcode': 'Баркод', 'product_name': 'Наименование', 'size': 'Размер'}
+SELECTED_COLUMNS = ['Артикул', 'Баркод', 'Наименование', 'Цвет', 'Размер']
+
+
+def label_products(quantities):
+    """Товары для генерации этикеток: по одному на каждое количество"""
+    return [
+        {
+            'data': {'Баркод': str(4600000000000 + index), 'Наименование': f"Товар {index}", 'Артикул': f"A-{index}"},
+            'quantity': quantity,
+        }
+        for index, quantity in enumerate(quantities)
+    ]
+
+
+def pdf_pages(data):
+    """Страницы PDF: (объект формы на странице, текст страницы)"""
+    reader = PdfReader(BytesIO(data))
+    pages = []
+    for page in reader.pages:
+        xobjects = page['/Resources']['/XObject']
+        forms = [xobjects.raw_get(name).idnum for name in xobjects]
+        pages.append((forms, page.extract_text()))
+    return pages
+
+
+def font_files(data):
+    """Номера объектов встроенных файлов шрифтов документа"""
+    reader = PdfReader(BytesIO(data))
+    found = set()
+    for page in reader.pages:
+        for form in page['/Resources']['/XObject'].values():
+            for font in form.get_object()['/Resources']['/Font'].values():
+                descriptor = font.get_object().get('/FontDescriptor')
+                if descriptor is not None:
+                    found.add(descriptor.get_object().raw_get('/FontFile2').idnum)
+    return found
+
+
+def form_streams(data):
+    """Содержимое форм этикеток по страницам документа"""
+    reader = PdfReader(BytesIO(data))
+    return [
+        [form.get_object().get_data() for form in page['/Resources']['/XObject'].values()]
+        for page in reader.pages
+    ]
+
+
+# ===========================================================
+# ЕДИНЫЙ PDF ДЛЯ МАССОВОЙ ПЕЧАТИ
+# ===========================================================
+
+class BulkPdfTests(TestCase):
+    def render(self, products):
+        output = BytesIO()
+        render_bulk_pdf(products, COMPANY, output)
+        return output.getvalue()
+
+    def test_copies_share_one_form(self):
+        pages = pdf_pages(self.render(label_products([3, 0, 2])))
+        self.assertEqual(len(pages), 5)
+        # Каждая страница ссылается на одну форму, копии товара - на одну и ту же
+        self.assertTrue(all(len(forms) == 1 for forms, _ in pages))
+        first, second = {pages[0][0][0]}, {pages[3][0][0]}
+        self.assertEqual({forms[0] for forms, _ in pages[:3]}, first)
+        self.assertEqual({forms[0] for forms, _ in pages[3:]}, second)
+        self.assertNotEqual(first, second)
+        self.assertIn('4600000000000', pages[0][1])
+        self.assertIn('Товар 2', pages[4][1])
+
+    def test_copies_do_not_repeat_label(self):
+        single = len(self.render(label_products([1, 1])))
+        many = len(self.render(label_products([101, 1])))
+        # Копия - только страница со ссылкой на форму, а не новая этикетка
+        self.assertLess((many - single) / 100, 1024)
+
+
+class ShardedPdfTests(TestCase):
+    def test_page_order(self):
+        products = label_products([3, 5, 1, 4])
+        single = BytesIO()
+        render_bulk_pdf(products, COMPANY, single)
+        sharded = BytesIO()
+        render_bulk_pdf_sharded(products, COMPANY, sharded, workers=3, threshold=0)
+
+        expected = [text for _, text in pdf_pages(single.getvalue())]
+        self.assertEqual([text for _, text in pdf_pages(sharded.getvalue())], expected)
+        self.assertEqual(len(expected), 13)
+
+    def test_shared_objects_merged(self):
+        products = label_products([20] * 6)
+        single = BytesIO()
+        render_bulk_pdf(products, COMPANY, single)
+        sharded = BytesIO()
+        render_bulk_pdf_sharded(products, COMPANY, sharded, workers=4, threshold=0)
+
+        # Каждая часть несёт свою копию шрифта - в склеенном документе она одна
+        self.assertEqual(len(font_files(sharded.getvalue())), 1)
+        self.assertLessEqual(len(sharded.getvalue()), len(single.getvalue()) * 1.1)
+
+    def test_broken_pool_falls_back(self):
+        products = label_products([3, 5, 1])
+        single = BytesIO()
+        render_bulk_pdf(products, COMPANY, single)
+
+        broken = mock.Mock()
+        broken.map.side_effect = BrokenProcessPool('процесс завершился')
+        sharded = BytesIO()
+        with mock.patch.object(rendering, 'get_pool', return_value=broken), \
+                mock.patch.object(rendering, 'reset_pool') as reset_pool:
+            render_bulk_pdf_sharded(products, COMPANY, sharded, workers=3, threshold=0)
+        reset_pool.assert_called_once_with(broken)
+        # Части нарисованы в текущем процессе и склеены в исходном порядке
+        self.assertEqual(
+            [text for _, text in pdf_pages(sharded.getvalue())],
+            [text for _, text in pdf_pages(single.getvalue())],
+        )
+
+
+# ===========================================================
+# КЭШ РАЗОБРАННЫХ ТАБЛИЦ
+# ===========================================================
+
+class WorkbookCacheTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        patcher = mock.patch.object(workbook, 'CACHE_DIR', os.path.join(self.tmp, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.path = os.path.join(self.tmp, 'orders.xlsx')
+        pd.DataFrame({'Артикул': ['A-1', 'B-2'], 'Баркод': ['4006381333931', '96385074']}).to_excel(
+            self.path, index=False)
+
+    def test_parsed_once(self):
+        with mock.patch.object(workbook.pd, 'read_excel', wraps=pd.read_excel) as read_excel:
+            first = workbook.read_workbook(self.path, 0)
+            second = workbook.read_workbook(self.path, 0)
+            self.assertEqual(read_excel.call_count, 1)
+            # Другая строка заголовков - другая запись кэша
+            workbook.read_workbook(self.path, 1)
+            self.assertEqual(read_excel.call_count, 2)
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(len(os.listdir(workbook.CACHE_DIR)), 2)
+
+    def test_evict_workbook(self):
+        workbook.read_workbook(self.path, 0)
+        workbook.read_workbook(self.path, 1)
+        workbook.evict_workbook(self.path)
+        self.assertEqual(os.listdir(workbook.CACHE_DIR), [])
+
+    def test_size_limit(self):
+        with override_settings(WORKBOOK_CACHE_MAX_BYTES=0):
+            workbook.read_workbook(self.path, 0)
+        self.assertEqual(os.listdir(workbook.CACHE_DIR), [])
+
+
+# ===========================================================
+# ГРУППИРОВКА ТОВАРОВ
+# ===========================================================
+
+def group_products_loop(df, selected_columns, column_mapping):
+    """Прежняя группировка обходом строк (эталон для group_products)"""
+    size_column = column_mapping.get('size')
+    grouped = {}
+    for item in df[selected_columns].fillna('').to_dict('records'):
+        article = str(item.get(column_mapping['article'], '')).strip().lower()
+        barcode = str(item.get(column_mapping['barcode'], '')).strip().lower()
+        color = str(item.get('Цвет', '')).strip().lower()
+        size = str(item.get(size_column, '')).strip().lower() if size_column else ''
+
+        key = f"{article}|{barcode}|{color}|{size}"
+        if key not in grouped:
+            grouped[key] = {'data': item.copy(), 'quantity': 0}
+            if size_column:
+                grouped[key]['data']['Размер'] = size
+        grouped[key]['quantity'] += 1
+    return list(grouped.values())
+
+
+def sample_rows(count, seed=0):
+    """Случайная таблица с повторами, разным регистром, пробелами и пустыми ячейками"""
+    rng = np.random.default_rng(seed)
+    articles = ['A-1', 'a-1 ', 'B-2', 'C-3', '']
+    colors = ['Красный', 'красный', ' Синий', '']
+    sizes = ['S', 's', 'M ', 'XL', '']
+    return pd.DataFrame({
+        'Артикул': rng.choice(articles, count),
+        'Баркод': rng.choice(['4006381333931', '2000000000026', '96385074'], count),
+        'Наименование': rng.choice(['Футболка', 'Платье'], count),
+        'Цвет': rng.choice(colors, count),
+        'Размер': rng.choice(sizes, count),
+    }).replace('', np.nan)
+
+
+class GroupProductsTests(TestCase):
+    def test_matches_loop(self):
+        df = sample_rows(2000)
+        self.assertEqual(
+            group_products(df, SELECTED_COLUMNS, COLUMN_MAPPING),
+            group_products_loop(df, SELECTED_COLUMNS, COLUMN_MAPPING),
+        )
+
+    def test_matches_loop_without_size(self):
+        df = sample_rows(500, seed=1)
+        mapping = {**COLUMN_MAPPING, 'size': ''}
+        columns = ['Артикул', 'Баркод', 'Наименование', 'Цвет']
+        self.assertEqual(
+            group_products(df, columns, mapping),
+            group_products_loop(df, columns, mapping),
+        )
+
+    def test_empty_cells_are_empty_strings(self):
+        df = pd.DataFrame({'Артикул': [np.nan], 'Баркод': ['2000000000026'], 'Наименование': ['Футболка'],
+                           'Цвет': [np.nan], 'Размер': [np.nan]})
+        product, = group_products(df, SELECTED_COLUMNS, COLUMN_MAPPING)
+        self.assertEqual(product['data']['Артикул'], '')
+        self.assertEqual(product['data']['Цвет'], '')
+        self.assertEqual(product['quantity'], 1)
+
+
+# ===========================================================
+# ХРАНИЛИЩЕ ЗАДАНИЙ
+# ===========================================================
+
+class JobStoreTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.jobs_dir = tmp.name
+        patcher = mock.patch.object(jobs, 'JOBS_DIR', self.jobs_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create_and_update(self):
+        products = label_products([2, 1])
+        job_id = jobs.create_job(products, False)
+        job = jobs.load_job(job_id)
+        self.assertEqual(job['processed_data'], products)
+        self.assertFalse(job['is_template_mode'])
+        self.assertFalse(job['from_library'])
+        self.assertTrue(jobs.load_job(jobs.create_job(products, False, from_library=True))['from_library'])
+
+        jobs.update_job(job_id, state='done', result={'created': 1})
+        job = jobs.load_job(job_id)
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result'], {'created': 1})
+        self.assertEqual(job['processed_data'], products)
+        self.assertIsNone(jobs.update_job('0' * 32, state='done'))
+
+    def test_rejects_foreign_ids(self):
+        self.assertIsNone(jobs.load_job('../settings'))
+        self.assertIsNone(jobs.load_job(''))
+
+    def test_concurrent_updates(self):
+        job_id = jobs.create_job(label_products([1]), False)
+
+        def worker(number):
+            for step in range(20):
+                jobs.update_job(job_id, **{f"field{number}": step})
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNotNone(jobs.load_job(job_id))
+        self.assertEqual(os.listdir(self.jobs_dir), [f"{job_id}.json"])
+
+    def test_cleanup_jobs(self):
+        old = jobs.create_job(label_products([1]), False)
+        fresh = jobs.create_job(label_products([1]), False)
+        expired = time.time() - 3600
+        os.utime(os.path.join(self.jobs_dir, f"{old}.json"), (expired, expired))
+
+        jobs.cleanup_jobs(ttl=60)
+        self.assertIsNone(jobs.load_job(old))
+        self.assertIsNotNone(jobs.load_job(fresh))
+
+
+# ===========================================================
+# ФОНОВЫЕ ЗАДАНИЯ
+# ===========================================================
+
+# Библиотека шаблонов в media/patterns не затрагивается
+@override_settings(LABEL_BULK_FROM_LIBRARY=False)
+class BackgroundJobTests(TransactionTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for module in (jobs, tasks):
+            patcher = mock.patch.object(module, 'JOBS_DIR', tmp.name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def wait(self, job_id):
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            progress = tasks.job_progress(job_id)
+            if progress['state'] in ('done', 'error'):
+                return progress
+            time.sleep(0.05)
+        self.fail('Задание не завершилось')
+
+    def test_bulk_job(self):
+        job_id = jobs.create_job(label_products([2, 3]), False)
+        tasks.submit_job(job_id, COMPANY)
+        progress = self.wait(job_id)
+
+        self.assertEqual(progress['state'], 'done')
+        self.assertEqual((progress['done'], progress['total']), (5, 5))
+        path, output_format = tasks.find_output(job_id)
+        self.assertEqual(output_format, 'pdf')
+        with open(path, 'rb') as f:
+            self.assertEqual(len(PdfReader(f).pages), 5)
+        self.assertEqual(jobs.load_job(job_id)['state'], 'done')
+
+    def test_zpl_job(self):
+        job_id = jobs.create_job(label_products([2, 3]), False, 'zpl')
+        tasks.submit_job(job_id, COMPANY)
+        self.assertEqual(self.wait(job_id)['state'], 'done')
+
+        path, output_format = tasks.find_output(job_id)
+        self.assertEqual(output_format, 'zpl')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read().count(b'^XA'), 2)
+
+    def test_failed_job(self):
+        job_id = jobs.create_job(label_products([1]), False)
+        with mock.patch.object(tasks, 'build_bulk', side_effect=RuntimeError('нет шрифта')):
+            tasks.submit_job(job_id, COMPANY)
+            progress = self.wait(job_id)
+
+        self.assertEqual(progress['state'], 'error')
+        self.assertEqual(progress['error'], 'нет шрифта')
+        self.assertIsNone(tasks.find_output(job_id))
+        self.assertEqual(jobs.load_job(job_id)['state'], 'error')
+
+    def test_interrupted_job(self):
+        # Задание осталось незавершённым в хранилище после перезапуска сервера
+        job_id = jobs.create_job(label_products([1]), False)
+        jobs.update_job(job_id, state='running', total=1)
+        self.assertEqual(tasks.job_progress(job_id)['state'], 'error')
+        self.assertIsNone(tasks.job_progress('0' * 32))
+
+
+class GeneratePdfViewTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for module in (jobs, tasks):
+            patcher = mock.patch.object(module, 'JOBS_DIR', tmp.name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        legal_data = {'current': COMPANY, 'all': [COMPANY]}
+        patcher = mock.patch('generator.views.get_legal_entities', return_value=legal_data)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, products, **options):
+        """Задание в сессии, как после отправки страницы редактирования"""
+        job_id = jobs.create_job(products, False)
+        session = self.client.session
+        session.update({'job_id': job_id, 'output_format': 'pdf', **options})
+        session.save()
+        return job_id
+
+    def test_bulk_download(self):
+        self.start(label_products([2, 3]))
+        stdout = StringIO()
+        with mock.patch('sys.stdout', stdout), self.assertLogs('generator.views', level='INFO') as logs:
+            response = self.client.get('/generate-pdf/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(pdf_pages(b''.join(response.streaming_content))), 5)
+        # Итог пишется в журнал, а не в stdout
+        self.assertIn('всего этикеток 5', '\n'.join(logs.output))
+        self.assertEqual(stdout.getvalue(), '')
+
+    def finished_job(self, result=None):
+        """Завершённое фоновое задание текущей сессии с готовым файлом"""
+        job_id = jobs.create_job(label_products([1]), False, session_key=self.client.session.session_key)
+        jobs.update_job(job_id, state='done', total=1, result=result or {})
+        with open(tasks.output_path(job_id), 'wb') as f:
+            f.write(b'%PDF')
+        return job_id
+
+    def test_jobs_of_other_sessions(self):
+        job_id = self.finished_job()
+        templates_id = self.finished_job({'files': []})
+        urls = [
+            reverse('job_status', args=[job_id]),
+            reverse('job_download', args=[job_id]),
+            reverse('job_templates', args=[templates_id]),
+        ]
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 200)
+            # Идентификатор задания из чужой сессии не даёт доступа к нему
+            self.assertEqual(Client().get(url).status_code, 404)
+
+    def test_edit_data_binds_job_to_session(self):
+        grid_id = jobs.create_job(label_products([1, 2]), False)
+        session = self.client.session
+        session.update({
+            'grid_id': grid_id, 'header_row': 0, 'selected_columns': ['Баркод'],
+            'column_mapping': {'barcode': 'Баркод', 'size': ''},
+        })
+        session.save()
+        with mock.patch('generator.views.has_upload', return_value=True):
+            self.client.post(reverse('edit_data'), {'changes': '{}', 'generation_mode': 'bulk'})
+        job = jobs.load_job(self.client.session['job_id'])
+        self.assertEqual(job['session'], self.client.session.session_key)
+
+
+# ===========================================================
+# КЭШ ШТРИХ-КОДОВ
+# ===========================================================
+
+class BarcodeCacheTests(TestCase):
+    def setUp(self):
+        encode_barcode.cache_clear()
+
+    def test_cache_hits(self):
+        first = encode_barcode('4600000000000', BARCODE_HEIGHT, BARCODE_BAR_WIDTH)
+        second = encode_barcode('4600000000000', BARCODE_HEIGHT, BARCODE_BAR_WIDTH)
+        self.assertIs(first, second)
+        info = encode_barcode.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+        # Другая геометрия - другая запись кэша
+        encode_barcode('4600000000000', BARCODE_HEIGHT, BARCODE_BAR_WIDTH * 2)
+        self.assertEqual(encode_barcode.cache_info().misses, 2)
+
+    def test_bulk_pdf_encodes_each_barcode_once(self):
+        render_bulk_pdf(label_products([3, 2]) + label_products([1]), COMPANY, BytesIO())
+        info = encode_barcode.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+
+    def test_bars(self):
+        encoded = encode_barcode('4600000000000', BARCODE_HEIGHT, BARCODE_BAR_WIDTH)
+        self.assertEqual(encoded.height, BARCODE_HEIGHT)
+        # Полосы идут слева направо, не перекрываются и кратны ширине модуля
+        for (x, width), (next_x, _) in zip(encoded.bars, encoded.bars[1:]):
+            self.assertLess(x + width, next_x + 1e-9)
+        for x, width in encoded.bars:
+            self.assertAlmostEqual(width / BARCODE_BAR_WIDTH, round(width / BARCODE_BAR_WIDTH))
+        self.assertLessEqual(encoded.bars[-1][0] + encoded.bars[-1][1], encoded.width)
+
+    def test_bars_match_reportlab_drawing(self):
+        for value in ['4600000000000', '96385074', 'ART-001/XL']:
+            encoded = encode_barcode(value, BARCODE_HEIGHT, BARCODE_BAR_WIDTH)
+            drawing = createBarcodeDrawing('Code128', value=value, barHeight=BARCODE_HEIGHT, barWidth=BARCODE_BAR_WIDTH)
+            rects = [shape for shape in drawing.contents[0].draw().contents if isinstance(shape, Rect)]
+            # Полосы совпадают с отрисовкой reportlab (без фонового прямоугольника во всю ширину)
+            self.assertEqual(
+                [(round(rect.x, 6), round(rect.width, 6)) for rect in rects if rect.width < drawing.width],
+                [(round(x, 6), round(width, 6)) for x, width in encoded.bars],
+            )
+            self.assertAlmostEqual(drawing.width, encoded.width)
+
+
+# ===========================================================
+# ПУЛ ПРОЦЕССОВ
+# ===========================================================
+
+class PoolTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def tasks(self, count):
+        return [
+            (product['data'], COMPANY, os.path.join(self.tmp, f"{index}.pdf"), None)
+            for index, product in enumerate(label_products([1] * count))
+        ]
+
+    def test_pool_size_is_capped(self):
+        self.assertEqual(pool.pool_size(1), 1)
+        self.assertEqual(pool.pool_size(1000), pool.MAX_WORKERS)
+        self.assertLessEqual(pool.pool_size(None), pool.MAX_WORKERS)
+
+    def test_pool_is_shared(self):
+        first = pool.get_pool(2)
+        self.addCleanup(pool.reset_pool, first)
+        self.assertIs(pool.get_pool(2), first)
+        self.assertEqual(first._mp_context.get_start_method(), 'spawn')
+
+    def test_templates_reuse_pool(self):
+        pools = []
+
+        def get_pool(workers):
+            pools.append(pool.get_pool(workers))
+            return pools[-1]
+
+        with mock.patch.object(rendering, 'get_pool', get_pool):
+            for _ in range(2):
+                results = rendering.render_template_files(self.tasks(3), workers=2)
+                self.assertEqual([error for _, error, _ in results], [None] * 3)
+        self.addCleanup(pool.reset_pool, pools[0])
+        # Оба вызова получили один и тот же пул
+        self.assertIs(pools[0], pools[1])
+
+    def test_broken_pool_falls_back(self):
+        broken = mock.Mock()
+        broken.map.side_effect = BrokenProcessPool('процесс завершился')
+        with mock.patch.object(rendering, 'get_pool', return_value=broken), \
+                mock.patch.object(rendering, 'reset_pool') as reset_pool:
+            results = rendering.render_template_files(self.tasks(3), workers=2)
+        reset_pool.assert_called_once_with(broken)
+        # Шаблоны нарисованы в текущем процессе
+        self.assertEqual([error for _, error, _ in results], [None] * 3)
+        self.assertTrue(all(os.path.exists(filepath) for filepath, _, _ in results))
+
+
+# ===========================================================
+# БИБЛИОТЕКА ШАБЛОНОВ
+# ===========================================================
+
+class TemplateLibraryTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.templates_dir = tmp.name
+
+    def save(self, entries):
+        """Сохраняет шаблоны как sync_templates: файл на диске и запись индекса"""
+        for entry in entries:
+            with open(os.path.join(self.templates_dir, entry['filename']), 'wb') as f:
+                f.write(b'%PDF')
+            entry.setdefault('content', None)
+        save_records(entries, self.templates_dir)
+
+    def plan(self, products, company=COMPANY):
+        return plan_templates(products, company, self.templates_dir)
+
+    def test_new_products_are_rendered(self):
+        products = label_products([1, 1]) + label_products([1])
+        entries, skipped = self.plan(products)
+        # Повтор штрих-кода внутри задания пропускается
+        self.assertEqual(skipped, 1)
+        self.assertEqual([entry['render'] for entry in entries], [True, True])
+        self.assertTrue(all(entry['record'] is None for entry in entries))
+
+    def test_saved_templates_are_fresh(self):
+        products = label_products([1, 1])
+        entries, _ = self.plan(products)
+        self.save(entries)
+        self.assertEqual(TemplateRecord.objects.count(), 2)
+
+        entries, _ = self.plan(products)
+        self.assertEqual([entry['render'] for entry in entries], [False, False])
+
+    def test_stale_templates(self):
+        products = label_products([1, 1, 1])
+        entries, _ = self.plan(products)
+        self.save(entries)
+
+        products[0]['data']['Наименование'] = 'Новое название'
+        os.remove(os.path.join(self.templates_dir, entries[1]['filename']))
+        entries, _ = self.plan(products)
+        # Изменились данные товара или пропал файл - шаблон перерисовывается
+        self.assertEqual([entry['render'] for entry in entries], [True, True, False])
+        self.assertIsNotNone(entries[0]['record'])
+
+        # Другое юрлицо меняет все этикетки
+        entries, _ = self.plan(products, 'ООО "Другое"')
+        self.assertTrue(all(entry['render'] for entry in entries))
+
+    def test_renamed_template_replaces_file(self):
+        products = label_products([1])
+        entries, _ = self.plan(products)
+        self.save(entries)
+        old_filename = entries[0]['filename']
+
+        products[0]['data']['Наименование'] = 'Новое название'
+        entries, _ = self.plan(products)
+        self.save(entries)
+
+        record = TemplateRecord.objects.get(barcode='4600000000000')
+        self.assertEqual(record.filename, entries[0]['filename'])
+        self.assertEqual(record.input_hash, label_hash(products[0]['data'], COMPANY))
+        self.assertEqual(os.listdir(self.templates_dir), [record.filename])
+        self.assertNotEqual(record.filename, old_filename)
+
+    def test_sync_report(self):
+        products = label_products([1, 1])
+        report, _ = sync_templates(products, COMPANY, self.templates_dir)
+        self.assertEqual((report['created'], report['updated'], report['skipped']), (2, 0, 0))
+
+        products[1]['data']['Наименование'] = 'Новое название'
+        report, entries = sync_templates(products, COMPANY, self.templates_dir)
+        self.assertEqual((report['created'], report['updated'], report['skipped']), (0, 1, 1))
+        self.assertEqual(sorted(os.listdir(self.templates_dir)), sorted(entry['filename'] for entry in entries))
+
+
+class BulkFromLibraryTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.templates_dir = tmp.name
+
+    def test_prepare_bulk_reads_library(self):
+        products = label_products([2, 3])
+        sync_templates(products, COMPANY, self.templates_dir, workers=1)
+        records = {record.barcode: record.updated for record in TemplateRecord.objects.all()}
+        files = sorted(os.listdir(self.templates_dir))
+
+        # Третьего товара нет в библиотеке, у первого изменилось количество
+        products = label_products([5, 3, 1])
+        found, contents = prepare_bulk(products, COMPANY, self.templates_dir)
+        self.assertEqual(found, 2)
+        self.assertEqual(set(contents), {label_hash(product['data'], COMPANY) for product in products[:2]})
+
+        # Библиотека только читается
+        self.assertEqual({record.barcode: record.updated for record in TemplateRecord.objects.all()}, records)
+        self.assertEqual(sorted(os.listdir(self.templates_dir)), files)
+
+    def test_edited_product_not_taken(self):
+        products = label_products([1])
+        sync_templates(products, COMPANY, self.templates_dir, workers=1)
+        # Цвет изменён на странице редактирования: штрих-код тот же, этикетка другая
+        products[0]['data']['Цвет'] = 'Красный'
+        self.assertEqual(prepare_bulk(products, COMPANY, self.templates_dir), (0, {}))
+
+    def test_library_labels_match_fresh_rendering(self):
+        products = label_products([2, 1])
+        products[1]['data']['Наименование'] = 'Футболка хлопковая с длинным рукавом и принтом «Лето»'
+        sync_templates(products, COMPANY, self.templates_dir, workers=1)
+        _, contents = prepare_bulk(products, COMPANY, self.templates_dir)
+        self.assertEqual(len(contents), 2)
+
+        fresh = BytesIO()
+        render_bulk_pdf(products, COMPANY, fresh)
+        cached = BytesIO()
+        render_bulk_pdf(products, COMPANY, cached, contents=contents)
+        # Сохранённые команды отрисовки дают те же формы, что и вёрстка заново
+        self.assertEqual(form_streams(cached.getvalue()), form_streams(fresh.getvalue()))
+        self.assertEqual(
+            [text for _, text in pdf_pages(cached.getvalue())],
+            [text for _, text in pdf_pages(fresh.getvalue())],
+        )
+
+    def test_fingerprint_covers_reportlab_and_font(self):
+        self.addCleanup(layout_fingerprint.cache_clear)
+        data = label_products([1])[0]['data']
+        original = label_hash(data, COMPANY)
+
+        # Другая версия reportlab
+        layout_fingerprint.cache_clear()
+        with mock.patch('reportlab.Version', '0.0.0'):
+            self.assertNotEqual(label_hash(data, COMPANY), original)
+
+        # Другой файл шрифта
+        with tempfile.TemporaryDirectory() as tmp:
+            face = pdfmetrics.getFont('Arial').face
+            font_path = os.path.join(tmp, 'arial.ttf')
+            with open(face.filename, 'rb') as source, open(font_path, 'wb') as target:
+                target.write(source.read() + b'\0')
+            layout_fingerprint.cache_clear()
+            with mock.patch.object(face, 'filename', font_path):
+                self.assertNotEqual(label_hash(data, COMPANY), original)
+
+        layout_fingerprint.cache_clear()
+        self.assertEqual(label_hash(data, COMPANY), original)
+
+    @override_settings(LABEL_BULK_FROM_LIBRARY=False)
+    def test_from_library_option(self):
+        products = label_products([2, 1])
+        sync_templates(products, COMPANY, self.templates_dir, workers=1)
+
+        with mock.patch.object(tasks, 'prepare_bulk', wraps=prepare_bulk) as prepare:
+            tasks.build_bulk_pdf(products, COMPANY, BytesIO(), templates_dir=self.templates_dir)
+            prepare.assert_not_called()
+            tasks.build_bulk_pdf(products, COMPANY, BytesIO(), templates_dir=self.templates_dir, from_library=True)
+            prepare.assert_called_once()
+
+
+# ===========================================================
+# ZPL
+# ===========================================================
+
+class ZplTests(TestCase):
+    def render(self, products, **options):
+        output = BytesIO()
+        render_bulk_zpl(products, COMPANY, output, dpi=203, **options)
+        return output.getvalue().decode('utf-8')
+
+    def test_one_format_per_product(self):
+        zpl = self.render(label_products([2, 0, 5]))
+        formats = [block for block in zpl.split('^XZ') if block.strip()]
+        self.assertEqual(len(formats), 2)
+        # Копии печатает принтер
+        self.assertIn('^PQ2\n', formats[0])
+        self.assertIn('^PQ5\n', formats[1])
+        self.assertIn('^BCN', formats[0])
+        self.assertIn('^FD4600000000002^FS', formats[1])
+
+    def test_wrapped_name(self):
+        products = label_products([1])
+        products[0]['data']['Наименование'] = 'Футболка хлопковая с длинным рукавом и принтом для детей и взрослых'
+        zpl = self.render(products)
+        block = next(line for line in zpl.split('\n') if 'Футболка' in line)
+        # Переносы строк берутся у reportlab: число строк в ^FB совпадает с числом \&
+        lines = int(block.split('^FB')[1].split(',')[1])
+        self.assertGreater(lines, 1)
+        self.assertEqual(block.count('\\&'), lines - 1)
+
+    def test_special_characters_escaped(self):
+        products = label_products([1])
+        products[0]['data']['Артикул'] = 'A_1^2~3'
+        zpl = self.render(products)
+        self.assertIn('^FH^FDАртикул: A_5F1_5E2_7E3^FS', zpl)
+
+    def test_text_font(self):
+        products = label_products([3])
+        text_lines = [line for line in self.render(products).split('\n') if '^FB' in line]
+        # Текст с кириллицей печатается масштабируемым шрифтом, а не встроенным шрифтом 0
+        self.assertTrue(text_lines)
+        for line in text_lines:
+            self.assertRegex(line, r'^\^FO\d+,\d+\^A@N,\d+,\d+,E:TT0003M_\.FNT\^FB\d+,\d+,\d+,C,0\^F')
+
+        zpl = self.render(products, font='E:ARIAL.TTF')
+        self.assertIn('^A@N,', zpl)
+        self.assertIn(',E:ARIAL.TTF^FB', zpl)
+        self.assertIn('^PQ3\n', zpl)
+        # Встроенный шрифт задаётся одной буквой
+        zpl = self.render(products, font='0')
+        self.assertNotIn('^A@', zpl)
+        self.assertIn('^A0N,', zpl)
+
+    @override_settings(LABEL_ZPL_FONT='E:ARIAL.TTF')
+    def test_font_setting(self):
+        output = BytesIO()
+        tasks.build_bulk(label_products([2]), COMPANY, output, 'zpl')
+        zpl = output.getvalue().decode('utf-8')
+        self.assertIn(',E:ARIAL.TTF^FB', zpl)
+        self.assertIn('^PQ2\n', zpl)
+
+
+# ===========================================================
+# РАСТРОВЫЙ ВЫВОД
+# ===========================================================
+
+class RasterTests(TestCase):
+    def test_tiff_round_trip(self):
+        rng = np.random.default_rng(0)
+        images = [Image.fromarray(rng.random((120, 200)) > 0.5) for _ in range(3)]
+        output = BytesIO()
+        write_tiff([encode_group4(image, 203) for image in images + images[:1]], output, 203)
+
+        with Image.open(BytesIO(output.getvalue())) as tiff:
+            self.assertEqual(tiff.n_frames, 4)
+            for index, image in enumerate(images + images[:1]):
+                tiff.seek(index)
+                self.assertEqual(tiff.info['compression'], 'group4')
+                self.assertEqual(tuple(tiff.info['dpi']), (203, 203))
+                self.assertTrue(np.array_equal(np.asarray(tiff.convert('1')), np.asarray(image)))
+
+    def test_bulk_tiff_pages(self):
+        output = BytesIO()
+        render_bulk_tiff(label_products([2, 0, 1]), COMPANY, output, dpi=203)
+        with Image.open(BytesIO(output.getvalue())) as tiff:
+            self.assertEqual(tiff.n_frames, 3)
+            # Размер страницы - этикетка 58x40 мм в точках принтера
+            self.assertEqual(tiff.size, (round(58 / 25.4 * 203), round(40 / 25.4 * 203)))
+
+    def test_bulk_png_pages(self):
+        output = BytesIO()
+        render_bulk_png(label_products([2, 1]), COMPANY, output, dpi=203)
+        with zipfile.ZipFile(BytesIO(output.getvalue())) as archive:
+            self.assertEqual(archive.namelist(), ['00001.png', '00002.png', '00003.png'])
+            # Копии одного товара - одинаковые изображения
+            self.assertEqual(archive.read('00001.png'), archive.read('00002.png'))
+            self.assertNotEqual(archive.read('00002.png'), archive.read('00003.png'))
+
+
+# ===========================================================
+# МЕТРИКИ
+# ===========================================================
+
+class MetricsTests(TestCase):
+    def test_exposition(self):
+        with stage('test_stage', rows=10):
+            pass
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('labelmaker_stage_duration_seconds_count{stage="test_stage"}', response.content.decode())
+        self.assertIn('labelmaker_stage_items_total{stage="test_stage",kind="rows"}', response.content.decode())
+
+    def test_other_hosts_forbidden(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='192.168.1.10')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_HOSTS=['192.168.1.10'])
+    def test_allowed_hosts_setting(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='192.168.1.10').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+
+# ===========================================================
+# КОМАНДА GENERATE_LABELS
+# ===========================================================
+
+@override_settings(LABEL_BULK_FROM_LIBRARY=False)
+class GenerateLabelsTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        patcher = mock.patch.object(workbook, 'CACHE_DIR', os.path.join(self.tmp, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.tmp, 'orders.xlsx')
+        pd.DataFrame({
+            'Артикул': ['A-1', 'A-1', 'B-2'],
+            'Баркод': ['4006381333931', '4006381333931', '96385074'],
+            'Наименование': ['Футболка', 'Футболка', 'Платье'],
+        }).to_excel(self.path, index=False)
+
+    def run_command(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('generate_labels', *args, '--header-row', '1', '--entity', COMPANY,
+                     stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_bulk_pdf(self):
+        self.run_command(self.path, '--output-dir', self.tmp, '--copies', '1')
+        with open(os.path.join(self.tmp, 'orders.pdf'), 'rb') as f:
+            texts = [text for _, text in pdf_pages(f.read())]
+        self.assertEqual(len(texts), 3)
+        self.assertIn('Платье', texts[2])
+
+    def test_csv_file(self):
+        path = os.path.join(self.tmp, 'export.csv')
+        with open(path, 'w', encoding='cp1251') as f:
+            f.write('Артикул;Штрихкод;Наименование;Размер\nA-1;04006381333931;Футболка;S\nA-1;04006381333931;Футболка;s\n')
+        self.run_command(path, '--output-dir', self.tmp, '--barcode', 'Штрихкод', '--size', 'Размер')
+        with open(os.path.join(self.tmp, 'export.pdf'), 'rb') as f:
+            texts = [text for _, text in pdf_pages(f.read())]
+        # Обе строки - один товар, по две этикетки на строку
+        self.assertEqual(len(texts), 4)
+        self.assertIn('04006381333931', texts[0])
+
+    def test_broken_file_does_not_stop_others(self):
+        broken = os.path.join(self.tmp, 'broken.xlsx')
+        with open(broken, 'wb') as f:
+            f.write(b'not a workbook')
+        with self.assertRaisesMessage(CommandError, 'Не обработано файлов: 1 из 2'):
+            self.run_command(broken, self.path, '--output-dir', self.tmp)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'orders.pdf')))
+
+    def test_invalid_barcodes(self):
+        path = os.path.join(self.tmp, 'invalid.xlsx')
+        pd.DataFrame({
+            'Артикул': ['A-1', 'B-2'], 'Баркод': ['4006381333932', '96385074'], 'Наименование': ['Футболка', 'Платье'],
+        }).to_excel(path, index=False)
+        with self.assertRaisesMessage(CommandError, 'Не обработано файлов: 1 из 1'):
+            self.run_command(path, '--output-dir', self.tmp)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'invalid.pdf')))
+
+        _, stderr = self.run_command(path, '--output-dir', self.tmp, '--skip-invalid', '--copies', '1')
+        self.assertIn('4006381333932: Неверная контрольная цифра', stderr)
+        with open(os.path.join(self.tmp, 'invalid.pdf'), 'rb') as f:
+            self.assertEqual(len(pdf_pages(f.read())), 1)
+
+    def test_templates_mode(self):
+        templates_dir = os.path.join(self.tmp, 'patterns')
+        stdout, _ = self.run_command(self.path, '--mode', 'templates', '--templates-dir', templates_dir)
+        self.assertIn('шаблонов создано 2', stdout)
+        self.assertEqual(TemplateRecord.objects.count(), 2)
+
+    def test_bulk_from_library(self):
+        templates_dir = os.path.join(self.tmp, 'patterns')
+        self.run_command(self.path, '--mode', 'templates', '--templates-dir', templates_dir)
+        with mock.patch.object(tasks, 'prepare_bulk', wraps=prepare_bulk) as prepare:
+            self.run_command(self.path, '--output-dir', self.tmp, '--templates-dir', templates_dir, '--from-library')
+        self.assertEqual(prepare.call_args.args[2], templates_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'orders.pdf')))
+
+
+# ===========================================================
+# CSV/TSV
+# ===========================================================
+
+class CsvTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_detect_encoding(self):
+        text = 'Артикул;Баркод\nФутболка;4006381333931\n'
+        self.assertEqual(detect_encoding(b'\xef\xbb\xbf' + text.encode('utf-8')), 'utf-8-sig')
+        self.assertEqual(detect_encoding(text.encode('utf-8')), 'utf-8')
+        self.assertEqual(detect_encoding(text.encode('cp1251')), 'cp1251')
+        # Образец, оборванный посреди символа, остаётся utf-8
+        self.assertEqual(detect_encoding(text.encode('utf-8')[:3]), 'utf-8')
+
+    def test_detect_delimiter(self):
+        self.assertEqual(detect_delimiter('a;b;c\n1;2;3\n', 'file.csv'), ';')
+        self.assertEqual(detect_delimiter('a,b,c\n1,2,3\n', 'file.csv'), ',')
+        self.assertEqual(detect_delimiter('a\tb\tc\n1\t2\t3\n', 'file.csv'), '\t')
+        self.assertEqual(detect_delimiter('a|b\n1|2\n', 'file.csv'), '|')
+        self.assertEqual(detect_delimiter('одна колонка\n', 'file.tsv'), '\t')
+
+    def test_csv_dialect(self):
+        path = self.write('cp1251.csv', 'Артикул;Баркод\nФутболка;4006381333931\n'.encode('cp1251'))
+        self.assertEqual(csv_dialect(path), ('cp1251', ';'))
+        path = self.write('bom.tsv', '﻿Артикул\tБаркод\nA\t1\n'.encode('utf-8'))
+        self.assertEqual(csv_dialect(path), ('utf-8-sig', '\t'))
+
+    @override_settings(CSV_CHUNK_ROWS=2)
+    def test_read_csv_chunks(self):
+        lines = ['Выгрузка', 'Артикул;Баркод;Цвет', 'A-1;0400638133393;Красный', ';;', 'A-1;0400638133393;красный',
+                 'B-2;96385074;Синий']
+        path = self.write('export.csv', '\n'.join(lines).encode('cp1251'))
+        chunks = list(read_csv_chunks(path, 1, ['Артикул', 'Баркод', 'Цвет']))
+        self.assertEqual(len(chunks), 2)
+        df = pd.concat(chunks)
+        # Ведущий ноль сохраняется: значения читаются строками
+        self.assertEqual(df['Баркод'].tolist(), ['0400638133393', '0400638133393', '96385074'])
+
+        mapping = {**COLUMN_MAPPING, 'size': ''}
+        products = group_chunks(chunks, ['Артикул', 'Баркод', 'Цвет'], mapping)
+        self.assertEqual([p['quantity'] for p in products], [2, 1])
+
+    def test_chunks_match_whole_table(self):
+        df = sample_rows(1000, seed=2)
+        chunks = [df.iloc[start:start + 128] for start in range(0, len(df), 128)]
+        self.assertEqual(
+            group_chunks(chunks, SELECTED_COLUMNS, COLUMN_MAPPING),
+            group_products(df, SELECTED_COLUMNS, COLUMN_MAPPING),
+        )
+
+
+# ===========================================================
+# НЕСКОЛЬКО ФАЙЛОВ В ОДНОЙ ПЕЧАТИ
+# ===========================================================
+
+class MergeGroupsTests(TestCase):
+    def test_sums_quantities_and_sources(self):
+        first = sample_rows(300, seed=3)
+        second = sample_rows(200, seed=4)
+        merged = merge_groups([
+            ('first.xlsx', *group_rows(first, SELECTED_COLUMNS, COLUMN_MAPPING)),
+            ('second.csv', *group_rows(second, SELECTED_COLUMNS, COLUMN_MAPPING)),
+        ])
+        expected = group_products(pd.concat([first, second]), SELECTED_COLUMNS, COLUMN_MAPPING)
+
+        self.assertEqual([p['data'] for p in merged], [p['data'] for p in expected])
+        self.assertEqual([p['quantity'] for p in merged], [p['quantity'] for p in expected])
+        for product in merged:
+            self.assertEqual(sum(product['sources'].values()), product['quantity'])
+        self.assertEqual(sum(p['sources'].get('first.xlsx', 0) for p in merged), 300)
+        self.assertEqual(sum(p['sources'].get('second.csv', 0) for p in merged), 200)
+
+    def test_float_and_text_barcodes_merge(self):
+        # Excel отдаёт штрих-код числом, CSV - строкой
+        excel = pd.DataFrame({'Артикул': ['A-1'], 'Баркод': [2000000000026.0], 'Наименование': ['Футболка']})
+        text = pd.DataFrame({'Артикул': ['A-1'], 'Баркод': [' 2000000000026'], 'Наименование': ['Футболка']})
+        mapping = {**COLUMN_MAPPING, 'size': ''}
+        columns = ['Артикул', 'Баркод', 'Наименование']
+        merged = merge_groups([
+            ('a.xlsx', *group_rows(excel, columns, mapping)),
+            ('b.csv', *group_rows(text, columns, mapping)),
+        ])
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]['quantity'], 2)
+        self.assertEqual(merged[0]['sources'], {'a.xlsx': 1, 'b.csv': 1})
+
+
+class ReadBatchTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        patcher = mock.patch.object(workbook, 'CACHE_DIR', os.path.join(self.tmp, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_xlsx(self, name, df):
+        path = os.path.join(self.tmp, name)
+        df.to_excel(path, index=False)
+        return path
+
+    @override_settings(LABEL_WORKERS=2)
+    def test_files_merged(self):
+        first = self.write_xlsx('first.xlsx', sample_rows(40, seed=5))
+        second = self.write_xlsx('second.xlsx', sample_rows(30, seed=6))
+        third = os.path.join(self.tmp, 'third.csv')
+        sample_rows(20, seed=7).to_csv(third, sep=';', index=False, encoding='cp1251')
+
+        paths = [first, second, third]
+        products, sources = workbook.read_batch(paths, 0, SELECTED_COLUMNS, COLUMN_MAPPING)
+        self.assertEqual([source['rows'] for source in sources], [40, 30, 20])
+        self.assertEqual(sum(product['quantity'] for product in products), 90)
+        # Разобранные в пуле таблицы попадают в кэш
+        self.assertEqual(len(os.listdir(workbook.CACHE_DIR)), 2)
+
+        expected = group_products(
+            pd.concat([sample_rows(40, seed=5), sample_rows(30, seed=6), sample_rows(20, seed=7)]),
+            SELECTED_COLUMNS, COLUMN_MAPPING,
+        )
+        self.assertEqual([p['quantity'] for p in products], [p['quantity'] for p in expected])
+
+    @override_settings(LABEL_WORKERS=2)
+    def test_pool_failure(self):
+        paths = [self.write_xlsx(name, sample_rows(10, seed=seed)) for seed, name in enumerate(['a.xlsx', 'b.xlsx'])]
+        with mock.patch.object(workbook, 'get_pool', side_effect=OSError('нет процессов')):
+            with self.assertLogs('generator.workbook', level='ERROR'):
+                products, sources = workbook.read_batch(paths, 0, SELECTED_COLUMNS, COLUMN_MAPPING)
+        # Файлы разобраны в текущем процессе
+        self.assertEqual([source['rows'] for source in sources], [10, 10])
+        self.assertEqual(sum(product['quantity'] for product in products), 20)
+
+    @override_settings(LABEL_WORKERS=2)
+    def test_broken_pool_is_reset(self):
+        paths = [self.write_xlsx(name, sample_rows(10, seed=seed)) for seed, name in enumerate(['a.xlsx', 'b.xlsx'])]
+        broken = mock.Mock()
+        broken.map.side_effect = BrokenProcessPool('процесс завершился')
+        with mock.patch.object(workbook, 'get_pool', return_value=broken), \
+                mock.patch.object(workbook, 'reset_pool') as reset_pool:
+            with self.assertLogs('generator.workbook', level='ERROR'):
+                _, sources = workbook.read_batch(paths, 0, SELECTED_COLUMNS, COLUMN_MAPPING)
+        # Следующий разбор получит новый пул, эти файлы разобраны в текущем процессе
+        reset_pool.assert_called_once_with(broken)
+        self.assertEqual([source['rows'] for source in sources], [10, 10])
+
+    def test_missing_columns(self):
+        first = self.write_xlsx('first.xlsx', sample_rows(5))
+        second = self.write_xlsx('second.xlsx', sample_rows(5).drop(columns=['Цвет', 'Размер']))
+        columns = workbook.required_columns(['Артикул', 'Цвет'], COLUMN_MAPPING)
+        self.assertEqual(workbook.missing_columns([first, second], 0, columns), [
+            'Файл second.xlsx: нет колонок Цвет, Размер (строка заголовков 1)',
+        ])
+        # Файл без колонки не доходит до группировки
+        with self.assertRaises(workbook.MissingColumnsError):
+            workbook.read_batch([first, second], 0, SELECTED_COLUMNS, COLUMN_MAPPING)
+
+
+
+# ===========================================================
+# ХРАНИЛИЩЕ ЮРЛИЦ
+# ===========================================================
+
+class LegalEntityStoreTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'legal_entities.json')
+        for name, value in (
+            ('SETTINGS_FILE', self.path),
+            ('_file_lock', utils.FileLock(f"{self.path}.lock", timeout=10)),
+            ('_cache', {'stamp': None, 'data': None}),
+        ):
+            patcher = mock.patch.object(utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_defaults_saved(self):
+        self.assertEqual(utils.get_legal_entities(), {'current': utils.DEFAULT_ENTITY, 'all': [utils.DEFAULT_ENTITY]})
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_update_and_remove(self):
+        utils.update_legal_entity('ООО "Ромашка"', add_to_list=True)
+        self.assertEqual(utils.get_legal_entities(), {
+            'current': 'ООО "Ромашка"', 'all': [utils.DEFAULT_ENTITY, 'ООО "Ромашка"'],
+        })
+        # Удаление текущего юрлица возвращает юрлицо по умолчанию
+        utils.remove_legal_entity('ООО "Ромашка"')
+        self.assertEqual(utils.get_legal_entities(), {'current': utils.DEFAULT_ENTITY, 'all': [utils.DEFAULT_ENTITY]})
+
+    def test_external_change_is_read(self):
+        utils.get_legal_entities()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'current': 'ИП Иванов', 'entities': ['ИП Иванов']}, f, ensure_ascii=False)
+        self.assertEqual(utils.get_legal_entities(), {'current': 'ИП Иванов', 'all': ['ИП Иванов']})
+
+    def test_cached_copy_is_not_shared(self):
+        data = utils.load_legal_entities()
+        data['entities'].append('Изменено вызывающим кодом')
+        self.assertEqual(utils.load_legal_entities()['entities'], [utils.DEFAULT_ENTITY])
+
+    def test_concurrent_updates(self):
+        names = [f"ООО \"Фирма {number}\"" for number in range(8)]
+        threads = [threading.Thread(target=utils.update_legal_entity, args=(name, True)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Ни одно добавление не потеряно
+        self.assertEqual(set(utils.get_legal_entities()['all']), {utils.DEFAULT_ENTITY, *names})
+
+    def test_lock_timeout(self):
+        utils.get_legal_entities()
+        # Файл юрлиц занят другим процессом дольше таймаута
+        other = utils.FileLock(f"{self.path}.lock")
+        with other, mock.patch.object(utils, '_file_lock', utils.FileLock(f"{self.path}.lock", timeout=0.05)):
+            with self.assertRaises(Timeout):
+                utils.update_legal_entity('ООО "Ромашка"', add_to_list=True)
+            with mock.patch('generator.views.get_legal_entities', return_value=utils.get_legal_entities()), \
+                    self.assertLogs('generator.views', level='ERROR'):
+                response = self.client.post('/', {'entity_action': 'add', 'new_entity': 'ООО "Ромашка"'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(utils.get_legal_entities()['all'], [utils.DEFAULT_ENTITY])
+
+    def test_save_error_is_logged(self):
+        with mock.patch.object(utils, 'SETTINGS_FILE', os.path.join(self.path, 'нет папки', 'legal_entities.json')):
+            with self.assertLogs('generator.utils', level='ERROR'):
+                self.assertFalse(utils.save_legal_entities(utils._default_data()))
+
+
+# ===========================================================
+# КЭШ ОТРИСОВАННЫХ ЭТИКЕТОК
+# ===========================================================
+
+class PageCacheTests(TestCase):
+    def test_round_trip(self):
+        save_pages({'a' * 64: 'BT /F1 12 Tf ET', 'b' * 64: 'q 1 0 0 1 0 0 cm Q'})
+        self.assertEqual(load_pages(['a' * 64, 'c' * 64]), {'a' * 64: 'BT /F1 12 Tf ET'})
+        # Повторное сохранение не заменяет запись
+        save_pages({'a' * 64: 'другое'})
+        self.assertEqual(load_pages(['a' * 64]), {'a' * 64: 'BT /F1 12 Tf ET'})
+
+    def test_load_marks_used(self):
+        save_pages({'a' * 64: 'A'})
+        LabelPage.objects.update(used=timezone.now() - timedelta(days=1))
+        load_pages(['a' * 64])
+        self.assertGreater(LabelPage.objects.get().used, timezone.now() - timedelta(minutes=1))
+
+    def test_evicts_least_recently_used(self):
+        now = timezone.now()
+        save_pages({key * 64: key * 1000 for key in 'abcd'})
+        for age, key in enumerate('dcba'):
+            LabelPage.objects.filter(key=key * 64).update(used=now - timedelta(hours=age))
+        size = LabelPage.objects.get(key='a' * 64).size
+
+        # Использованная запись становится самой свежей
+        load_pages(['a' * 64])
+        evict_pages(max_bytes=size * 2)
+        self.assertEqual(set(LabelPage.objects.values_list('key', flat=True)), {'a' * 64, 'd' * 64})
+
+    def test_evicts_on_save(self):
+        with override_settings(LABEL_PAGE_CACHE_MAX_BYTES=0):
+            save_pages({'a' * 64: 'A'})
+        self.assertFalse(LabelPage.objects.exists())
+
+    @override_settings(LABEL_BULK_FROM_LIBRARY=False)
+    def test_bulk_pdf_uses_cache(self):
+        products = label_products([2, 1])
+        first = BytesIO()
+        tasks.build_bulk_pdf(products, COMPANY, first)
+        self.assertEqual(LabelPage.objects.count(), 2)
+
+        # Повторная печать с другим количеством берёт этикетки из кэша
+        products[0]['quantity'] = 3
+        second = BytesIO()
+        with mock.patch('generator.rendering.draw_label') as draw_label:
+            tasks.build_bulk_pdf(products, COMPANY, second)
+        draw_label.assert_not_called()
+        first_texts = [text for _, text in pdf_pages(first.getvalue())]
+        self.assertEqual([text for _, text in pdf_pages(second.getvalue())], first_texts[:1] * 3 + first_texts[2:])
+
+    @override_settings(LABEL_BULK_FROM_LIBRARY=False)
+    def test_other_reportlab_version_misses_cache(self):
+        self.addCleanup(layout_fingerprint.cache_clear)
+        products = label_products([1])
+        tasks.build_bulk_pdf(products, COMPANY, BytesIO())
+
+        # Команды, записанные другой версией reportlab, не используются
+        layout_fingerprint.cache_clear()
+        with mock.patch('reportlab.Version', '0.0.0'):
+            with mock.patch('generator.rendering.draw_label', wraps=rendering.draw_label) as draw_label:
+                tasks.build_bulk_pdf(products, COMPANY, BytesIO())
+        draw_label.assert_called_once()
+        self.assertEqual(LabelPage.objects.count(), 2)
+
+
+# ===========================================================
+# РАБОЧИЕ ПАПКИ ЗАГРУЗОК
+# ===========================================================
+
+class WorkspaceTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = os.path.join(tmp.name, 'temp')
+        patcher = mock.patch.object(workspaces, 'WORKSPACES_DIR', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(workspaces, 'start_sweeper')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire(self, path, age):
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+    def test_cleanup_removes_expired(self):
+        old_id, old_path = workspaces.create_workspace()
+        fresh_id, fresh_path = workspaces.create_workspace()
+        with open(os.path.join(old_path, 'orders.xlsx'), 'wb') as f:
+            f.write(b'data')
+        self.expire(old_path, 3600)
+        self.expire(fresh_path, 3600)
+        # Обращение к папке продлевает её срок
+        self.assertTrue(workspaces.touch_workspace(fresh_id))
+
+        self.assertEqual(workspaces.cleanup_workspaces(ttl=60), 1)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(fresh_path))
+        self.assertFalse(workspaces.touch_workspace(old_id))
+
+    def test_cleanup_removes_legacy_files(self):
+        os.makedirs(self.root)
+        legacy = os.path.join(self.root, 'orders.xlsx')
+        with open(legacy, 'wb') as f:
+            f.write(b'data')
+        self.expire(legacy, 3600)
+        self.assertEqual(workspaces.cleanup_workspaces(ttl=60), 1)
+        self.assertFalse(os.path.exists(legacy))
+
+    def test_rejects_foreign_ids(self):
+        self.assertIsNone(workspaces.workspace_path('../media'))
+        self.assertFalse(workspaces.touch_workspace('../media'))
+
+    @override_settings(UPLOAD_MAX_BYTES=100)
+    def test_size_cap(self):
+        workspace_id, path = workspaces.create_workspace(60)
+        with open(os.path.join(path, 'orders.xlsx'), 'wb') as f:
+            f.write(b'x' * 60)
+        # Активная папка другой загрузки не удаляется
+        self.assertIsNone(workspaces.create_workspace(60))
+        self.expire(path, 2 * 24 * 60 * 60)
+        self.assertIsNotNone(workspaces.create_workspace(60))
+        self.assertFalse(os.path.exists(path))
+
+    def test_new_upload_replaces_previous(self):
+        patcher = mock.patch.object(workbook, 'CACHE_DIR', os.path.join(self.root, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        workspace_id, path = workspaces.create_workspace()
+        excel_path = os.path.join(path, 'orders.xlsx')
+        pd.DataFrame({'Баркод': ['4006381333931']}).to_excel(excel_path, index=False)
+        workbook.read_workbook(excel_path, 0)
+
+        session = self.client.session
+        session.update({'excel_path': excel_path, 'excel_paths': [excel_path], 'workspace': workspace_id})
+        session.save()
+        legal_data = {'current': COMPANY, 'all': [COMPANY]}
+        with mock.patch('generator.views.get_legal_entities', return_value=legal_data):
+            self.assertEqual(self.client.get('/').status_code, 200)
+
+        # Файлы прошлой загрузки и их разобранные копии удалены
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(workbook.CACHE_DIR), [])
+
+
+# ===========================================================
+# ИЗМЕНЕНИЯ ИЗ РЕДАКТОРА
+# ===========================================================
+
+class ApplyChangesTests(TestCase):
+    def setUp(self):
+        self.products = [
+            {'data': {'Цвет': 'красный', 'Размер': 's'}, 'quantity': 2},
+            {'data': {'Цвет': 'синий', 'Размер': 'm'}, 'quantity': 1},
+        ]
+
+    def test_applies_valid_changes(self):
+        errors = apply_changes(self.products, {'1': {'color': 'зелёный', 'size': 'L', 'quantity': '5'}}, 'Размер')
+        self.assertEqual(errors, [])
+        self.assertEqual(self.products[1], {'data': {'Цвет': 'зелёный', 'Размер': 'L'}, 'quantity': 5})
+        self.assertEqual(self.products[0]['quantity'], 2)
+
+    def test_size_kept_without_size_column(self):
+        apply_changes(self.products, {'0': {'color': '', 'size': 'XXL', 'quantity': '3'}}, '')
+        self.assertEqual(self.products[0]['data']['Размер'], 's')
+        self.assertEqual(self.products[0]['quantity'], 3)
+
+    def test_rejects_invalid_changes(self):
+        errors = apply_changes(self.products, {
+            '0': {'color': 'белый', 'quantity': '4'},
+            '1': {'quantity': '-1'},
+            '7': {'quantity': '1'},
+            'x': {'quantity': '1'},
+            '1x': 'не словарь',
+        }, 'Размер')
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(errors[0].startswith('Строка 2: Количество этикеток'))
+        self.assertIn('Строка 7: нет такого товара', errors)
+        self.assertIn('Неверный номер строки: x', errors)
+        # При ошибках верные изменения тоже не применяются
+        self.assertEqual(self.products[0], {'data': {'Цвет': 'красный', 'Размер': 's'}, 'quantity': 2})
+
+
+# ===========================================================
+# ПРОВЕРКА ШТРИХ-КОДОВ
+# ===========================================================
+
+class BarcodeTests(TestCase):
+    def test_normalize_float_values(self):
+        codes = normalize_barcodes([2000000000026.0, '2.000000000026e+12', ' 96385074 ', np.nan, 'ABC-1.5', 12.5])
+        self.assertEqual(codes.tolist(), ['2000000000026', '2000000000026', '96385074', '', 'ABC-1.5', '12.5'])
+
+    def test_valid_codes(self):
+        # EAN-13, EAN-8, UPC-A, GTIN-14 и произвольный Code128
+        codes = ['4006381333931', '96385074', '012345678905', '10012345678902', 'ART-001/XL']
+        self.assertEqual(barcode_errors(codes).tolist(), [''] * len(codes))
+
+    def test_check_digit(self):
+        errors = barcode_errors(['4006381333932', '96385075', '012345678900'])
+        self.assertEqual(errors.tolist(), [
+            'Неверная контрольная цифра (ожидается 1)',
+            'Неверная контрольная цифра (ожидается 4)',
+            'Неверная контрольная цифра (ожидается 5)',
+        ])
+
+    def test_length_and_characters(self):
+        errors = barcode_errors(['12345', '', 'Товар-1', 'X' * 49]).tolist()
+        self.assertTrue(errors[0].startswith('Неверная длина (цифр: 5'))
+        self.assertEqual(errors[1], 'Нет штрих-кода')
+        self.assertTrue(errors[2].startswith('Недопустимые символы'))
+        self.assertTrue(errors[3].startswith('Слишком длинный штрих-код'))
+
+    def test_check_products(self):
+        products = [
+            {'data': {'Баркод': 4006381333931.0}, 'quantity': 1},
+            {'data': {'Баркод': '4006381333932'}, 'quantity': 1, 'barcode_error': 'старая ошибка'},
+            {'data': {'Баркод': '96385074'}, 'quantity': 1, 'barcode_error': 'старая ошибка'},
+        ]
+        self.assertEqual(check_products(products, 'Баркод'), 1)
+        self.assertEqual(products[0]['data']['Баркод'], '4006381333931')
+        self.assertNotIn('barcode_error', products[0])
+        self.assertEqual(products[1]['barcode_error'], 'Неверная контрольная цифра (ожидается 1)')
+        self.assertNotIn('barcode_error', products[2])
+
+
+# ===========================================================
+# ZIP-АРХИВ
+# ===========================================================
+
+class StreamZipTests(TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {'a.pdf': os.urandom(200 * 1024), 'пустой.pdf': b'', 'b.pdf': b'%PDF-1.4 test'}
+            paths = []
+            for name, data in files.items():
+                path = os.path.join(tmp, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                paths.append(path)
+            paths.append(os.path.join(tmp, 'нет такого.pdf'))
+
+            with self.assertLogs('generator.archive', level='ERROR'):
+                data = b''.join(stream_zip(paths))
+
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), list(files))
+            for name, content in files.items():
+                self.assertEqual(archive.read(name), content)
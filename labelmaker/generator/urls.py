@@ -7,5 +7,10 @@ urlpatterns = [
     path('select-columns/', views.select_columns, name='select_columns'),
     path('label-settings/', views.label_settings, name='label_settings'),
     path('edit-data/', views.edit_data, name='edit_data'),
+    path('edit-data/rows/', views.edit_rows, name='edit_rows'),
     path('generate-pdf/', views.generate_pdf, name='generate_pdf'),
+    path('jobs/<str:job_id>/status/', views.job_status, name='job_status'),
+    path('jobs/<str:job_id>/download/', views.job_download, name='job_download'),
+    path('jobs/<str:job_id>/templates.zip', views.job_templates, name='job_templates'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,42 +1,83 @@
+import copy
 import json
+import logging
 import os
+import threading
 from pathlib import Path
 from django.conf import settings
+from filelock import FileLock
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_ENTITY = 'ООО "МЕДИЦИНСКИЕ РАСХОДНИКИ"'
 SETTINGS_FILE = Path(settings.MEDIA_ROOT) / 'legal_entities.json'
 
+# Блокировка файла юрлиц между потоками и процессами сервера
+_file_lock = FileLock(f"{SETTINGS_FILE}.lock", timeout=10)
+
+# Разобранный файл юрлиц: перечитывается, только если файл изменился
+_cache = {'stamp': None, 'data': None}
+_cache_lock = threading.Lock()
+
+def _locked():
+    """Блокировка файла юрлиц (папка media создаётся при необходимости)"""
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    return _file_lock
+
+def _file_stamp():
+    """Время изменения и размер файла (None, если файла нет)"""
+    try:
+        stat = os.stat(SETTINGS_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _default_data():
+    return {
+        'current': DEFAULT_ENTITY,
+        'entities': [DEFAULT_ENTITY]
+    }
+
 def save_legal_entities(data):
-    """Сохраняем данные в файл"""
+    """Сохраняем данные в файл (запись во временный файл и замена)"""
     try:
-        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"Файл сохранён: {SETTINGS_FILE}")
+        with _locked():
+            tmp_path = f"{SETTINGS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, SETTINGS_FILE)
+            with _cache_lock:
+                _cache['stamp'] = _file_stamp()
+                _cache['data'] = copy.deepcopy(data)
+        logger.info(f"Файл юрлиц сохранён: {SETTINGS_FILE}")
         return True
     except Exception as e:
-        print(f"ОШИБКА сохранения: {e}")
+        logger.error(f"Ошибка сохранения юрлиц: {str(e)}")
         return False
 
 def load_legal_entities():
-    """Загружаем данные из файла"""
-    if not SETTINGS_FILE.exists():
-        default_data = {
-            'current': DEFAULT_ENTITY,
-            'entities': [DEFAULT_ENTITY]
-        }
+    """Загружаем данные из файла (из кэша, если файл не менялся)"""
+    stamp = _file_stamp()
+    if stamp is None:
+        default_data = _default_data()
         save_legal_entities(default_data)
         return default_data
-    
+
+    with _cache_lock:
+        if _cache['stamp'] == stamp:
+            return copy.deepcopy(_cache['data'])
+
     try:
         with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            data = json.load(f)
     except Exception as e:
-        print(f"ОШИБКА загрузки: {e}")
-        return {
-            'current': DEFAULT_ENTITY,
-            'entities': [DEFAULT_ENTITY]
-        }
+        logger.error(f"Ошибка загрузки юрлиц: {str(e)}")
+        return _default_data()
+
+    with _cache_lock:
+        _cache['stamp'] = stamp
+        _cache['data'] = data
+        return copy.deepcopy(data)
 
 def get_legal_entities():
     """Получаем текущее юрлицо и список всех"""
@@ -48,23 +89,26 @@ def get_legal_entities():
 
 def update_legal_entity(new_entity, add_to_list=False):
     """Обновляем текущее юрлицо"""
-    data = load_legal_entities()
-    data['current'] = new_entity
+    # Чтение и запись под одной блокировкой: параллельные изменения не теряются
+    with _locked():
+        data = load_legal_entities()
+        data['current'] = new_entity
 
-    if add_to_list and new_entity not in data['entities']:
-        data['entities'].append(new_entity)
+        if add_to_list and new_entity not in data['entities']:
+            data['entities'].append(new_entity)
 
-    save_legal_entities(data)
+        save_legal_entities(data)
 
 def remove_legal_entity(entity_to_remove):
     """Удаляем юрлицо из списка"""
-    data = load_legal_entities()
-    
-    if entity_to_remove in data['entities']:
-        data['entities'].remove(entity_to_remove)
-        
-        # Если удаляем текущее, сбрасываем на значение по умолчанию
-        if data['current'] == entity_to_remove:
-            data['current'] = DEFAULT_ENTITY
-        
-        save_legal_entities(data)
\ No newline at end of file
+    with _locked():
+        data = load_legal_entities()
+
+        if entity_to_remove in data['entities']:
+            data['entities'].remove(entity_to_remove)
+
+            # Если удаляем текущее, сбрасываем на значение по умолчанию
+            if data['current'] == entity_to_remove:
+                data['current'] = DEFAULT_ENTITY
+
+            save_legal_entities(data)
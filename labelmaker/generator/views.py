@@ -1,68 +1,78 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.urls import reverse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, FileResponse, StreamingHttpResponse
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
-import pandas as pd
 import os
 import logging
+import tempfile
 import json
 from .utils import get_legal_entities, update_legal_entity, remove_legal_entity, load_legal_entities, save_legal_entities
 from textwrap import shorten
-from .forms import UploadForm, HeaderSelectForm, ColumnSelectForm, EditDataForm, LabelSettingsForm
-from django.forms import formset_factory
-from reportlab.pdfgen import canvas
-from reportlab.graphics.barcode import code128
-from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import Paragraph
+from .forms import UploadForm, HeaderSelectForm, ColumnSelectForm, LabelSettingsForm
+from .jobs import create_job, load_job, job_exists
+from .grid import create_grid, page_rows, apply_changes
+from .barcodes import check_products
+from .metrics import stage, exposition
+from .archive import stream_zip
+from .tasks import TEMPLATES_DIR, OUTPUT_FORMATS, TEMPLATE_ARCHIVE, build_bulk, build_templates, submit_job, job_progress, find_output
+from .workbook import (
+    read_products, read_batch, evict_workbook, file_digest, preview_rows, preview_workbook, guess_header_row,
+    missing_columns, required_columns, MissingColumnsError,
+)
+from .workspaces import create_workspace, touch_workspace, remove_workspace
 from django.views.decorators.csrf import csrf_exempt
+from filelock import Timeout
 from django.http import JsonResponse
 
 # Инициализация логгера для записи событий
 logger = logging.getLogger(__name__)
 
-
 # ===========================================================
-# ГЛОБАЛЬНЫЕ КОНСТАНТЫ ДЛЯ ДИЗАЙНА ЭТИКЕТОК
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ===========================================================
 
-# Размеры страницы и отступы
-PAGE_WIDTH = 58 * mm       # Ширина этикетки (58 мм)
-PAGE_HEIGHT = 40 * mm      # Высота этикетки (40 мм)
-MARGIN = 0.2 * mm            # Отступ от края страницы
-PADDING_RIGHT = 5 * mm     # Правый отступ для текста
-PADDING_LEFT = 5 * mm      # Левый отступ для текста
-
-# Размеры шрифтов
-COMPANY_FONT_SIZE = 8.2    # Размер шрифта для названия компании
-PRODUCT_FONT_SIZE = 7.4    # Размер шрифта для названия товара
-ARTICLE_FONT_SIZE = 7.5    # Размер шрифта для артикула
-EXTRA_FONT_SIZE = 8        # Размер шрифта для дополнительной информации
-
-# Параметры штрих-кода (одинаковые для всех режимов генерации)
-BARCODE_HEIGHT = 8.3 * mm        # Высота штрих-кода
-BARCODE_BAR_WIDTH = 0.75       # Толщина штрихов (меньше = тоньше)
-BARCODE_TEXT_SIZE = 9          # Размер шрифта для цифр под штрих-кодом
-BARCODE_TOP_MARGIN = 12 * mm   # Отступ штрих-кода от верхнего края
-BARCODE_TEXT_OFFSET = 4 * mm   # Отступ текста от штрих-кода
-AFTER_BARCODE_SPACE = 17 * mm  # Отступ после блока штрих-кода
-
-# Дополнительные параметры вёрстки
-LINE_SPACING = 1 * mm          # Универсальный межстрочный интервал
-PRODUCT_SIDE_PADDING = 5 * mm  # Боковые отступы для названия товара
-
-# Дополнительные отступы для элементов (необязательные, могут использоваться в будущем)
-ELEMENT_OFFSETS = {
-    'after_barcode': 3 * mm,
-    'after_company': 1.5 * mm,
-    'after_product': 1 * mm,
-    'after_article': 1 * mm
-}
-
-# Путь для сохранения шаблонов этикеток
-TEMPLATES_DIR = os.path.join(settings.MEDIA_ROOT, 'patterns')
+def unique_names(names):
+    """Имена файлов для сводки по источникам: повторы получают номер"""
+    result = []
+    for name in names:
+        candidate, number = name, 2
+        while candidate in result:
+            candidate = f"{name} ({number})"
+            number += 1
+        result.append(candidate)
+    return result
+
+
+def has_upload(request, *keys):
+    """
+    Есть ли в сессии загруженные файлы и ключи keys.
+    Отмечает использование рабочей папки; если её уже удалила очистка, файлов нет.
+    """
+    if not all(key in request.session for key in ('excel_path', *keys)):
+        return False
+    return touch_workspace(request.session.get('workspace'))
+
+
+def load_products(request):
+    """
+    Сгруппированные товары загруженных файлов сессии.
+    Возвращает (products, sources) - см. read_batch.
+    """
+    args = (
+        request.session['header_row'],
+        request.session['selected_columns'],
+        request.session['column_mapping'],
+    )
+    paths = request.session.get('excel_paths')
+    if not paths or len(paths) == 1:
+        path = request.session['excel_path']
+        products = read_products(path, *args, request.session.get('excel_hash'))
+        rows = sum(product['quantity'] for product in products)
+        name = request.session.get('file_display_name', os.path.basename(path))
+        return products, [{'name': name, 'rows': rows, 'products': len(products)}]
+    return read_batch(paths, *args, request.session.get('excel_hashes'), request.session.get('excel_names'))
+
 
 # ===========================================================
 # VIEW-ФУНКЦИИ
@@ -72,30 +82,39 @@ def upload_file(request):
     # 1. Обработка всех действий с юрлицами
     if request.method == 'POST' and 'entity_action' in request.POST:
         action = request.POST['entity_action']
-        
-        # Удаление
-        if action == 'delete':
-            remove_legal_entity(request.POST['delete_entity'])
-            return redirect('upload_file')
-            
-        # Добавление нового
-        elif action == 'add':
-            new_entity = request.POST.get('new_entity', '').strip()
-            if new_entity:
-                update_legal_entity(new_entity, add_to_list=True)
-            return redirect('upload_file')
-            
-        # Сохранение/использование
-        elif action in ['save', 'update']:
-            entity = request.POST.get('legal_entity', '').strip()
-            if entity:
-                update_legal_entity(entity, add_to_list=(action == 'save'))
-            return redirect('upload_file')
+        try:
+            # Удаление
+            if action == 'delete':
+                remove_legal_entity(request.POST['delete_entity'])
+                return redirect('upload_file')
+
+            # Добавление нового
+            elif action == 'add':
+                new_entity = request.POST.get('new_entity', '').strip()
+                if new_entity:
+                    update_legal_entity(new_entity, add_to_list=True)
+                return redirect('upload_file')
+
+            # Сохранение/использование
+            elif action in ['save', 'update']:
+                entity = request.POST.get('legal_entity', '').strip()
+                if entity:
+                    update_legal_entity(entity, add_to_list=(action == 'save'))
+                return redirect('upload_file')
+        except Timeout as e:
+            # Файл юрлиц дольше таймаута занят другим запросом или процессом
+            logger.error(f"Ошибка блокировки файла юрлиц: {str(e)}")
+            return JsonResponse({'status': 'error', 'message': 'Список юрлиц сейчас изменяется, повторите попытку'},
+                                status=503)
     """
     Обработка загрузки Excel-файла с выбором режима работы.
     Определяет тип генерации (массовая печать или создание шаблонов).
     """
-    # Очищаем сессию при новой загрузке
+    # Очищаем сессию при новой загрузке (вместе с файлами прошлой загрузки
+    # и их разобранными копиями в кэше)
+    for path in request.session.get('excel_paths', []):
+        evict_workbook(path)
+    remove_workspace(request.session.get('workspace'))
     request.session.flush()
     
     if request.method == 'POST':
@@ -103,39 +122,55 @@ def upload_file(request):
         if form.is_valid():
             # Определяем выбранный режим работы
             if form.cleaned_data.get('template_file'):  # Исправлено на использование метода
-                file = request.FILES['template_file']
+                files = form.cleaned_data['template_file']
                 request.session['is_template_mode'] = True
             else:
-                file = request.FILES['bulk_file']
+                files = form.cleaned_data['bulk_file']
                 request.session['is_template_mode'] = False
 
-            # Сохраняем оригинальное имя файла для отображения
-            original_filename = file.name
-            request.session['file_display_name'] = original_filename
+            # Сохраняем оригинальные имена файлов для отображения
+            original_names = [file.name for file in files]
+            request.session['file_display_name'] = ', '.join(original_names)
 
-            # Сохраняем файл во временную папку
-            fs = FileSystemStorage(location=os.path.join(settings.MEDIA_ROOT, 'temp'))
+            # Сохраняем файлы в отдельную папку этой загрузки
+            workspace = create_workspace(sum(file.size for file in files))
+            if workspace is None:
+                logger.error("Превышен общий объём загрузок")
+                form.add_error(None, "Недостаточно места для загрузки, попробуйте позже")
+                return render_upload(request, form)
+            workspace_id, workspace_dir = workspace
+            fs = FileSystemStorage(location=workspace_dir)
 
-            # Удаляем все файлы из папки temp перед сохранением нового
-            try:
-                for existing_file in fs.listdir('')[1]:
-                    fs.delete(existing_file)
-            except Exception as e:
-                logger.error(f"Ошибка очистки temp: {str(e)}")
-                
-            # Сохраняем файл
+            # Сохраняем файлы; шаги выбора заголовков и колонок работают по первому файлу
             try:
-                saved_filename = fs.save(original_filename, file)
-                request.session['excel_path'] = fs.path(saved_filename)
-                logger.info(f"Файл сохранен: {saved_filename}")  # Логирование сохраненного файла
+                paths = []
+                hashes = []
+                for file in files:
+                    with stage('upload', bytes=file.size):
+                        saved_filename = fs.save(file.name, file)
+                        paths.append(fs.path(saved_filename))
+                        hashes.append(file_digest(fs.path(saved_filename)))
+                    logger.info(f"Файл сохранен: {saved_filename}")  # Логирование сохраненного файла
+                request.session['excel_path'] = paths[0]
+                request.session['excel_hash'] = hashes[0]
+                request.session['excel_paths'] = paths
+                request.session['excel_hashes'] = hashes
+                request.session['excel_names'] = unique_names(original_names)
+                request.session['workspace'] = workspace_id
                 logger.info("Редирект на select_header")  # Логирование редиректа
                 return redirect('select_header')  # Убедитесь, что редирект здесь
             except Exception as e:
                 logger.error(f"Ошибка сохранения файла: {str(e)}")
+                remove_workspace(workspace_id)
                 form.add_error(None, "Ошибка сохранения файла")
     else:
         form = UploadForm()
 
+    return render_upload(request, form)
+
+
+def render_upload(request, form):
+    """Страница загрузки с формой form"""
     #  Формируем контекст
     legal_data = get_legal_entities()
     context = {
@@ -151,7 +186,7 @@ def select_header(request):
     Выбор строки с заголовками в Excel-файле.
     Пользователь указывает номер строки, содержащей названия колонок.
     """
-    if 'excel_path' not in request.session:
+    if not has_upload(request):
         return redirect('upload_file')
     
     if request.method == 'POST':
@@ -167,9 +202,19 @@ def select_header(request):
     excel_path = request.session.get('excel_path', '')
     file_name = os.path.basename(excel_path) if excel_path else 'Файл не выбран'
 
+    # Первые строки файла для подсказки (читаются без разбора всего файла)
+    try:
+        head_rows = preview_rows(excel_path)
+    except Exception as e:
+        logger.error(f"Ошибка предпросмотра файла: {str(e)}")
+        head_rows = []
+    suggested_row = guess_header_row(head_rows)
+
     # Контекст с информацией о файле и режиме
     context = {
         'form': form,
+        'head_rows': head_rows,
+        'suggested_row': suggested_row + 1 if suggested_row is not None else 5,
         'file_name': request.session.get('file_display_name', 'Файл не выбран'),
         'is_template_mode': request.session.get('is_template_mode', False)
     }
@@ -182,13 +227,12 @@ def select_columns(request):
     Выбор колонок, которые будут использоваться для генерации этикеток.
     Показывает предпросмотр данных для помощи пользователю.
     """
-    if 'excel_path' not in request.session or 'header_row' not in request.session:
+    if not has_upload(request, 'header_row'):
         return redirect('upload_file')
     
-    # Чтение Excel-файла с учетом выбранной строки заголовков
-    df = pd.read_excel(request.session['excel_path'], header=request.session['header_row'])
-    columns = df.columns.tolist()
-    sample_data = df.head(5).to_dict('records')
+    # Колонки и пример данных читаются из первых строк файла,
+    # полный разбор таблицы откладывается до шага редактирования
+    columns, sample_data = preview_workbook(request.session['excel_path'], request.session['header_row'])
     
     if request.method == 'POST':
         form = ColumnSelectForm(request.POST, columns=columns)
@@ -226,17 +270,36 @@ def label_settings(request):
     if request.method == 'POST':
         form = LabelSettingsForm(request.POST, columns=selected_columns)
         if form.is_valid():
-            # Сохраняем выбранные соответствия колонок
-            request.session['column_mapping'] = {
+            column_mapping = {
                 'barcode': form.cleaned_data['barcode_column'],
                 'product_name': form.cleaned_data['product_name_column'],
                 'article': form.cleaned_data['article_column'],
                 'size': form.cleaned_data['size_column']  # Добавляем размер
             }
-            return redirect('edit_data')
+            # Колонки выбраны по первому файлу - проверяем остальные файлы пакета
+            paths = request.session.get('excel_paths') or []
+            errors = []
+            if len(paths) > 1 and 'header_row' in request.session:
+                errors = missing_columns(
+                    paths,
+                    request.session['header_row'],
+                    required_columns(selected_columns, column_mapping),
+                    request.session.get('excel_names'),
+                )
+            for error in errors:
+                form.add_error(None, error)
+            if not errors:
+                # Сохраняем выбранные соответствия колонок
+                request.session['column_mapping'] = column_mapping
+                return redirect('edit_data')
     else:
         form = LabelSettingsForm(columns=selected_columns)
     
+    return render_label_settings(request, form)
+
+
+def render_label_settings(request, form):
+    """Страница настройки соответствий с формой form"""
     context = {
         'form': form,
         'file_name': request.session.get('file_display_name', 'Файл не выбран'),
@@ -247,102 +310,158 @@ def label_settings(request):
 
 
 def edit_data(request):
-    """Форма редактирования данных"""
-    if not all(key in request.session for key in ['excel_path', 'header_row', 'selected_columns', 'column_mapping']):
+    """
+    Форма редактирования данных.
+    Строки таблицы страница получает через edit_rows, а при отправке
+    передаёт только изменённые строки (поле changes, JSON).
+    """
+    if not has_upload(request, 'header_row', 'selected_columns', 'column_mapping'):
         return redirect('upload_file')
 
-    # Чтение и обработка данных из Excel
-    df = pd.read_excel(request.session['excel_path'], header=request.session['header_row'])
-    raw_data = df[request.session['selected_columns']].to_dict('records')
-    
-    size_column = request.session['column_mapping'].get('size')
-
-    # Группировка данных с подсчетом количества
-    grouped = {}
-    for item in raw_data:
-        article = str(item.get(request.session['column_mapping']['article'], '')).strip().lower()
-        barcode = str(item.get(request.session['column_mapping']['barcode'], '')).strip().lower()
-        color = str(item.get('Цвет', '')).strip().lower()
-        size = str(item.get(size_column, '')).strip().lower() if size_column else ''
-
-        key = f"{article}|{barcode}|{color}|{size}"
-        if key not in grouped:
-            grouped[key] = {
-                'data': item.copy(),
-                'quantity': 0  # Начинаем с 0
-            }
-            if size_column:
-                grouped[key]['data']['Размер'] = size
-        
-        # Увеличиваем счетчик для каждого найденного товара
-        grouped[key]['quantity'] += 1
-
-    # Умножаем количество на 2 (по 2 этикетки на товар) только в режиме массовой печати
-    if not request.session.get('is_template_mode', False):
-        for key in grouped:
-            grouped[key]['quantity'] *= 2
-
-    # Создаем формсет
-    EditFormSet = formset_factory(EditDataForm, extra=0)
-    
     if request.method == 'POST':
-        formset = EditFormSet(request.POST)
-        
-        if formset.is_valid():
-            # Определяем режим генерации из скрытого поля
-            generation_mode = request.POST.get('generation_mode', 'bulk')
-            is_template_mode = (generation_mode == 'template')
-            
-            # Обновляем данные из формы
-            for i, (key, values) in enumerate(grouped.items()):
-                form_data = formset[i].cleaned_data
-                grouped[key]['data']['Цвет'] = form_data.get('color', '')
-                if size_column:
-                    grouped[key]['data']['Размер'] = form_data.get('size', '')
-                
-                # Для шаблонов всегда 1, для массовой - сохраняем введенное значение (включая 0)
-                if is_template_mode:
-                    grouped[key]['quantity'] = 1
-                else:
-                    grouped[key]['quantity'] = form_data.get('quantity', grouped[key]['quantity'])
-
-            # Фильтруем данные, удаляя записи с нулевым количеством только в режиме массовой печати
-            if not is_template_mode:
-                processed_data = [item for item in grouped.values() if item['quantity'] > 0]
-            else:
-                processed_data = list(grouped.values())
-
-            # Сохраняем данные в сессии
-            request.session['processed_data'] = processed_data
-            request.session['is_template_mode'] = is_template_mode
-            request.session.modified = True
-            
-            return redirect('generate_pdf')
-    else:
-        # Устанавливаем начальное количество
-        initial_data = []
-        for item in grouped.values():
-            if request.session.get('is_template_mode', False):
-                initial_data.append({'quantity': 1})  # Для шаблонов всегда 1
-            else:
-                initial_data.append({'quantity': item['quantity']})  # Для массовой - сохраненное значение (×2 по умолчанию)
-        
-        formset = EditFormSet(initial=initial_data)
+        grid_id = request.session.get('grid_id')
+        job = load_job(grid_id)
+        if job is None:
+            return redirect('edit_data')
+        products = job['processed_data']
 
-    # Подготавливаем данные для отображения
-    grouped_list = [(k, {'data': v['data'], 'form': f}) for (k, v), f in zip(grouped.items(), formset)]
-    
+        try:
+            changes = json.loads(request.POST.get('changes') or '{}')
+            if not isinstance(changes, dict):
+                raise ValueError('ожидается объект')
+        except ValueError as e:
+            logger.error(f"Ошибка разбора изменений: {str(e)}")
+            return render_edit(request, grid_id, job, ['Не удалось прочитать изменения, обновите страницу'])
+
+        errors = apply_changes(products, changes, request.session['column_mapping'].get('size'))
+        if errors:
+            return render_edit(request, grid_id, job, errors, changes)
+
+        # Определяем режим генерации из скрытого поля
+        # template_zip - шаблоны, которые сразу скачиваются архивом
+        generation_mode = request.POST.get('generation_mode', 'bulk')
+        is_template_mode = generation_mode in ('template', 'template_zip')
+        if generation_mode == 'template_zip':
+            output_format = 'zip'
+        else:
+            output_format = generation_mode if generation_mode in OUTPUT_FORMATS else 'pdf'
+
+        # Строки с неверным штрих-кодом не печатаются: оператор их исключает
+        # (количество 0) или явно пропускает все такие строки
+        invalid = sum(1 for item in products if item.get('barcode_error') and (is_template_mode or item['quantity'] > 0))
+        if invalid and 'skip_invalid' not in request.POST:
+            return render_edit(request, grid_id, job, [
+                f"Неверных штрих-кодов: {invalid}. Исправьте файл, поставьте таким строкам количество 0 "
+                f"или отметьте «Пропустить товары с неверным штрих-кодом»"
+            ], changes)
+        if invalid:
+            products = [item for item in products if not item.get('barcode_error')]
+
+        # Готовые этикетки из библиотеки шаблонов (только для PDF массовой печати)
+        from_library = 'from_library' in request.POST
+
+        # Для шаблонов всегда 1, для массовой - удаляем записи с нулевым количеством
+        if is_template_mode:
+            for item in products:
+                item['quantity'] = 1
+            processed_data = products
+        else:
+            processed_data = [item for item in products if item['quantity'] > 0]
+
+        # Сохраняем данные в хранилище заданий, в сессии - только идентификатор.
+        # Задание привязано к сессии: чужие задания недоступны (см. own_job)
+        if request.session.session_key is None:
+            request.session.save()
+        with stage('session_save', products=len(processed_data)):
+            request.session['job_id'] = create_job(
+                processed_data, is_template_mode, output_format, from_library, request.session.session_key
+            )
+        request.session['is_template_mode'] = is_template_mode
+        request.session['output_format'] = output_format
+        request.session['background'] = 'background' in request.POST
+        request.session['from_library'] = from_library
+        request.session.modified = True
+
+        return redirect('generate_pdf')
+
+    # Чтение файлов (Excel - из кэша разобранных таблиц, CSV - по частям)
+    # и группировка данных с подсчетом количества
+    try:
+        products, sources = load_products(request)
+    except MissingColumnsError as e:
+        # В одном из файлов пакета нет выбранных колонок - возвращаем к сопоставлению
+        column_mapping = request.session['column_mapping']
+        form = LabelSettingsForm({
+            'barcode_column': column_mapping['barcode'],
+            'product_name_column': column_mapping['product_name'],
+            'article_column': column_mapping['article'],
+            'size_column': column_mapping.get('size', ''),
+        }, columns=request.session['selected_columns'])
+        form.is_valid()
+        for message in e.messages:
+            form.add_error(None, message)
+        return render_label_settings(request, form)
+
+    # Для шаблонов всегда 1, для массовой - по 2 этикетки на товар
+    is_template_mode = request.session.get('is_template_mode', False)
+    for item in products:
+        item['quantity'] = 1 if is_template_mode else item['quantity'] * 2
+
+    # Проверка штрих-кодов до генерации: неверные строки видны в таблице сразу
+    with stage('barcode_check', products=len(products)) as current:
+        current.record(invalid=check_products(products, request.session['column_mapping']['barcode']))
+
+    # Черновик таблицы хранится на сервере, страница загружает его по частям
+    with stage('session_save', products=len(products)):
+        grid_id = create_grid(products, is_template_mode, sources)
+    request.session['grid_id'] = grid_id
+
+    return render_edit(request, grid_id, {'processed_data': products, 'sources': sources})
+
+
+def render_edit(request, grid_id, job, errors=None, changes=None):
+    """
+    Страница редактирования черновика grid_id.
+    errors и changes - ошибки и неприменённые изменения прошлой отправки.
+    """
+    sources = job.get('sources') or []
     context = {
-        'formset': formset,
-        'grouped_list': grouped_list,
+        'rows_url': reverse('edit_rows'),
+        'page_size': settings.EDIT_PAGE_SIZE,
+        'total': len(job['processed_data']),
+        'invalid': sum(1 for item in job['processed_data'] if item.get('barcode_error')),
+        'errors': errors or [],
+        'changes': changes or {},
         'selected_columns': request.session['selected_columns'],
         'column_mapping': request.session['column_mapping'],
         'file_name': request.session.get('file_display_name', 'Файл не выбран'),
-        'is_template_mode': request.session.get('is_template_mode', False)
+        'is_template_mode': request.session.get('is_template_mode', False),
+        'output_format': request.session.get('output_format', 'pdf'),
+        'from_library': request.session.get('from_library', settings.LABEL_BULK_FROM_LIBRARY),
+        'sources': sources if len(sources) > 1 else [],
     }
-    
     return render(request, 'generator/edit.html', context)
 
+
+def edit_rows(request):
+    """
+    JSON со страницей строк черновика редактирования.
+    Параметры: page (с 1), page_size, q - поиск по значениям колонок,
+    invalid=1 - только строки с неверным штрих-кодом.
+    """
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = int(request.GET.get('page_size', settings.EDIT_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Неверный номер страницы'}, status=400)
+
+    with stage('edit_rows'):
+        result = page_rows(request.session.get('grid_id'), page, page_size, request.GET.get('q', ''),
+                           request.GET.get('invalid') == '1')
+    if result is None:
+        return JsonResponse({'status': 'error', 'message': 'Данные не найдены, загрузите файл заново'}, status=404)
+    return JsonResponse({'status': 'success', **result})
+
 # Функция для установки режима
 @csrf_exempt
 def set_generation_mode(request):
@@ -360,8 +479,19 @@ def generate_pdf(request):
     """
     Роутер для генерации PDF. Определяет тип генерации на основе флага в сессии.
     """
-    if 'processed_data' not in request.session:
+    if not job_exists(request.session.get('job_id')):
         return redirect('upload_file')
+
+    # Фоновая генерация: ставим задание в очередь и показываем страницу прогресса
+    if request.session.get('background', False):
+        job_id = request.session['job_id']
+        if job_progress(job_id) is None:
+            submit_job(job_id, get_legal_entities()['current'])
+        return render(request, 'generator/job_progress.html', {
+            'job_id': job_id,
+            'file_name': request.session.get('file_display_name', 'Файл не выбран'),
+            'is_template_mode': request.session.get('is_template_mode', False)
+        })
     
     # Выбираем обработчик в зависимости от режима
     if request.session.get('is_template_mode', False):
@@ -370,211 +500,51 @@ def generate_pdf(request):
         return generate_bulk_labels(request)  # Режим массовой печати
     
 
-def generate_templates_direct(request):
-    """Генерация шаблонов напрямую со страницы редактирования"""
-    if request.method == 'POST':
-        # Получаем данные из сессии
-        if not all(key in request.session for key in ['excel_path', 'header_row', 'selected_columns', 'column_mapping']):
-            return redirect('upload_file')
-        
-        # Чтение Excel-файла
-        df = pd.read_excel(request.session['excel_path'], header=request.session['header_row'])
-        raw_data = df[request.session['selected_columns']].to_dict('records')
-        
-        # Получаем название колонки с размером
-        size_column = request.session['column_mapping'].get('size')
-
-        # Создаем формсет
-        EditFormSet = formset_factory(EditDataForm, extra=0)
-        formset = EditFormSet(request.POST)
-        
-        if formset.is_valid():
-            grouped = {}
-            for i, item in enumerate(raw_data):
-                try:
-                    form_data = formset[i].cleaned_data
-                except IndexError:
-                    form_data = {'color': '', 'size': '', 'quantity': 1}
-                
-                # Нормализация данных
-                article = str(item.get(request.session['column_mapping']['article'], '')).strip().lower()
-                barcode = str(item.get(request.session['column_mapping']['barcode'], '')).strip().lower()
-                color = form_data.get('color', str(item.get('Цвет', '')).strip().lower())
-                size = form_data.get('size', str(item.get('Размер', '')).strip().lower())
-                size = form_data.get('size', str(item.get(size_column, '')).strip().lower()) if size_column else ''
-
-                key = f"{article}|{barcode}|{color}|{size}"
-                if key not in grouped:
-                    grouped[key] = {
-                        'data': item.copy(),
-                        'quantity': 1  # Для шаблонов всегда 1
-                    }
-                    grouped[key]['data']['Цвет'] = color
-                    if size_column:
-                        grouped[key]['data']['Размер'] = size
-
-            # Сохраняем данные в сессии
-            request.session['processed_data'] = list(grouped.values())
-            request.session['is_template_mode'] = True
-            
-            # Вызываем стандартную функцию генерации шаблонов
-            return generate_templates(request)
-    
-    return redirect('edit_data')
-
-
 def generate_templates(request):
     """
     Генерация отдельных PDF-файлов для каждого уникального товара.
-    Каждый файл сохраняется в папке шаблонов.
+    Каждый файл сохраняется в папке шаблонов. Товары распределяются
+    по пулу процессов (см. LABEL_WORKERS в settings.py).
     """
-    processed_data = request.session['processed_data']
+    job = load_job(request.session['job_id'])
     legal_data = get_legal_entities()
-    
-    # Создаем папку для шаблонов, если она не существует
-    os.makedirs(TEMPLATES_DIR, exist_ok=True)
-    
-    created = 0  # Счетчик созданных файлов
-    skipped = 0  # Счетчик пропущенных файлов (уже существующих)
 
-    # Регистрируем шрифт Arial
-    pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
-    styles = getSampleStyleSheet()
+    report = build_templates(job['processed_data'], legal_data['current'])
 
-    # =======================================================
-    # НАСТРОЙКА СТИЛЕЙ ТЕКСТА (одинаковые для всех режимов)
-    # =======================================================
-    
-    # Стиль для названия компании
-    company_style = styles["Normal"].clone('CompanyStyle')
-    company_style.fontName = "Arial"
-    company_style.fontSize = COMPANY_FONT_SIZE
-    company_style.alignment = 1  # Выравнивание по центру
-    company_style.leading = COMPANY_FONT_SIZE * 1.2  # Межстрочный интервал
-    company_style.spaceBefore = 1  # Отступ сверху
-    company_style.spaceAfter = 1   # Отступ снизу
-
-    # Стиль для названия товара
-    product_style = styles["Normal"].clone('ProductStyle')
-    product_style.fontName = "Arial"
-    product_style.fontSize = PRODUCT_FONT_SIZE
-    product_style.alignment = 1
-    product_style.leading = PRODUCT_FONT_SIZE * 1.3
-    product_style.splitLongWords = True  # Разрешаем перенос длинных слов
-    product_style.wordWrap = 'CJK'       # Алгоритм переноса для кириллицы
-    product_style.leftIndent = PRODUCT_SIDE_PADDING  # Левый отступ
-    product_style.rightIndent = PRODUCT_SIDE_PADDING  # Правый отступ
-
-    # Стиль для артикула
-    article_style = styles["Normal"].clone('ArticleStyle')
-    article_style.fontName = "Arial"
-    article_style.fontSize = ARTICLE_FONT_SIZE
-    article_style.alignment = 1
-    article_style.leading = ARTICLE_FONT_SIZE * 1.1
-    article_style.spaceBefore = 0.5 * mm  # Отступ сверху
-    article_style.spaceAfter = 0.5 * mm   # Отступ снизу
-
-    # Стиль для дополнительной информации (цвет/размер)
-    color_style = styles["Normal"].clone('ColorStyle')
-    color_style.fontName = "Arial"
-    color_style.fontSize = EXTRA_FONT_SIZE
-    color_style.alignment = 1
-    color_style.leading = EXTRA_FONT_SIZE * 1.1
-    color_style.spaceBefore = 1 * mm
-
-    # Обработка каждого товара
-    for product in processed_data:
-        data = product['data']
-        
-        # Формируем имя файла на основе штрих-кода и названия товара
-        barcode = str(data.get('Баркод', 'N/A')).strip()
-        product_name = str(data.get('Наименование', 'без_названия'))[:60]  # Обрезаем длинные названия
-        clean_name = product_name.replace(' ', ' ').replace('/', '-')  # Заменяем спецсимволы
-        filename = f"{barcode} {clean_name}.pdf"
-        filepath = os.path.join(TEMPLATES_DIR, filename)
-        
-        # Пропускаем существующие файлы
-        if os.path.exists(filepath):
-            skipped += 1
-            continue
-            
-        try:
-            # Создаем PDF-документ
-            response = HttpResponse(content_type='application/pdf')
-            p = canvas.Canvas(response, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
-            
-            current_y = PAGE_HEIGHT - MARGIN  # Стартовая позиция по Y
-            
-            # Отрисовка штрих-кода (если он есть)
-            if barcode != 'N/A':
-                # Генерация штрих-кода
-                barcode_img = code128.Code128(
-                    barcode,
-                    barHeight=BARCODE_HEIGHT,
-                    barWidth=BARCODE_BAR_WIDTH
-                )
-                # Центрирование штрих-кода
-                barcode_x = (PAGE_WIDTH - barcode_img.width) / 2
-                barcode_img.drawOn(p, barcode_x, current_y - BARCODE_TOP_MARGIN)
-                
-                # Текст под штрих-кодом
-                p.setFont("Arial", BARCODE_TEXT_SIZE)
-                text_width = p.stringWidth(barcode, "Arial", BARCODE_TEXT_SIZE)
-                text_x = (PAGE_WIDTH - text_width) / 2
-                p.drawString(text_x, current_y - BARCODE_TOP_MARGIN - BARCODE_TEXT_OFFSET, barcode)
-                
-                # Смещаем позицию Y вниз после штрих-кода
-                current_y -= AFTER_BARCODE_SPACE
-
-            # Список элементов для отображения (текст + стиль)
-            elements = [
-                (legal_data['current'], company_style),  # Динамическое название
-                (data.get('Наименование', 'Без названия'), product_style),
-                (f"Артикул: {data.get('Артикул', 'N/A')}", article_style)
-            ]
-            
-            # Добавляем размер, если он указан
-            if 'Размер' in data and data['Размер']:
-                elements.append((f"Размер: {data['Размер']}", color_style))
-
-            # Добавляем цвет, если он указан
-            if data.get('Цвет'):
-                elements.append((f"Цвет: {data['Цвет']}", color_style))
-            
-            # Отрисовка всех текстовых элементов
-            for text, style in elements:
-                para = Paragraph(text, style)
-                w, h = para.wrap(PAGE_WIDTH, PAGE_HEIGHT)  # Определение размера элемента
-                x = (PAGE_WIDTH - w) / 2  # Центрирование по горизонтали
-                para.drawOn(p, x, current_y - h)  # Отрисовка параграфа
-                
-                # Смещаем позицию Y с учетом отступа стиля
-                current_y -= h + style.spaceAfter
-
-            # Завершаем страницу
-            p.showPage()
-            p.save()
-            
-            # Сохраняем файл на диск
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            created += 1
-            
-        except Exception as e:
-            logger.error(f"Ошибка генерации шаблона {filename}: {str(e)}")
+    # Режим архива: новые и готовые шаблоны отдаются одним ZIP
+    if job.get('output_format') == 'zip':
+        return templates_archive(report['files'])
     
     # Возвращаем отчет с кнопкой возврата
     return render(request, 'generator/template_report.html', {
-        'created': created,
-        'skipped': skipped,
+        'created': report['created'],
+        'updated': report['updated'],
+        'skipped': report['skipped'],
+        'failed': report['failed'],
         'templates_dir': TEMPLATES_DIR
     })
 
+def templates_archive(filenames):
+    """
+    Ответ с ZIP-архивом шаблонов filenames из TEMPLATES_DIR.
+    Архив собирается по мере отправки, без сжатия и без временного файла.
+    """
+    filename, content_type = TEMPLATE_ARCHIVE
+    response = StreamingHttpResponse(
+        stream_zip(os.path.join(TEMPLATES_DIR, name) for name in filenames),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 def generate_bulk_labels(request):
     """
-    Генерация единого PDF-файла с множеством этикеток для массовой печати.
+    Генерация единого файла с множеством этикеток для массовой печати.
+    PDF: каждый уникальный товар рисуется один раз, копии ссылаются на готовую форму.
+    ZPL: по одному формату на товар, копии печатает принтер.
     """
-    processed_data = request.session['processed_data']
+    job = load_job(request.session['job_id'])
+    processed_data = job['processed_data']
     legal_data = get_legal_entities()
 
     # =====================================================
@@ -585,124 +555,94 @@ def generate_bulk_labels(request):
     zakazes = total_labels // 2  # Каждому заказу соответствует 2 этикетки
     
     # Логирование статистики
-    logger.info(f"Сгенерировано этикеток: {total_labels}")
-    logger.info(f"Уникальных товаров: {unique_products}")
-    logger.info(f"Заказов: {zakazes}")
-    
-    # Вывод в консоль для быстрого просмотра
-    print(f"\n=== ОТЧЕТ ===")
-    print(f"Заказов: {zakazes}")
-    print(f"Уникальных товаров: {unique_products}")
-    print(f"Всего этикеток: {total_labels}")
-    print("==============\n")
+    logger.info(
+        f"Массовая печать: заказов {zakazes}, уникальных товаров {unique_products}, "
+        f"всего этикеток {total_labels}"
+    )
     
-    # Подготовка PDF-документа для скачивания
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="labels.pdf"'
-    
-    # Регистрируем шрифт Arial
-    pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
-    p = canvas.Canvas(response, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+    # Документ пишется во временный файл на диске, а не в память процесса.
+    # Ответ начинается только после того, как файл собран целиком
+    # (reportlab и склейка частей выдают документ в конце); FileResponse
+    # затем отдаёт его блоками и удаляет. Для больших файлов, где важно
+    # не ждать в запросе, есть фоновая генерация со страницей прогресса.
+    output_format = request.session.get('output_format', 'pdf')
+    output = tempfile.TemporaryFile()
+    try:
+        build_bulk(processed_data, legal_data['current'], output, output_format,
+                   from_library=job.get('from_library', False))
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+
+    filename, content_type = OUTPUT_FORMATS[output_format]
+    return FileResponse(output, as_attachment=True, filename=filename, content_type=content_type)
+
+
+def own_job(request, job_id):
+    """Задание job_id, если оно создано в текущей сессии; иначе None"""
+    job = load_job(job_id)
+    if job is None or job.get('session') != request.session.session_key:
+        return None
+    return job
+
+
+def job_status(request, job_id):
+    """
+    JSON с ходом фоновой генерации: состояние, число готовых этикеток
+    (или шаблонов), общее число и ссылка на скачивание готового файла.
+    Задания других сессий не показываются.
+    """
+    progress = job_progress(job_id)
+    if progress is None or progress.get('session') != request.session.session_key:
+        return JsonResponse({'status': 'error', 'message': 'Задание не найдено'}, status=404)
+
+    data = {
+        'status': 'success',
+        'state': progress['state'],
+        'done': progress.get('done', 0),
+        'total': progress.get('total', 0),
+    }
+    if progress['state'] == 'done':
+        data['result'] = progress.get('result') or {}
+        if find_output(job_id) is not None:
+            data['download_url'] = reverse('job_download', args=[job_id])
+        elif 'files' in data['result']:
+            data['download_url'] = reverse('job_templates', args=[job_id])
+            # Список файлов отдаёт job_templates, в статусе он не нужен
+            data['result'] = {key: value for key, value in data['result'].items() if key != 'files'}
+    elif progress['state'] == 'error':
+        data['message'] = progress.get('error', '')
+    return JsonResponse(data)
+
+
+def job_download(request, job_id):
+    """Скачивание файла, подготовленного фоновым заданием текущей сессии"""
+    if not job_exists(job_id):
+        return redirect('upload_file')
+    output = find_output(job_id)
+    if own_job(request, job_id) is None or output is None:
+        raise Http404('Задание не найдено')
+    path, output_format = output
+    filename, content_type = OUTPUT_FORMATS[output_format]
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename, content_type=content_type)
 
-    # Стили текста (используем те же, что и для шаблонов)
-    styles = getSampleStyleSheet()
-    
-    # Стиль для названия компании
-    company_style = styles["Normal"].clone('CompanyStyle')
-    company_style.fontName = "Arial"
-    company_style.fontSize = COMPANY_FONT_SIZE
-    company_style.alignment = 1
-    company_style.leading = COMPANY_FONT_SIZE * 1.2
-    company_style.spaceBefore = 1
-    company_style.spaceAfter = 1
-
-    # Стиль для названия товара
-    product_style = styles["Normal"].clone('ProductStyle')
-    product_style.fontName = "Arial"
-    product_style.fontSize = PRODUCT_FONT_SIZE
-    product_style.alignment = 1
-    product_style.leading = PRODUCT_FONT_SIZE * 1.3
-    product_style.splitLongWords = True
-    product_style.wordWrap = 'CJK'
-    product_style.leftIndent = PRODUCT_SIDE_PADDING
-    product_style.rightIndent = PRODUCT_SIDE_PADDING
-
-    # Стиль для артикула
-    article_style = styles["Normal"].clone('ArticleStyle')
-    article_style.fontName = "Arial"
-    article_style.fontSize = ARTICLE_FONT_SIZE
-    article_style.alignment = 1
-    article_style.leading = ARTICLE_FONT_SIZE * 1.1
-    article_style.spaceBefore = 0.5 * mm
-    article_style.spaceAfter = 0.5 * mm
-
-    # Стиль для дополнительной информации (цвет/размер)
-    color_style = styles["Normal"].clone('ColorStyle')
-    color_style.fontName = "Arial"
-    color_style.fontSize = EXTRA_FONT_SIZE
-    color_style.alignment = 1
-    color_style.leading = EXTRA_FONT_SIZE * 1.1
-    color_style.spaceBefore = 1 * mm
-
-    # Обработка каждого товара
-    for product in processed_data:
-        data = product['data']
-        quantity = product['quantity']  # Количество этикеток для этого товара
-        
-        # Генерация указанного количества этикеток
-        for _ in range(quantity):
-            current_y = PAGE_HEIGHT - MARGIN  # Стартовая позиция по Y
-            
-            # Отрисовка штрих-кода (если он есть)
-            barcode_value = str(data.get('Баркод', 'N/A')).strip()
-            if barcode_value != 'N/A':
-                # Генерация штрих-кода
-                barcode = code128.Code128(
-                    barcode_value,
-                    barHeight=BARCODE_HEIGHT,
-                    barWidth=BARCODE_BAR_WIDTH
-                )
-                # Центрирование штрих-кода
-                barcode_x = (PAGE_WIDTH - barcode.width) / 2
-                barcode.drawOn(p, barcode_x, current_y - BARCODE_TOP_MARGIN)
-                
-                # Текст под штрих-кодом
-                p.setFont("Arial", BARCODE_TEXT_SIZE)
-                text_width = p.stringWidth(barcode_value, "Arial", BARCODE_TEXT_SIZE)
-                text_x = (PAGE_WIDTH - text_width) / 2
-                p.drawString(text_x, current_y - BARCODE_TOP_MARGIN - BARCODE_TEXT_OFFSET, barcode_value)
-                
-                # Смещаем позицию Y вниз после штрих-кода
-                current_y -= AFTER_BARCODE_SPACE
-
-            # Список элементов для отображения (текст + стиль)
-            elements = [
-                (legal_data['current'], company_style),  # Динамическое название
-                (data.get('Наименование', 'Без названия'), product_style),
-                (f"Артикул: {data.get('Артикул', 'N/A')}", article_style)
-            ]
-
-            # Добавляем размер, если он есть и не пустой
-            if 'Размер' in data and data['Размер']:
-                elements.append((f"Размер: {data['Размер']}", color_style))
-                        
-            # Добавляем цвет, если он есть и не пустой
-            if data.get('Цвет'):
-                elements.append((f"Цвет: {data['Цвет']}", color_style))
-
-            # Отрисовка всех текстовых элементов
-            for text, style in elements:
-                para = Paragraph(text, style)
-                w, h = para.wrap(PAGE_WIDTH, PAGE_HEIGHT)  # Определение размера элемента
-                x = (PAGE_WIDTH - w) / 2  # Центрирование по горизонтали
-                para.drawOn(p, x, current_y - h)  # Отрисовка параграфа
-                
-                # Смещаем позицию Y с учетом отступа стиля
-                current_y -= h + style.spaceAfter
-
-            # Завершаем страницу
-            p.showPage()
-    
-    # Сохраняем PDF-документ
-    p.save()
-    return response
\ No newline at end of file
+
+def job_templates(request, job_id):
+    """Скачивание шаблонов фонового задания текущей сессии архивом"""
+    if not job_exists(job_id):
+        return redirect('upload_file')
+    job = own_job(request, job_id)
+    if job is None or 'files' not in (job.get('result') or {}):
+        raise Http404('Задание не найдено')
+    return templates_archive(job['result']['files'])
+
+
+def metrics(request):
+    """
+    Метрики этапов обработки в текстовом формате Prometheus.
+    Доступны только с адресов из METRICS_ALLOWED_HOSTS.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_HOSTS:
+        return HttpResponseForbidden()
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,446 @@
+"""
+Чтение загруженных Excel-файлов: кэш разобранных таблиц и быстрый предпросмотр.
+
+Разбор xlsx через openpyxl - самая медленная часть шагов мастера, поэтому
+таблица разбирается один раз и сохраняется на диск в формате pickle
+(блочное хранение колонок pandas). Ключ кэша - хэш содержимого файла
+и номер строки заголовков.
+
+Выгрузки в CSV/TSV (кодировка utf-8 или cp1251, разделитель определяется
+по началу файла) читаются частями и группируются по ходу чтения,
+поэтому память не зависит от числа строк в файле.
+"""
+import csv
+import hashlib
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+from django.conf import settings
+from openpyxl import load_workbook
+
+from .grouping import group_rows, group_products, group_chunks, merge_groups
+from .metrics import stage
+from .pool import get_pool, pool_size, reset_pool
+
+logger = logging.getLogger(__name__)
+
+# Папка кэша разобранных таблиц
+CACHE_DIR = os.path.join(settings.MEDIA_ROOT, 'cache', 'workbooks')
+
+# Число строк для предпросмотра
+HEADER_PREVIEW_ROWS = 15  # Строк на шаге выбора заголовков
+SAMPLE_ROWS = 5           # Строк данных на шаге выбора колонок
+
+# Текстовые выгрузки
+CSV_EXTENSIONS = ('.csv', '.tsv')
+CSV_SAMPLE_BYTES = 64 * 1024  # Объём начала файла для определения кодировки и разделителя
+CSV_DELIMITERS = ';,\t|'
+
+
+def file_digest(path):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_path(digest, header_row):
+    return os.path.join(CACHE_DIR, f"{digest}_{header_row}.pkl")
+
+
+def read_workbook(path, header_row, digest=None):
+    """
+    Возвращает DataFrame загруженного файла.
+
+    При первом обращении файл разбирается pd.read_excel и кладётся в кэш,
+    последующие шаги мастера читают готовую таблицу из кэша.
+    """
+    digest = digest or file_digest(path)
+    cache_path = _cache_path(digest, header_row)
+
+    if os.path.exists(cache_path):
+        try:
+            with stage('excel_cache') as current:
+                df = pd.read_pickle(cache_path)
+                current.record(rows=len(df))
+            os.utime(cache_path)  # Отмечаем использование для вытеснения старых записей
+            return df
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша {cache_path}: {str(e)}")
+
+    with stage('excel_parse', bytes=os.path.getsize(path)) as current:
+        df = pd.read_excel(path, header=header_row)
+        current.record(rows=len(df))
+
+    _write_cache(df, cache_path)
+    return df
+
+
+def _write_cache(df, cache_path):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, cache_path)
+        _enforce_limit()
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша {cache_path}: {str(e)}")
+
+
+def evict_workbook(path):
+    """Удаляет из кэша все таблицы, разобранные из файла path"""
+    if not os.path.isdir(CACHE_DIR) or not os.path.exists(path):
+        return
+    prefix = f"{file_digest(path)}_"
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(prefix):
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+def _enforce_limit():
+    """Удаляет давно не использованные записи, пока кэш больше WORKBOOK_CACHE_MAX_BYTES"""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        entry_path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(entry_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= settings.WORKBOOK_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(entry_path)
+            total -= size
+        except OSError:
+            pass
+
+
+def read_products(path, header_row, selected_columns, column_mapping, digest=None):
+    """
+    Товары загруженного файла, сгруппированные group_products.
+
+    Excel-файлы читаются целиком (через кэш read_workbook),
+    CSV/TSV - частями по CSV_CHUNK_ROWS строк.
+    """
+    if not is_csv(path):
+        df = read_workbook(path, header_row, digest)
+        with stage('grouping', rows=len(df)) as current:
+            products = group_products(df, selected_columns, column_mapping)
+            current.record(products=len(products))
+        return products
+
+    with stage('csv_grouping', bytes=os.path.getsize(path)) as current:
+        products = group_chunks(read_csv_chunks(path, header_row, selected_columns), selected_columns, column_mapping)
+        current.record(rows=sum(product['quantity'] for product in products), products=len(products))
+    return products
+
+
+# ===========================================================
+# НЕСКОЛЬКО ФАЙЛОВ
+# ===========================================================
+
+def _parse_excel(task):
+    """Разбор Excel-файла в рабочем процессе: task = (path, header_row)"""
+    path, header_row = task
+    return pd.read_excel(path, header=header_row)
+
+
+def parse_workbooks(paths, header_row, digests):
+    """
+    Разбирает Excel-файлы, которых ещё нет в кэше, в общем пуле процессов
+    (см. pool.py) и кладёт результат в кэш read_workbook. Если пул недоступен,
+    файлы остаются неразобранными и читаются последовательно.
+    """
+    pending = {}  # Одинаковые файлы разбираются один раз
+    for path, digest in zip(paths, digests):
+        cache_path = _cache_path(digest, header_row)
+        if not is_csv(path) and cache_path not in pending and not os.path.exists(cache_path):
+            pending[cache_path] = path
+    pending = [(path, cache_path) for cache_path, path in pending.items()]
+    workers = pool_size(settings.LABEL_WORKERS)
+    if min(workers, len(pending)) < 2:
+        return  # Один файл разберёт read_workbook без запуска пула
+
+    total_bytes = sum(os.path.getsize(path) for path, _ in pending)
+    with stage('excel_parse_batch', files=len(pending), bytes=total_bytes) as current:
+        pool = None
+        try:
+            pool = get_pool(workers)
+            tasks = [(path, header_row) for path, _ in pending]
+            for (_, cache_path), df in zip(pending, pool.map(_parse_excel, tasks)):
+                current.record(rows=current.counts.get('rows', 0) + len(df))
+                _write_cache(df, cache_path)
+        except (BrokenProcessPool, OSError) as e:
+            # Пул процессов недоступен или рабочий процесс завершился -
+            # неразобранные файлы разберёт read_workbook в текущем процессе
+            logger.error(f"Ошибка пула разбора файлов: {str(e)}")
+            if pool is not None:
+                reset_pool(pool)
+
+
+class MissingColumnsError(ValueError):
+    """В части загруженных файлов нет выбранных колонок; messages - по файлу на строку"""
+
+    def __init__(self, messages):
+        super().__init__('; '.join(messages))
+        self.messages = messages
+
+
+def required_columns(selected_columns, column_mapping):
+    """Колонки, которые должны быть в каждом файле: выбранные и сопоставленные"""
+    mapped = [column for column in column_mapping.values() if column]
+    return list(dict.fromkeys(list(selected_columns) + mapped))
+
+
+def missing_columns(paths, header_row, columns, names=None):
+    """
+    Проверяет строку заголовков каждого файла (без разбора всего файла).
+    Возвращает список ошибок вида "файл: нет колонок ..." (пустой, если все колонки есть).
+    """
+    names = names or [os.path.basename(path) for path in paths]
+    errors = []
+    for path, name in zip(paths, names):
+        rows = read_head_rows(path, header_row + 1)
+        header = column_names(rows[header_row], len(rows[header_row])) if header_row < len(rows) else []
+        missing = [str(column) for column in columns if column not in header]
+        if missing:
+            errors.append(f"Файл {name}: нет колонок {', '.join(missing)} (строка заголовков {header_row + 1})")
+    return errors
+
+
+def read_batch(paths, header_row, selected_columns, column_mapping, digests=None, names=None):
+    """
+    Товары нескольких загруженных файлов одним списком.
+
+    Файлы читаются с одной строкой заголовков и одними колонками, одинаковые
+    товары из разных файлов объединяются (количество складывается), каждый
+    товар получает сводку product['sources'] = {имя файла: число строк}.
+    Возвращает (products, sources): sources - [{'name', 'rows', 'products'}]
+    по каждому файлу. Если в каком-то файле нет нужных колонок, вызывает
+    MissingColumnsError.
+    """
+    digests = [digest or file_digest(path) for path, digest in zip(paths, digests or [None] * len(paths))]
+    names = names or [os.path.basename(path) for path in paths]
+    # Заголовки и колонки выбраны по первому файлу - остальные проверяются до разбора
+    errors = missing_columns(paths, header_row, required_columns(selected_columns, column_mapping), names)
+    if errors:
+        raise MissingColumnsError(errors)
+    parse_workbooks(paths, header_row, digests)
+
+    parts = []
+    sources = []
+    for path, digest, name in zip(paths, digests, names):
+        if is_csv(path):
+            chunks = read_csv_chunks(path, header_row, selected_columns)
+        else:
+            chunks = [read_workbook(path, header_row, digest)]
+        rows = 0
+        product_keys = set()
+        for chunk in chunks:
+            keys, grouped = group_rows(chunk, selected_columns, column_mapping)
+            rows += len(chunk)
+            product_keys.update(keys)
+            parts.append((name, keys, grouped))
+        sources.append({'name': name, 'rows': rows, 'products': len(product_keys)})
+
+    with stage('batch_merge', rows=sum(source['rows'] for source in sources)) as current:
+        merged = merge_groups(parts)
+        current.record(products=len(merged))
+    return merged, sources
+
+
+# ===========================================================
+# CSV/TSV
+# ===========================================================
+
+def is_csv(path):
+    """Текстовая выгрузка (CSV/TSV), а не Excel-файл"""
+    return os.path.splitext(path)[1].lower() in CSV_EXTENSIONS
+
+
+def detect_encoding(sample):
+    """Кодировка по началу файла: utf-8 (в том числе с BOM) или cp1251"""
+    if sample.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Начало файла могло оборваться посреди многобайтного символа
+        if e.start < len(sample) - 3:
+            return 'cp1251'
+    return 'utf-8'
+
+
+def detect_delimiter(text, path):
+    """Разделитель колонок по первым строкам файла"""
+    lines = [line for line in text.splitlines()[:HEADER_PREVIEW_ROWS + SAMPLE_ROWS] if line.strip()]
+    try:
+        return csv.Sniffer().sniff('\n'.join(lines), delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        pass
+    if path.lower().endswith('.tsv'):
+        return '\t'
+    # Самый частый из возможных разделителей
+    counts = {delimiter: sum(line.count(delimiter) for line in lines) for delimiter in CSV_DELIMITERS}
+    return max(counts, key=counts.get) if any(counts.values()) else ','
+
+
+def csv_dialect(path):
+    """(кодировка, разделитель) текстовой выгрузки"""
+    with open(path, 'rb') as f:
+        sample = f.read(CSV_SAMPLE_BYTES)
+    encoding = detect_encoding(sample)
+    text = sample.decode(encoding, errors='ignore')
+    if len(sample) == CSV_SAMPLE_BYTES:
+        text = text[:text.rfind('\n') + 1]  # Последняя строка образца может быть неполной
+    return encoding, detect_delimiter(text, path)
+
+
+def read_csv_head_rows(path, nrows):
+    """Первые nrows строк текстовой выгрузки (ячейки - строки)"""
+    encoding, delimiter = csv_dialect(path)
+    rows = []
+    with open(path, encoding=encoding, errors='replace', newline='') as f:
+        for row in csv.reader(f, delimiter=delimiter):
+            rows.append(row)
+            if len(rows) >= nrows:
+                break
+    return rows
+
+
+def read_csv_chunks(path, header_row, columns):
+    """
+    Итератор по частям текстовой выгрузки (DataFrame по CSV_CHUNK_ROWS строк).
+
+    Читаются только колонки columns, все значения - строки (штрих-коды
+    не превращаются в числа), полностью пустые строки пропускаются.
+    """
+    encoding, delimiter = csv_dialect(path)
+    reader = pd.read_csv(
+        path,
+        sep=delimiter,
+        encoding=encoding,
+        encoding_errors='replace',
+        header=header_row,
+        usecols=lambda column: column in columns,
+        dtype=str,
+        skip_blank_lines=False,
+        chunksize=settings.CSV_CHUNK_ROWS,
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk.dropna(how='all')
+
+
+# ===========================================================
+# БЫСТРЫЙ ПРЕДПРОСМОТР (без разбора всего файла)
+# ===========================================================
+
+def read_head_rows(path, nrows):
+    """
+    Читает первые nrows строк первого листа в потоковом режиме openpyxl
+    (текстовые выгрузки - модулем csv).
+    Время чтения не зависит от общего числа строк в файле.
+    """
+    if is_csv(path):
+        rows = read_csv_head_rows(path, nrows)
+        for row in rows:
+            while row and row[-1] == '':
+                row.pop()
+        return rows
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()  # Размеры листа в выгрузках часто указаны неверно
+        rows = []
+        for row in ws.iter_rows(max_row=nrows, values_only=True):
+            row = list(row)
+            # Отбрасываем пустые ячейки в конце строки (как pd.read_excel)
+            while row and row[-1] in (None, ''):
+                row.pop()
+            rows.append(row)
+    finally:
+        wb.close()
+    return rows
+
+
+def _is_number(value):
+    try:
+        float(value.replace(',', '.'))
+    except ValueError:
+        return False
+    return True
+
+
+def guess_header_row(rows):
+    """
+    Номер строки (с 0), похожей на заголовки: больше всего текстовых ячеек
+    (числа, записанные текстом, как в CSV, не считаются).
+    Возвращает None, если в строках нет текста.
+    """
+    best_row, best_count = None, 0
+    for index, row in enumerate(rows):
+        count = sum(1 for value in row if isinstance(value, str) and value.strip() and not _is_number(value))
+        if count > best_count:
+            best_row, best_count = index, count
+    return best_row
+
+
+def column_names(header, width):
+    """
+    Названия колонок по строке заголовков - так же, как их получает pd.read_excel:
+    пустые ячейки становятся "Unnamed: N", повторы получают суффиксы ".1", ".2".
+    """
+    header = list(header) + [None] * (width - len(header))
+    names = []
+    counts = {}
+    for index, value in enumerate(header):
+        name = f"Unnamed: {index}" if value in (None, '') else value
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts.get(name, 0)
+        names.append(name)
+        counts[name] = count + 1
+    return names
+
+
+def preview_rows(path, nrows=HEADER_PREVIEW_ROWS):
+    """Первые строки файла, выровненные по ширине (для выбора строки заголовков)"""
+    rows = read_head_rows(path, nrows)
+    width = max((len(row) for row in rows), default=0)
+    return [
+        ['' if value is None else value for value in row] + [''] * (width - len(row))
+        for row in rows
+    ]
+
+
+def preview_workbook(path, header_row, nrows=SAMPLE_ROWS):
+    """
+    Колонки и первые nrows строк данных при заданной строке заголовков.
+    Возвращает (columns, sample_data) в том же виде, что и DataFrame.head().
+    """
+    rows = read_head_rows(path, header_row + 1 + nrows)
+    if header_row >= len(rows):
+        return [], []
+
+    width = max(len(row) for row in rows[header_row:])
+    columns = column_names(rows[header_row], width)
+    sample_data = [
+        {column: ('' if value is None else value) for column, value in zip(columns, row + [None] * (width - len(row)))}
+        for row in rows[header_row + 1:]
+    ]
+    return columns, sample_data
@@ -0,0 +1,147 @@
+"""
+Рабочие папки загрузок.
+
+Каждая загрузка получает собственную папку media/temp/<идентификатор>,
+идентификатор хранится в сессии. Поэтому упаковщики, работающие с сервером
+одновременно, не удаляют файлы друг друга. Папки, не использовавшиеся
+дольше UPLOAD_TTL, удаляет фоновый поток, а общий объём загрузок
+ограничен UPLOAD_MAX_BYTES.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Папка с рабочими папками загрузок
+WORKSPACES_DIR = os.path.join(settings.MEDIA_ROOT, 'temp')
+
+# Проверка места и создание папки выполняются по очереди,
+# чтобы параллельные загрузки не превысили предел вместе
+_space_lock = threading.Lock()
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def workspace_path(workspace_id):
+    # Идентификатор приходит из сессии - допускаем только hex-строки uuid
+    if not workspace_id or not all(c in '0123456789abcdef' for c in workspace_id):
+        return None
+    return os.path.join(WORKSPACES_DIR, workspace_id)
+
+
+def _folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _workspaces():
+    """Список (время последнего использования, путь) всех рабочих папок"""
+    if not os.path.isdir(WORKSPACES_DIR):
+        return []
+    result = []
+    for name in os.listdir(WORKSPACES_DIR):
+        path = os.path.join(WORKSPACES_DIR, name)
+        try:
+            result.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    return result
+
+
+def used_bytes():
+    """Общий объём загруженных файлов"""
+    return _folder_size(WORKSPACES_DIR) if os.path.isdir(WORKSPACES_DIR) else 0
+
+
+def create_workspace(needed_bytes=0):
+    """
+    Создаёт рабочую папку для загрузки needed_bytes байт.
+    Возвращает (идентификатор, путь) или None, если места не хватает
+    даже после удаления устаревших папок.
+    """
+    start_sweeper()
+    with _space_lock:
+        if used_bytes() + needed_bytes > settings.UPLOAD_MAX_BYTES:
+            cleanup_workspaces()
+            if used_bytes() + needed_bytes > settings.UPLOAD_MAX_BYTES:
+                return None
+
+        workspace_id = uuid.uuid4().hex
+        path = workspace_path(workspace_id)
+        os.makedirs(path)
+        return workspace_id, path
+
+
+def touch_workspace(workspace_id):
+    """
+    Отмечает использование папки (отсчёт UPLOAD_TTL начинается заново).
+    Возвращает False, если папки уже нет.
+    """
+    path = workspace_path(workspace_id)
+    if path is None:
+        return False
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def remove_workspace(workspace_id):
+    """Удаляет рабочую папку вместе с файлами"""
+    path = workspace_path(workspace_id)
+    if path is not None and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def cleanup_workspaces(ttl=None):
+    """Удаляет папки, не использовавшиеся дольше ttl секунд (по умолчанию UPLOAD_TTL)"""
+    ttl = settings.UPLOAD_TTL if ttl is None else ttl
+    expire_before = time.time() - ttl
+    removed = 0
+    for mtime, path in _workspaces():
+        if mtime >= expire_before:
+            continue
+        # Файлы из общей папки temp прежних версий удаляются так же
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        removed += 1
+    return removed
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(settings.UPLOAD_SWEEP_INTERVAL)
+        try:
+            removed = cleanup_workspaces()
+            if removed:
+                logger.info(f"Удалено устаревших загрузок: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки загрузок: {str(e)}")
+
+
+def start_sweeper():
+    """Запускает фоновую очистку устаревших папок (один поток на процесс)"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = threading.Thread(target=_sweep_forever, name='workspace-sweeper', daemon=True)
+            _sweeper.start()
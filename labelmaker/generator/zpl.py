@@ -0,0 +1,131 @@
+"""
+Вывод этикеток на языке термопринтеров ZPL.
+
+Вёрстка повторяет PDF-этикетку (константы и стили из rendering.py):
+штрих-код печатается встроенной командой принтера, переносы строк текста
+берутся у reportlab, а количество копий задаётся командой ^PQ, поэтому
+каждый товар занимает в файле один короткий формат, а не страницы.
+
+Встроенный шрифт принтера 0 не содержит кириллицы, поэтому текст
+печатается масштабируемым шрифтом из памяти принтера (^A@ с путём
+к шрифту, по умолчанию резидентный Swiss 721 - E:TT0003M_.FNT;
+загруженный TTF указывается так же, например E:ARIAL.TTF).
+Модуль не зависит от Django.
+"""
+from reportlab.platypus import Paragraph
+
+from .rendering import (
+    PAGE_WIDTH, PAGE_HEIGHT, MARGIN,
+    BARCODE_HEIGHT, BARCODE_BAR_WIDTH, BARCODE_TEXT_SIZE, BARCODE_TOP_MARGIN,
+    BARCODE_TEXT_OFFSET, AFTER_BARCODE_SPACE,
+    register_fonts, build_styles, encode_barcode, label_elements, to_dots, paragraph_lines,
+)
+
+# Разрешение печати по умолчанию (точек на дюйм)
+DEFAULT_DPI = 203
+
+# Шрифт текста по умолчанию: резидентный Swiss 721 с кириллицей (Link-OS)
+DEFAULT_FONT = 'E:TT0003M_.FNT'
+
+# Символы, которые нельзя передавать в ^FD как есть (заменяются hex-кодами через ^FH)
+_SPECIAL_CHARS = {'_': '_5F', '^': '_5E', '~': '_7E'}
+
+
+def field_data(text):
+    """Команда ^FD с текстом поля (служебные символы ZPL экранируются)"""
+    text = str(text).replace('\n', ' ')
+    if any(char in text for char in _SPECIAL_CHARS):
+        text = ''.join(_SPECIAL_CHARS.get(char, char) for char in text)
+        return f"^FH^FD{text}^FS"
+    return f"^FD{text}^FS"
+
+
+def font_command(font, size):
+    """
+    Команда выбора шрифта высотой size точек.
+    font - путь к шрифту в памяти принтера (E:TT0003M_.FNT, E:ARIAL.TTF)
+    или однобуквенное имя встроенного шрифта (0, A-Z).
+    """
+    if len(font) == 1:
+        return f"^A{font}N,{size},{size}"
+    return f"^A@N,{size},{size},{font}"
+
+
+def text_block(top, left, width, lines, font_size, leading, dpi, font=DEFAULT_FONT):
+    """Блок строк, выровненных по центру области шириной width (все величины в пунктах)"""
+    size = to_dots(font_size, dpi)
+    spacing = max(to_dots(leading - font_size, dpi), 0)
+    text = '\\&'.join(lines)  # \& - перевод строки внутри ^FB
+    return (
+        f"^FO{to_dots(left, dpi)},{to_dots(top, dpi)}"
+        + font_command(font, size)
+        + f"^FB{to_dots(width, dpi)},{len(lines)},{spacing},C,0"
+        + field_data(text)
+    )
+
+
+def label_zpl(data, company, styles, quantity, dpi=DEFAULT_DPI, font=DEFAULT_FONT):
+    """Формат ZPL одной этикетки товара с quantity копиями, текст - шрифтом font"""
+    commands = [
+        '^XA',
+        '^CI28',  # Текст полей в UTF-8
+        f"^PW{to_dots(PAGE_WIDTH, dpi)}^LL{to_dots(PAGE_HEIGHT, dpi)}^LH0,0",
+    ]
+    top = MARGIN  # Позиция от верхнего края (в ZPL начало координат сверху)
+
+    barcode_value = str(data.get('Баркод', 'N/A')).strip()
+    if barcode_value != 'N/A':
+        # Ширина модуля в точках и число модулей - по той же кодировке, что и в PDF
+        module = max(to_dots(BARCODE_BAR_WIDTH, dpi), 1)
+        bars = encode_barcode(barcode_value, BARCODE_HEIGHT, BARCODE_BAR_WIDTH).bars
+        modules = round((bars[-1][0] + bars[-1][1] - bars[0][0]) / BARCODE_BAR_WIDTH) if bars else 0
+        barcode_x = max((to_dots(PAGE_WIDTH, dpi) - modules * module) // 2, 0)
+        barcode_top = top + BARCODE_TOP_MARGIN - BARCODE_HEIGHT
+        height = to_dots(BARCODE_HEIGHT, dpi)
+        commands.append(
+            f"^BY{module}^FO{barcode_x},{to_dots(barcode_top, dpi)}"
+            f"^BCN,{height},N,N,N,A" + field_data(barcode_value)
+        )
+
+        # Текст под штрих-кодом: базовая линия на BARCODE_TEXT_OFFSET ниже штрих-кода
+        baseline = top + BARCODE_TOP_MARGIN + BARCODE_TEXT_OFFSET
+        commands.append(text_block(
+            baseline - BARCODE_TEXT_SIZE, 0, PAGE_WIDTH, [barcode_value],
+            BARCODE_TEXT_SIZE, BARCODE_TEXT_SIZE, dpi, font,
+        ))
+        top += AFTER_BARCODE_SPACE
+
+    for text, style in label_elements(data, company, styles):
+        para = Paragraph(text, style)
+        _, h = para.wrap(PAGE_WIDTH, PAGE_HEIGHT)
+        lines = paragraph_lines(para)
+        if lines:
+            width = PAGE_WIDTH - style.leftIndent - style.rightIndent
+            commands.append(text_block(
+                top, style.leftIndent, width, lines, style.fontSize, style.leading, dpi, font,
+            ))
+        top += h + style.spaceAfter
+
+    commands.append(f"^PQ{quantity}")
+    commands.append('^XZ')
+    return '\n'.join(commands) + '\n'
+
+
+def render_bulk_zpl(processed_data, company, output, dpi=DEFAULT_DPI, progress=None, font=DEFAULT_FONT):
+    """
+    Записывает задание для термопринтера в файлоподобный объект output (bytes).
+
+    Каждый товар - один формат ZPL, копии печатает сам принтер (^PQ).
+    font - шрифт текста (см. font_command).
+    progress(n) вызывается после каждого товара с числом его этикеток.
+    """
+    register_fonts()
+    styles = build_styles()
+
+    for product in processed_data:
+        quantity = product['quantity']
+        if quantity <= 0:
+            continue
+        output.write(label_zpl(product['data'], company, styles, quantity, dpi, font).encode('utf-8'))
+        if progress:
+            progress(quantity)
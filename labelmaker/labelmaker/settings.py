@@ -100,8 +100,23 @@ SESSION_SAVE_EVERY_REQUEST = True  # Важно для надежного сох
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-# Увеличиваем лимит полей формы
-DATA_UPLOAD_MAX_NUMBER_FIELDS = 50000  # Стандартное значение - 1000
+# Генерация этикеток
+LABEL_WORKERS = None  # Число процессов для генерации (None - по числу ядер)
+LABEL_PARALLEL_THRESHOLD = 20  # Меньше этого числа шаблонов генерируем в одном процессе
+LABEL_SHARD_THRESHOLD = 3000  # Меньше этого числа этикеток единый PDF рисуется в одном процессе
+LABEL_BULK_FROM_LIBRARY = False  # Брать готовые этикетки для массовой печати из библиотеки шаблонов (только чтение): значение по умолчанию для отметки на странице редактирования и --from-library
+LABEL_PRINTER_DPI = 203  # Разрешение принтера для ZPL и растрового вывода (203 или 300)
+LABEL_ZPL_FONT = 'E:TT0003M_.FNT'  # Шрифт текста ZPL в памяти принтера (с кириллицей); '0' - встроенный шрифт без кириллицы
+LABEL_PAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Предельный размер кэша отрисованных этикеток
+WORKBOOK_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Предельный размер кэша разобранных Excel-файлов
+CSV_CHUNK_ROWS = 100_000  # Строк в одной части при чтении CSV/TSV
+EDIT_PAGE_SIZE = 100  # Строк на одной странице редактирования данных
+JOB_TTL = 24 * 60 * 60  # Время хранения заданий на генерацию (секунды)
+BACKGROUND_WORKERS = 2  # Число одновременно выполняемых фоновых заданий
+UPLOAD_TTL = 24 * 60 * 60  # Время хранения загруженных файлов без обращений (секунды)
+UPLOAD_SWEEP_INTERVAL = 10 * 60  # Период фоновой очистки устаревших загрузок (секунды)
+UPLOAD_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Предельный общий объём загруженных файлов
+METRICS_ALLOWED_HOSTS = ['127.0.0.1', '::1']  # Адреса, с которых доступен /metrics/
 
 
 STATICFILES_DIRS = [
@@ -134,6 +149,11 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'INFO',
         },
+        # Замеры этапов обработки (generator/metrics.py)
+        'generator.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
 